@@ -0,0 +1,332 @@
+"""
+Benchmarks of tagging, feature extraction, decoding, evaluation and training on the bundled data, written to a JSON
+file so that two runs (e.g. before and after a change) can be compared.  The tagging benchmarks use a model trained
+first for an epoch of averaged_perceptron on the training sentences (the shipped model has keys in an older format,
+which load_model rejects), or the model given.
+
+    predict          sentences/s and tokens/s tagging ner.dev, batched, one sentence at a
+                     time and with a beam, and the peak memory of each
+    load             seconds to read the model, as text and as a binary model
+    length_buckets   the same per bucket of sentence length, and decoding alone on precomputed score matrices
+    tagset_scaling   decoding alone on random score matrices with more and more tags
+    features         Features.compute_features over the gold tags, and compiling the features (CompiledFeatures),
+                     and the hit rates of the word memos of features.py
+    evaluation       ChunkCounter and conlleval.count_chunks on the tags predicted for ner.dev
+    train            seconds per epoch of each main_train method and optimizer on the first train_size sentences of
+                     ner.train, without the evaluation after each epoch (see profiling.py)
+
+Every timing is the best of a few repeats.  Memory is the peak of the Python and numpy allocations (tracemalloc),
+measured in a separate run.
+
+Usage:
+    python benchmark.py <results.json> [quick] [model]
+    python benchmark.py compare <old.json> <new.json> [tolerance]
+"""
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import tracemalloc
+
+import numpy as np
+
+import profiling
+from features import Features, FeatureIndex, word_attributes, word_gazetteer_types, word_cache_info
+from helpers import read_data, predict, predict_all, compute_score_matrices, compile_data, TAGSET, FEATURE_NAMES
+from decode import viterbi, viterbi_batch, BeamDecoder
+from conlleval import ChunkCounter, count_chunks
+from binary_model import read_model, write_binary_model, read_binary_model
+from train import train
+
+LENGTH_BUCKETS = [(1, 5), (6, 10), (11, 20), (21, 40), (41, None)]
+TAGSET_SIZES = [5, 9, 17, 33]
+# (method, optimizer, l2) as passed to main_train
+TRAINING_METHODS = [('structured_perceptron', 'sgd', None), ('structured_perceptron', 'adagrad', None),
+                    ('averaged_perceptron', 'sgd', None), ('svm', 'svm', 0.0001), ('svm_modified', 'svm', None)]
+
+
+def _best_time(func, repeat):
+    """
+    :return: Tuple of (the fewest seconds func took over repeat calls, the result of the last call)
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def _peak_mb(func):
+    """
+    :return: Megabytes allocated at most while func ran
+    """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def _rates(seconds, data):
+    n_tokens = sum(len(inputs['tokens'])-2 for inputs in data)
+    return {'seconds': seconds, 'sentences_per_s': len(data)/seconds if seconds else 0.0,
+            'tokens_per_s': n_tokens/seconds if seconds else 0.0}
+
+
+def load_model(filename):
+    """
+    Raises ValueError if most of the weights do not fit the layout of the WeightMatrix, e.g. a model written with
+    the old feature keys: scoring ignores those weights, so every benchmark would time an all-zero model.
+    :param filename: String.  A text or binary model
+    :return: FeatureVector over a WeightMatrix
+    """
+    parameters = read_model(filename, TAGSET)
+    weights = parameters.fdict
+    if len(weights.extra) > len(weights)/2:
+        raise ValueError('%d of the %d weights of %s do not fit the feature layout, so scoring would ignore them: '
+                         'train a new model' % (len(weights.extra), len(weights), filename))
+    return parameters
+
+
+def train_model(data, filename, epochs=1):
+    """
+    Trains the model the tagging benchmarks use, with averaged_perceptron, and writes it as a text model
+    :param data: Array of dictionaries, as returned by read_data
+    :param filename: String
+    :param epochs: Int
+    :return: None
+    """
+    train(data, FEATURE_NAMES, TAGSET, epochs, 'averaged_perceptron', 'sgd').write_to_file(filename)
+
+
+def bench_load(model_filename, repeat=3):
+    """
+    Seconds to read the model as text and as a binary model
+    """
+    text_seconds, parameters = _best_time(lambda: load_model(model_filename), repeat)
+    binary_filename = 'outputs/benchmark.model.bin'
+    write_binary_model(parameters, binary_filename)
+    binary_seconds, _ = _best_time(lambda: read_binary_model(binary_filename), repeat)
+    return {'text': {'seconds': text_seconds, 'bytes': os.path.getsize(model_filename)},
+            'binary': {'seconds': binary_seconds, 'bytes': os.path.getsize(binary_filename)}}
+
+
+def bench_predict(data, parameters, repeat=3):
+    """
+    Tagging speed and peak memory of the decoders on data
+    """
+    decoders = {'batch': lambda: predict_all(data, parameters, FEATURE_NAMES, TAGSET),
+                'per_sentence': lambda: [predict(inputs, len(inputs['tokens']), parameters, FEATURE_NAMES, TAGSET) for inputs in data],
+                'beam4': lambda: predict_all(data, parameters, FEATURE_NAMES, TAGSET, decoder=BeamDecoder(4))}
+    results = {}
+    for name, func in decoders.items():
+        seconds, _ = _best_time(func, repeat)
+        results[name] = _rates(seconds, data)
+        results[name]['peak_mb'] = _peak_mb(func)
+    return results
+
+
+def bench_length_buckets(data, parameters, repeat=3):
+    """
+    Tagging speed per bucket of sentence length, and the speed of viterbi alone on the precomputed score matrices
+    """
+    results = {}
+    for low, high in LENGTH_BUCKETS:
+        bucket = [inputs for inputs in data if low <= len(inputs['tokens'])-2 and (high is None or len(inputs['tokens'])-2 <= high)]
+        if not bucket:
+            continue
+        name = '%d-%s' % (low, high or '')
+        matrices = [compute_score_matrices(Features(inputs, FEATURE_NAMES), len(inputs['tokens']), parameters, TAGSET) for inputs in bucket]
+        results[name] = {'sentences': len(bucket),
+            'batch': _rates(_best_time(lambda: predict_all(bucket, parameters, FEATURE_NAMES, TAGSET), repeat)[0], bucket),
+            'per_sentence': _rates(_best_time(lambda: [predict(inputs, len(inputs['tokens']), parameters, FEATURE_NAMES, TAGSET) for inputs in bucket], repeat)[0], bucket),
+            'viterbi': _rates(_best_time(lambda: [viterbi(*m, TAGSET) for m in matrices], repeat)[0], bucket)}
+    return results
+
+
+def bench_tagset_scaling(n_sentences=200, n_words=15, repeat=3, seed=0):
+    """
+    Decoding speed on random score matrices as the number of tags grows
+    """
+    random = np.random.RandomState(seed)
+    results = {}
+    for n_tags in TAGSET_SIZES:
+        tagset = ['T%d' % j for j in range(n_tags)]
+        emissions = random.randn(n_sentences, n_words, n_tags)
+        transitions = random.randn(n_sentences, n_words, n_tags, n_tags)
+        start_transitions = random.randn(n_sentences, n_tags)
+        lengths = [n_words]*n_sentences
+        viterbi_seconds, _ = _best_time(lambda: [viterbi(emissions[b], transitions[b], start_transitions[b], tagset) for b in range(n_sentences)], repeat)
+        batch_seconds, _ = _best_time(lambda: viterbi_batch(emissions, transitions, start_transitions, lengths, tagset), repeat)
+        results[str(n_tags)] = {'viterbi': {'seconds': viterbi_seconds, 'tokens_per_s': n_sentences*n_words/viterbi_seconds},
+                                'viterbi_batch': {'seconds': batch_seconds, 'tokens_per_s': n_sentences*n_words/batch_seconds}}
+    return results
+
+
+def bench_features(data, repeat=3):
+    """
+    Speed and peak memory of the string features over the gold tags, and of compiling the features, with the word
+    memos starting empty.  Also the hit rates of the memos.
+    """
+    def string_features():
+        for inputs in data:
+            features, tags = Features(inputs, FEATURE_NAMES), inputs['gold_tags']
+            for i in range(1, len(tags)):
+                features.compute_features(tags[i], tags[i-1], i)
+
+    def compiled_features():
+        return compile_data(data, FEATURE_NAMES, FeatureIndex(), TAGSET)
+
+    results = {}
+    for name, func in (('compute_features', string_features), ('compile', compiled_features)):
+        seconds = float('inf')
+        for _ in range(repeat):
+            word_attributes.cache_clear()
+            word_gazetteer_types.cache_clear()
+            seconds = min(seconds, _best_time(func, 1)[0])
+        results[name] = _rates(seconds, data)
+        results[name]['peak_mb'] = _peak_mb(func)
+    results['word_cache'] = word_cache_info()
+    return results
+
+
+def bench_evaluation(data, tag_seqs, repeat=3):
+    """
+    Speed of counting the chunks of tag_seqs against the gold tags of data
+    """
+    def chunk_counter():
+        counter = ChunkCounter()
+        for inputs, tag_seq in zip(data, tag_seqs):
+            counter.update(inputs['gold_tags'][1:-1], tag_seq[1:-1])
+        return counter.counts()
+
+    def reference():
+        true_seqs, pred_seqs = [], []
+        for inputs, tag_seq in zip(data, tag_seqs):
+            true_seqs.extend(inputs['gold_tags'][1:-1] + ['O'])
+            pred_seqs.extend(tag_seq[1:-1] + ['O'])
+        return count_chunks(true_seqs, pred_seqs)
+
+    return {name: _rates(_best_time(func, repeat)[0], data) for name, func in (('chunk_counter', chunk_counter), ('count_chunks', reference))}
+
+
+def bench_train(data, epochs=1, methods=TRAINING_METHODS):
+    """
+    Seconds per training epoch of each method and optimizer.  The setup before the first epoch (see
+    profiling.start_epoch) and the evaluation on ner.dev and ner.test after each epoch are left out.
+    """
+    results = {}
+    for method, optimizer, l2 in methods:
+        compiled = compile_data(data, FEATURE_NAMES, FeatureIndex(), TAGSET)   # a fresh index for every method
+        profiling.enable()
+        try:
+            train(data, FEATURE_NAMES, TAGSET, epochs, method, optimizer, l2=l2, compiled=compiled)
+            epoch_seconds = [epoch['seconds'] - epoch['timers'].get('evaluation', 0.0) for epoch in profiling.report()['epochs']]
+        finally:
+            profiling.enable(False)
+        seconds = float(np.mean(epoch_seconds))
+        results[method+'/'+optimizer] = {'seconds_per_epoch': seconds, 'sentences_per_s': len(data)/seconds}
+    return results
+
+
+def run(filename=None, quick=False, model_filename=None, train_size=1000, epochs=1, repeat=3):
+    """
+    Runs every benchmark
+    :param filename: String or None.  Writes the results to this JSON file
+    :param quick: Boolean.  Tag the first 500 sentences of ner.dev instead of all of it, train on 200 sentences and
+        time each benchmark once
+    :param model_filename: String or None.  The text model to tag with.  None trains one on the train_size sentences
+        first (see train_model) and writes it to outputs/benchmark.model
+    :param train_size: Int.  Number of sentences of ner.train to train on
+    :param epochs: Int.  Number of epochs per training method
+    :param repeat: Int.  Number of times each timing is repeated
+    :return: Dictionary of the results
+    """
+    os.makedirs('outputs', exist_ok=True)  # train writes the models and predictions of each epoch there
+    if quick:
+        train_size, repeat = 200, 1
+    dev_data = read_data('ner.dev')[:500 if quick else None]
+    train_data = read_data('ner.train')[:train_size]
+    results = {'meta': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+                        'cpus': os.cpu_count(), 'quick': quick, 'sentences': len(dev_data), 'train_size': train_size,
+                        'epochs': epochs, 'repeat': repeat, 'time': time.strftime('%Y-%m-%d %H:%M:%S')}}
+
+    if model_filename is None:
+        print('Training the model')
+        model_filename = 'outputs/benchmark.model'
+        train_model(train_data, model_filename)
+    results['meta']['model'] = model_filename
+    print('Loading the model')
+    results['load'] = bench_load(model_filename, repeat)
+    parameters = load_model(model_filename)
+    print('Tagging')
+    results['predict'] = bench_predict(dev_data, parameters, repeat)
+    print('Tagging by sentence length')
+    results['length_buckets'] = bench_length_buckets(dev_data, parameters, repeat)
+    print('Decoding with more tags')
+    results['tagset_scaling'] = bench_tagset_scaling(repeat=repeat)
+    print('Features')
+    results['features'] = bench_features(dev_data, repeat)
+    print('Evaluation')
+    results['evaluation'] = bench_evaluation(dev_data, predict_all(dev_data, parameters, FEATURE_NAMES, TAGSET), repeat)
+    print('Training')
+    results['train'] = bench_train(train_data, epochs)
+    results['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+    if filename is not None:
+        with open(filename, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+def _flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, prefix+key+'.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix+key] = value
+    return flat
+
+
+def compare(old_filename, new_filename, tolerance=0.1):
+    """
+    Prints the measurements of two runs side by side, marking those that got worse by more than tolerance
+    :param old_filename: String.  Results of run
+    :param new_filename: String.  Results of run
+    :param tolerance: Float.  Relative change that counts as a regression
+    :return: Array of the names of the measurements that got worse
+    """
+    with open(old_filename) as f:
+        old = _flatten(json.load(f))
+    with open(new_filename) as f:
+        new = _flatten(json.load(f))
+    regressions = []
+    for name in sorted(set(old) & set(new)):
+        if name.startswith('meta.') or not old[name]:
+            continue
+        if name.endswith('_per_s'):
+            change = new[name]/old[name] - 1        # higher is better
+        elif name.endswith(('seconds', 'seconds_per_epoch', '_mb', 'bytes')):
+            change = old[name]/new[name] - 1 if new[name] else 0.0   # lower is better
+        else:
+            continue
+        worse = change < -tolerance
+        if worse:
+            regressions.append(name)
+        print('%-60s %14.4f %14.4f %+7.1f%%%s' % (name, old[name], new[name], 100*change, '  WORSE' if worse else ''))
+    return regressions
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'compare':
+        regressions = compare(sys.argv[2], sys.argv[3], float(sys.argv[4]) if len(sys.argv) > 4 else 0.1)
+        sys.exit(1 if regressions else 0)
+    args = sys.argv[2:]
+    quick = 'quick' in args
+    models = [arg for arg in args if arg != 'quick']
+    run(sys.argv[1], quick=quick, model_filename=models[0] if models else None)
@@ -0,0 +1,229 @@
+"""
+Binary model format.  The text format written by FeatureVector.write_to_file has one 'key value' line per feature and
+has to be parsed in full before tagging.  A binary model file holds the same weights in the WeightMatrix layout: the
+non-zero weights are scattered into the matrix with one array operation, and the observation strings are looked up
+in a hash table read with mmap, so loading takes next to no time and no dictionary is built.  Each observation string
+is stored once rather than once per tag, so the file is smaller than the text model.
+
+Layout (all sections start at a multiple of 8 bytes, integers are little endian):
+    MAGIC
+    header: n_tags, n_obs, n_weights, n_slots, blob_size, meta_size (uint64 each)
+    rows: uint32[n_obs+1], the non-zero weights of row i of the WeightMatrix are entries rows[i]:rows[i+1] of tags
+        and values (compressed sparse rows)
+    tags: uint8 (uint16 for more than 256 tags) [n_weights], the tag (column) of each non-zero weight
+    values: float64 (or float32) [n_weights], the weights
+    offsets: uint32[n_obs+1], observation i is blob[offsets[i]:offsets[i+1]] (utf-8)
+    table: int32[n_slots], open addressing hash table (crc32 modulo n_slots, linear probing) from observation to row,
+        -1 if empty
+    blob: the observation strings
+    meta: JSON with the tagset, the weight and tag types, the bucket count of a hashed index, and the features that
+        do not fit the layout
+
+A hashed model (FeatureIndex with n_buckets) has no observation strings: n_slots is 0 and rows are buckets.
+
+Usage: python binary_model.py <model> <model.bin> [n_buckets]
+    converts a text model to binary, or a binary model to text if <model> is binary
+"""
+import sys
+import json
+import mmap
+import struct
+import zlib
+
+import numpy as np
+
+from features import FeatureVector, ScaledFeatureVector, FeatureIndex, WeightMatrix
+from helpers import TAGSET
+
+MAGIC = b'NERBIN02'
+HEADER = struct.Struct('<6Q')
+
+
+def _aligned(n):
+    return (n + 7) // 8 * 8
+
+
+def _sections(buffer):
+    """
+    :param buffer: mmap of a binary model file
+    :return: Tuple of (header values, meta, dictionary from section name to its start)
+    """
+    n_tags, n_obs, n_weights, n_slots, blob_size, meta_size = header = HEADER.unpack_from(buffer, len(MAGIC))
+    meta = json.loads(buffer[len(buffer)-meta_size:].decode('utf-8'))
+    starts = {'rows': len(MAGIC) + HEADER.size}
+    starts['tags'] = starts['rows'] + _aligned(4*(n_obs+1))
+    starts['values'] = starts['tags'] + _aligned(np.dtype(meta['tag_dtype']).itemsize*n_weights)
+    starts['offsets'] = starts['values'] + _aligned(np.dtype(meta['dtype']).itemsize*n_weights)
+    starts['table'] = starts['offsets'] + _aligned(4*(n_obs+1))
+    starts['blob'] = starts['table'] + _aligned(4*n_slots)
+    return header, meta, starts
+
+
+class MappedFeatureIndex(FeatureIndex):
+
+    def __init__(self, filename):
+        """
+        Read-only FeatureIndex over the observation table of a binary model file.  Observations are looked up in the
+        file's hash table, so no dictionary is built.  Unseen observations are never added.
+        :param filename: String
+        """
+        super(MappedFeatureIndex, self).__init__()
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (n_tags, self.n_obs, n_weights, n_slots, blob_size, meta_size), meta, starts = _sections(self.buffer)
+        view = memoryview(self.buffer)
+        self.offsets = view[starts['offsets']:starts['offsets']+4*(self.n_obs+1)].cast('I')
+        self.table = view[starts['table']:starts['table']+4*n_slots].cast('i')
+        self.blob_start = starts['blob']
+        self.n_slots = n_slots
+
+    def __len__(self):
+        return self.n_obs
+
+    def __getstate__(self):
+        return {'filename': self.filename}
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'])
+
+    def lookup(self, observation, add=True):
+        data = observation.encode('utf-8')
+        slot = zlib.crc32(data) % self.n_slots
+        while True:
+            fid = self.table[slot]
+            if fid < 0:
+                return -1
+            if self.buffer[self.blob_start+self.offsets[fid]:self.blob_start+self.offsets[fid+1]] == data:
+                return fid
+            slot = slot + 1 if slot + 1 < self.n_slots else 0
+
+    def observation(self, fid):
+        return self.buffer[self.blob_start+self.offsets[fid]:self.blob_start+self.offsets[fid+1]].decode('utf-8')
+
+
+def is_binary_model(filename):
+    """
+    :param filename: String
+    :return: Boolean.  Whether the file is a binary model
+    """
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_binary_model(parameters, filename, tagset=None, dtype='<f8'):
+    """
+    Writes the parameters as a binary model.  Only the non-zero weights are written, and only the observations with
+    one of them.
+    :param parameters: FeatureVector.  Its fdict is a WeightMatrix or a dictionary of feature strings
+    :param filename: String
+    :param tagset: Array of Strings.  The list of tags.  Only needed if parameters is not stored in a WeightMatrix
+    :param dtype: String.  '<f8' for float64 weights, '<f4' for float32 weights (smaller, but rounded)
+    :return: None
+    """
+    print('Writing to ' + filename)
+    weights = parameters.fdict
+    scale = parameters.scale if isinstance(parameters, ScaledFeatureVector) else 1.0
+    if not isinstance(weights, WeightMatrix):
+        weights = WeightMatrix(FeatureIndex(), tagset)
+        for key, value in parameters.fdict.items():
+            weights[key] = value
+    index, n_tags = weights.index, len(weights.tagset)
+    matrix = weights.weights[:len(index)]
+
+    if index.n_buckets:
+        rows = np.arange(len(index))
+        offsets, table, blob = np.zeros(len(index)+1, dtype=np.uint32), np.zeros(0, dtype=np.int32), b''
+    else:
+        rows = np.flatnonzero(matrix.any(axis=1))
+        encoded = [index.observation(int(fid)).encode('utf-8') for fid in rows]
+        offsets = np.zeros(len(rows)+1, dtype=np.uint64)
+        np.cumsum([len(data) for data in encoded], out=offsets[1:])
+        if offsets[-1] >= 2**32:
+            raise ValueError('the observation strings do not fit in a binary model')
+        n_slots = len(rows) + len(rows)//2 + 1   # at most two thirds full
+        table = np.full(n_slots, -1, dtype=np.int32)
+        for fid, data in enumerate(encoded):
+            slot = zlib.crc32(data) % n_slots
+            while table[slot] >= 0:
+                slot = slot + 1 if slot + 1 < n_slots else 0
+            table[slot] = fid
+        blob = b''.join(encoded)
+
+    values = scale*matrix[rows]
+    row_ids, tags = np.nonzero(values)
+    row_starts = np.zeros(len(rows)+1, dtype=np.uint64)
+    np.cumsum(np.bincount(row_ids, minlength=len(rows)), out=row_starts[1:])
+    if row_starts[-1] >= 2**32:
+        raise ValueError('the weights do not fit in a binary model')
+    tag_dtype = 'u1' if n_tags <= 256 else '<u2'
+    meta = json.dumps({'tagset': weights.tagset, 'dtype': dtype, 'tag_dtype': tag_dtype, 'n_buckets': index.n_buckets,
+                       'extra': {str(key): scale*value for key, value in weights.extra.items()}}).encode('utf-8')
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(HEADER.pack(n_tags, len(rows), len(tags), len(table), len(blob), len(meta)))
+        for section in (row_starts.astype('<u4'), tags.astype(tag_dtype), values[row_ids, tags].astype(dtype),
+                        offsets.astype('<u4'), table.astype('<i4'), blob):
+            data = section if isinstance(section, bytes) else section.tobytes()
+            f.write(data + b'\0'*(_aligned(len(data))-len(data)))
+        f.write(meta)
+
+
+def read_binary_model(filename):
+    """
+    Reads a binary model.  The weights are scattered into a dense matrix; the observation strings stay in the mapped
+    file and are shared with other processes mapping it.
+    :param filename: String
+    :return: FeatureVector over a WeightMatrix
+    """
+    with open(filename, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError(filename + ' is not a binary model (or one written by an older version)')
+    (n_tags, n_obs, n_weights, n_slots, blob_size, meta_size), meta, starts = _sections(buffer)
+
+    index = FeatureIndex(meta['n_buckets']) if meta['n_buckets'] else MappedFeatureIndex(filename)
+    weights = WeightMatrix(FeatureIndex(), meta['tagset'])
+    weights.index = index
+    weights.weights = np.zeros((max(n_obs, 1), n_tags))
+    row_starts = np.frombuffer(buffer, dtype='<u4', count=n_obs+1, offset=starts['rows']).astype(np.intp)
+    row_ids = np.repeat(np.arange(n_obs), np.diff(row_starts))
+    tags = np.frombuffer(buffer, dtype=meta['tag_dtype'], count=n_weights, offset=starts['tags'])
+    weights.weights[row_ids, tags] = np.frombuffer(buffer, dtype=meta['dtype'], count=n_weights, offset=starts['values'])
+    weights.extra = meta['extra']
+    return FeatureVector(weights)
+
+
+def read_model(filename, tagset=None, n_buckets=None):
+    """
+    Reads a text or a binary model, whichever the file is
+    :param filename: String
+    :param tagset: Array of Strings.  The list of tags of a text model, TAGSET if None.  A binary model has its own.
+    :param n_buckets: Int or None.  The bucket count of a text model trained with hashed features
+    :return: FeatureVector over a WeightMatrix
+    """
+    if is_binary_model(filename):
+        return read_binary_model(filename)
+    parameters = FeatureVector(WeightMatrix(FeatureIndex(n_buckets), tagset or TAGSET))
+    parameters.read_from_file(filename)
+    return parameters
+
+
+def convert_model(in_filename, out_filename, tagset=None, n_buckets=None):
+    """
+    Converts a text model to a binary model, or a binary model to a text model
+    :param in_filename: String
+    :param out_filename: String
+    :param tagset: Array of Strings.  The list of tags, for text models
+    :param n_buckets: Int or None.  The bucket count of a text model trained with hashed features
+    :return: None
+    """
+    parameters = read_model(in_filename, tagset, n_buckets)
+    if is_binary_model(in_filename):
+        parameters.write_to_file(out_filename)
+    else:
+        write_binary_model(parameters, out_filename)
+
+
+if __name__ == '__main__':
+    convert_model(sys.argv[1], sys.argv[2], n_buckets=int(sys.argv[3]) if len(sys.argv) > 3 else None)
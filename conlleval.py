@@ -30,6 +30,8 @@ from __future__ import division, print_function, unicode_literals
 import sys
 from collections import defaultdict
 
+import numpy as np
+
 def split_tag(chunk_tag):
     """
     split chunk tag into IOBES prefix and chunk_type
@@ -204,12 +206,182 @@ def get_result(correct_chunks, true_chunks, pred_chunks,
     # http://cnts.uia.ac.be/conll2003/ner/example.tex
     # but I'm not implementing this
 
+# integer codes of the tags seen so far, shared by all ChunkCounters
+_tag_codes = {}
+_code_tags, _code_prefixes, _code_types = [], [], []
+_type_codes, _type_names = {}, []
+_PREFIX_CODES = {'O': 0, 'B': 1, 'I': 2, 'E': 3, 'S': 4}   # any other prefix behaves like I
+
+def _encode(tags):
+    """
+    map tags to integer codes, splitting each new tag once
+    """
+    codes = []
+    for tag in tags:
+        code = _tag_codes.get(tag)
+        if code is None:
+            prefix, chunk_type = split_tag(tag)
+            if chunk_type is not None and chunk_type not in _type_codes:
+                _type_codes[chunk_type] = len(_type_names)
+                _type_names.append(chunk_type)
+            code = _tag_codes[tag] = len(_code_tags)
+            _code_tags.append(tag)
+            _code_prefixes.append(_PREFIX_CODES.get(prefix, 5))
+            _code_types.append(-1 if chunk_type is None else _type_codes[chunk_type])
+        codes.append(code)
+    return np.array(codes, dtype=np.intp)
+
+def _chunk_spans(codes, prefixes, types):
+    """
+    chunks of a tag sequence (given as codes) as arrays of start, end (exclusive) and type,
+    with the boundaries of is_chunk_start and is_chunk_end
+    """
+    prefix, chunk_type = prefixes[codes], types[codes]
+    prev_prefix = np.concatenate([[0], prefix[:-1]])
+    prev_type = np.concatenate([[-1], chunk_type[:-1]])
+    boundary = (chunk_type != prev_type) | (prefix == 1) | (prefix == 4) | (prev_prefix == 3) | (prev_prefix == 4)
+    start = (prefix != 0) & ((prev_prefix == 0) | boundary)
+    end = (prev_prefix != 0) & ((prefix == 0) | boundary)   # a chunk ended between the previous and current word
+    starts = np.flatnonzero(start)
+    ends = np.append(np.flatnonzero(end), len(codes))
+    return starts, ends[np.searchsorted(ends, starts, side='right')], chunk_type[starts]
+
+class ChunkCounter(object):
+    """
+    Counts the chunks and tags of count_chunks incrementally, e.g. one sentence at a time while decoding, with tags
+    mapped to integer codes once and chunks found with array operations.  A chunk is correct if the true and the
+    predicted chunk have the same start, end and type.
+
+    The sequence is counted in segments that end where both the true and the predicted tag are O: no chunk spans
+    such a position, so the counts are the same as those of count_chunks on the whole sequence.  Tags are buffered
+    until at least flush_size of them are waiting, so that short updates (one sentence) stay cheap.
+
+    Counters of consecutive shards of the data (e.g. one per worker) are created with shard=True and combined with
+    merge, in order.
+    """
+
+    def __init__(self, shard=False, flush_size=4096):
+        """
+        :param shard: Boolean.  The counter does not start at the beginning of the data, so the tags up to its
+            first O/O position are kept until it is merged into the counter of the preceding shard.
+        :param flush_size: Int.  Number of buffered tags that triggers counting
+        """
+        self.flush_size = flush_size
+        self.correct_chunks = defaultdict(int)
+        self.true_chunks = defaultdict(int)
+        self.pred_chunks = defaultdict(int)
+        self.correct_counts = defaultdict(int)
+        self.true_counts = defaultdict(int)
+        self.pred_counts = defaultdict(int)
+        self.head = ([], []) if shard else None   # tags up to the first O/O position of a shard
+        self.head_done = not shard                # whether head ends at an O/O position
+        self.tail = ([], [])                      # tags after the last O/O position
+        self.scanned = 0                          # length of the start of tail known to have no O/O position
+
+    def update(self, true_seqs, pred_seqs):
+        """
+        counts the next tags
+        :param true_seqs: list of true tags
+        :param pred_seqs: list of predicted tags, as many as true_seqs
+        """
+        true_seqs, pred_seqs = list(true_seqs), list(pred_seqs)
+        if not self.head_done:
+            both_o = [t for t, (a, b) in enumerate(zip(true_seqs, pred_seqs)) if a == 'O' and b == 'O']
+            split = both_o[0]+1 if both_o else len(true_seqs)
+            self.head[0].extend(true_seqs[:split])
+            self.head[1].extend(pred_seqs[:split])
+            self.head_done = bool(both_o)
+            true_seqs, pred_seqs = true_seqs[split:], pred_seqs[split:]
+        self.tail[0].extend(true_seqs)
+        self.tail[1].extend(pred_seqs)
+        if len(self.tail[0]) >= self.flush_size:
+            self._flush()
+
+    def _flush(self):
+        # counts the tail up to its last O/O position
+        true_tail, pred_tail = self.tail
+        for t in range(len(true_tail)-1, self.scanned-1, -1):
+            if true_tail[t] == 'O' and pred_tail[t] == 'O':
+                self._count(true_tail[:t+1], pred_tail[:t+1])
+                self.tail = (true_tail[t+1:], pred_tail[t+1:])
+                self.scanned = 0
+                return
+        self.scanned = len(true_tail)   # e.g. a model that never predicts O: only scan the new tags next time
+
+    def _count(self, true_seqs, pred_seqs):
+        if not true_seqs:
+            return
+        true_codes, pred_codes = _encode(true_seqs), _encode(pred_seqs)
+        prefixes, types = np.array(_code_prefixes), np.array(_code_types)
+        n_codes, n_types, n = len(_code_tags), max(len(_type_names), 1), len(true_codes)
+
+        for counts, codes in ((self.true_counts, true_codes), (self.pred_counts, pred_codes),
+                              (self.correct_counts, true_codes[true_codes == pred_codes])):
+            for code, count in enumerate(np.bincount(codes, minlength=n_codes)):
+                if count:
+                    counts[_code_tags[code]] += int(count)
+
+        true_starts, true_ends, true_types = _chunk_spans(true_codes, prefixes, types)
+        pred_starts, pred_ends, pred_types = _chunk_spans(pred_codes, prefixes, types)
+        correct = np.intersect1d((true_starts*(n+1) + true_ends)*n_types + true_types,
+                                 (pred_starts*(n+1) + pred_ends)*n_types + pred_types, assume_unique=True) % n_types
+        for chunks, chunk_types in ((self.true_chunks, true_types), (self.pred_chunks, pred_types), (self.correct_chunks, correct)):
+            for chunk_type, count in enumerate(np.bincount(chunk_types, minlength=n_types)):
+                if count:
+                    chunks[_type_names[chunk_type]] += int(count)
+
+    def merge(self, other):
+        """
+        adds the counts of the shard that follows this counter's tags
+        :param other: ChunkCounter created with shard=True
+        :return: self
+        """
+        if other.head is None:
+            raise ValueError('only a shard can be merged into the counter of the preceding tags')
+        for mine, theirs in zip(self._counts(), other._counts()):
+            for key, value in theirs.items():
+                mine[key] += value
+        if not self.head_done:
+            # all of this counter's tags are still in head; they and other.head are counted once head is merged
+            self.head[0].extend(other.head[0])
+            self.head[1].extend(other.head[1])
+            self.head_done = other.head_done
+        else:
+            self.tail[0].extend(other.head[0])
+            self.tail[1].extend(other.head[1])
+            self._flush()
+        if other.head_done:
+            self.tail = (self.tail[0] + other.tail[0], self.tail[1] + other.tail[1])
+            self._flush()
+        return self
+
+    def _counts(self):
+        return (self.correct_chunks, self.true_chunks, self.pred_chunks,
+            self.correct_counts, self.true_counts, self.pred_counts)
+
+    def counts(self):
+        """
+        return: the counts of count_chunks for all the tags so far, as if they were the whole data (the head of a
+        shard is taken to start the data)
+        """
+        counter = ChunkCounter()
+        for mine, theirs in zip(counter._counts(), self._counts()):
+            mine.update(theirs)
+        if self.head is not None:
+            counter._count(*self.head)   # ends at an O/O position, or else the tail is empty
+        counter._count(*self.tail)
+        return counter._counts()
+
+    def result(self, verbose=True):
+        """
+        get_result of the tags so far
+        """
+        return get_result(*self.counts(), verbose=verbose)
+
 def evaluate(true_seqs, pred_seqs, verbose=True):
-    (correct_chunks, true_chunks, pred_chunks,
-        correct_counts, true_counts, pred_counts) = count_chunks(true_seqs, pred_seqs)
-    result = get_result(correct_chunks, true_chunks, pred_chunks,
-        correct_counts, true_counts, pred_counts, verbose=verbose)
-    return result
+    counter = ChunkCounter()
+    counter.update(true_seqs, pred_seqs)
+    return counter.result(verbose=verbose)
 
 def evaluate_conll_file(fileIterator):
     true_seqs, pred_seqs = [], []
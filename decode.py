@@ -1,11 +1,46 @@
+import numpy as np
 
-def decode(input_length, tagset, score):
+def allowed_transitions(tagset, scheme='iob1'):
+    """
+    The tag transitions that a tagging scheme allows.  The CoNLL 2003 data is in IOB1.
+        'iob1': I-X starts or continues an X chunk.  B-X only starts an X chunk right after another X chunk, so it
+            must follow B-X or I-X.
+        'iob2': every chunk starts with B-X, so I-X must follow B-X or I-X.
+    O can follow and be followed by anything.
+    :param tagset: Array of strings, which are the possible tags.  Does not have <START>, <STOP>
+    :param scheme: String.  'iob1' or 'iob2'
+    :return: Tuple of (allowed, allowed_start).  allowed is a numpy boolean array of shape (n_tags, n_tags),
+        allowed[k, j] tells whether tagset[k] can be followed by tagset[j].  allowed_start is of shape (n_tags,) and
+        tells whether tagset[j] can follow <START>.
+    """
+    if scheme == 'iob1':
+        constrained = 'B-'
+    elif scheme == 'iob2':
+        constrained = 'I-'
+    else:
+        raise ValueError('Unknown tagging scheme: '+str(scheme))
+
+    n_tags = len(tagset)
+    allowed = np.ones((n_tags, n_tags), dtype=bool)
+    allowed_start = np.ones(n_tags, dtype=bool)
+    for j, cur_tag in enumerate(tagset):
+        if not cur_tag.startswith(constrained):
+            continue
+        allowed_start[j] = False
+        for k, prev_tag in enumerate(tagset):
+            allowed[k, j] = prev_tag != 'O' and prev_tag[2:] == cur_tag[2:]
+    return allowed, allowed_start
+
+
+def decode(input_length, tagset, score, constraints=None):
     """
     Compute the highest scoring sequence according to the scoring function.
     :param input_length: int. number of tokens in the input including <START> and <STOP>
     :param tagset: Array of strings, which are the possible tags.  Does not have <START>, <STOP>
     :param score: function from current_tag (string), previous_tag (string), i (int) to the score.  i=0 points to
         <START> and i=1 points to the first token. i=input_length-1 points to <STOP>
+    :param constraints: Tuple of (allowed, allowed_start) as returned by allowed_transitions, or None.  score is not
+        called for transitions that are not allowed, and they are never part of the result.
     :return: Array strings of length input_length, which is the highest scoring tag sequence including <START> and <STOP>
     """
     # Look at the function compute_score for an example of how the tag sequence should be scored
@@ -14,9 +49,12 @@ def decode(input_length, tagset, score):
     best_path_scores = [[float('-inf')]*n_words for i in range(n_tags)]
     best_path_pointers = [[None]*n_words for i in range(n_tags)]
 
+    allowed, allowed_start = constraints if constraints is not None else (None, None)
+
     #initialization
     for i in range(n_tags):
-        best_path_scores[i][0] = score(tagset[i], "<START>", 1) # best score for start word given each tag
+        if allowed_start is None or allowed_start[i]:
+            best_path_scores[i][0] = score(tagset[i], "<START>", 1) # best score for start word given each tag
     # print ([best_path_scores[i][0] for i in range(n_tags)])
     # print (best_path_scores)
 
@@ -30,6 +68,8 @@ def decode(input_length, tagset, score):
 
             for k in range(n_tags):
 
+                if allowed is not None and not allowed[k][j]:
+                    continue
                 prev_tag = tagset[k] #cur tag
                 cur_score = best_path_scores[k][i-1] + score(cur_tag, prev_tag, i+1) 
                 if cur_score > best_score:
@@ -55,3 +95,242 @@ def decode(input_length, tagset, score):
     # print ('bp', best_path)
 
     return best_path
+
+
+def viterbi(emissions, transitions, start_transitions, tagset, constraints=None):
+    """
+    Vectorized Viterbi over precomputed score matrices.  Gives the same result as decode when
+    score(tagset[j], tagset[k], i+1) == emissions[i][j] + transitions[i][k][j] and
+    score(tagset[j], '<START>', 1) == emissions[0][j] + start_transitions[j].
+    :param emissions: numpy array of shape (n_words, n_tags).  emissions[i, j] is the score of tagset[j] at token i+1
+    :param transitions: numpy array of shape (n_tags, n_tags), or (n_words, n_tags, n_tags) for position dependent
+        scores.  transitions[k, j] is the score of tagset[k] followed by tagset[j].  Position 0 of a 3-d array is unused.
+    :param start_transitions: numpy array of shape (n_tags,).  The score of tagset[j] following <START>
+    :param tagset: Array of strings, which are the possible tags.  Does not have <START>, <STOP>
+    :param constraints: Tuple of (allowed, allowed_start) as returned by allowed_transitions, or None.  Transitions
+        that are not allowed are never part of the result.
+    :return: Array strings of length n_words+2, which is the highest scoring tag sequence including <START> and <STOP>
+    """
+    emissions = np.asarray(emissions, dtype=np.float64)
+    transitions = np.asarray(transitions, dtype=np.float64)
+    n_words = emissions.shape[0]
+    if n_words == 0:
+        return ['<START>', '<STOP>']
+    if constraints is not None:
+        allowed, allowed_start = constraints
+        transitions = np.where(allowed, transitions, float('-inf'))
+        start_transitions = np.where(allowed_start, start_transitions, float('-inf'))
+
+    best_path_pointers = np.zeros((n_words, len(tagset)), dtype=np.intp)
+    best_path_scores = emissions[0] + start_transitions
+
+    for i in range(1, n_words):
+        trans = transitions[i] if transitions.ndim == 3 else transitions
+        # cur_scores[k, j]: best path ending in tag k at i-1, followed by tag j at i
+        cur_scores = best_path_scores[:, None] + (trans + emissions[i])
+        best_path_pointers[i] = cur_scores.argmax(axis=0)
+        best_path_scores = cur_scores.max(axis=0)
+
+    #backtrack towards the best path
+    best_path = [0]*n_words
+    best_path[n_words-1] = int(best_path_scores.argmax())
+    for i in reversed(range(1, n_words)):
+        best_path[i-1] = int(best_path_pointers[i, best_path[i]])
+
+    return ['<START>']+[tagset[i] for i in best_path]+['<STOP>']
+
+
+def score_matrices(input_length, tagset, score, constraints=None):
+    """
+    Fills the score matrices used by viterbi from a score function, so any scorer written for decode can run on the
+    vectorized engine.  Calls score the same number of times as decode does.
+    :param input_length: int. number of tokens in the input including <START> and <STOP>
+    :param tagset: Array of strings, which are the possible tags.  Does not have <START>, <STOP>
+    :param score: function from current_tag (string), previous_tag (string), i (int) to the score
+    :param constraints: Tuple of (allowed, allowed_start) as returned by allowed_transitions, or None.  Transitions
+        that are not allowed are not scored and get -inf.
+    :return: Tuple of (emissions, transitions, start_transitions) as taken by viterbi
+    """
+    n_tags, n_words = len(tagset), max(input_length-2, 0)
+    allowed, allowed_start = constraints if constraints is not None else (np.ones((n_tags, n_tags), dtype=bool), np.ones(n_tags, dtype=bool))
+    emissions = np.zeros((n_words, n_tags))
+    transitions = np.full((n_words, n_tags, n_tags), float('-inf'))
+    start_transitions = np.array([score(tag, '<START>', 1) if allowed_start[j] else float('-inf') for j, tag in enumerate(tagset)], dtype=np.float64)
+
+    for i in range(1, n_words):
+        for j in range(n_tags):
+            for k in range(n_tags):
+                if allowed[k, j]:
+                    transitions[i, k, j] = score(tagset[j], tagset[k], i+1)
+
+    return emissions, transitions, start_transitions
+
+
+def viterbi_decode(input_length, tagset, score, constraints=None):
+    """
+    Drop-in replacement for decode that runs the search on the vectorized engine.
+    :param input_length: int. number of tokens in the input including <START> and <STOP>
+    :param tagset: Array of strings, which are the possible tags.  Does not have <START>, <STOP>
+    :param score: function from current_tag (string), previous_tag (string), i (int) to the score
+    :param constraints: Tuple of (allowed, allowed_start) as returned by allowed_transitions, or None
+    :return: Array strings of length input_length, which is the highest scoring tag sequence including <START> and <STOP>
+    """
+    return viterbi(*score_matrices(input_length, tagset, score, constraints), tagset, constraints)
+
+
+def beam_viterbi(emissions, transitions, start_transitions, tagset, beam_width=4, threshold=None, constraints=None):
+    """
+    Approximate viterbi that keeps only the beam_width best tags at each position, and only considers the tags whose
+    emission score is at least the best emission score of the position minus threshold.  Takes
+    O(n_words * beam_width * n_candidates) instead of O(n_words * n_tags^2).  With beam_width >= n_tags and no
+    threshold it gives the same result as viterbi.
+    :param emissions: numpy array of shape (n_words, n_tags), as for viterbi
+    :param transitions: numpy array of shape (n_tags, n_tags) or (n_words, n_tags, n_tags), as for viterbi
+    :param start_transitions: numpy array of shape (n_tags,), as for viterbi
+    :param tagset: Array of strings, which are the possible tags.  Does not have <START>, <STOP>
+    :param beam_width: Int.  Number of tags kept at each position
+    :param threshold: Float or None.  Emission score margin of the candidate tags.  None considers all tags.  If none
+        of the candidates can follow the beam (see constraints), all tags are considered at that position.
+    :param constraints: Tuple of (allowed, allowed_start) as returned by allowed_transitions, or None
+    :return: Array strings of length n_words+2, the best tag sequence found including <START> and <STOP>
+    """
+    emissions = np.asarray(emissions, dtype=np.float64)
+    transitions = np.asarray(transitions, dtype=np.float64)
+    start_transitions = np.asarray(start_transitions, dtype=np.float64)
+    n_words, n_tags = emissions.shape[0], len(tagset)
+    if n_words == 0:
+        return ['<START>', '<STOP>']
+    if constraints is not None:
+        allowed, allowed_start = constraints
+        transitions = np.where(allowed, transitions, float('-inf'))
+        start_transitions = np.where(allowed_start, start_transitions, float('-inf'))
+    all_tags = np.arange(n_tags)
+
+    def candidates(i):
+        if threshold is None:
+            return all_tags
+        return np.flatnonzero(emissions[i] >= emissions[i].max() - threshold)
+
+    def top(scores):
+        # the beam_width best, in tag order so that ties are broken as in viterbi
+        keep = all_tags[:len(scores)] if len(scores) <= beam_width else np.sort(np.argpartition(-scores, beam_width-1)[:beam_width])
+        finite = np.isfinite(scores[keep])
+        return keep[finite] if finite.any() else keep
+
+    cand = candidates(0)
+    scores = emissions[0, cand] + start_transitions[cand]
+    if not np.isfinite(scores).any():
+        cand = all_tags
+        scores = emissions[0] + start_transitions
+    keep = top(scores)
+    beam_tags, beam_scores, best_path_pointers = [cand[keep]], scores[keep], [None]
+
+    for i in range(1, n_words):
+        trans = transitions[i] if transitions.ndim == 3 else transitions
+        cand = candidates(i)
+        # cur_scores[b, c]: beam entry b at i-1 followed by candidate c at i
+        cur_scores = beam_scores[:, None] + trans[np.ix_(beam_tags[-1], cand)] + emissions[i, cand]
+        if not np.isfinite(cur_scores).any():
+            cand = all_tags
+            cur_scores = beam_scores[:, None] + trans[beam_tags[-1]] + emissions[i]
+        pointers, scores = cur_scores.argmax(axis=0), cur_scores.max(axis=0)
+        keep = top(scores)
+        beam_tags.append(cand[keep])
+        best_path_pointers.append(pointers[keep])
+        beam_scores = scores[keep]
+
+    #backtrack towards the best path
+    best_path = [0]*n_words
+    b = int(beam_scores.argmax())
+    for i in reversed(range(n_words)):
+        best_path[i] = int(beam_tags[i][b])
+        if i:
+            b = int(best_path_pointers[i][b])
+
+    return ['<START>']+[tagset[i] for i in best_path]+['<STOP>']
+
+
+class BeamDecoder(object):
+    def __init__(self, beam_width=4, threshold=None, check_every=0):
+        """
+        beam_viterbi with fixed settings, usable wherever viterbi is, that counts how often its result differs from
+        exact viterbi
+        :param beam_width: Int.  See beam_viterbi
+        :param threshold: Float or None.  See beam_viterbi
+        :param check_every: Int.  Also decode every check_every-th sentence exactly and compare.  0 never compares.
+        """
+        self.beam_width = beam_width
+        self.threshold = threshold
+        self.check_every = check_every
+        self.n_decoded = 0
+        self.n_checked = 0
+        self.n_differ = 0
+
+    def __call__(self, emissions, transitions, start_transitions, tagset, constraints=None):
+        tags = beam_viterbi(emissions, transitions, start_transitions, tagset, self.beam_width, self.threshold, constraints)
+        self.n_decoded += 1
+        if self.check_every and self.n_decoded % self.check_every == 0:
+            self.n_checked += 1
+            self.n_differ += tags != viterbi(emissions, transitions, start_transitions, tagset, constraints)
+        return tags
+
+    def stats(self):
+        """
+        :return: Dictionary with the number of sentences decoded and compared, and the fraction of the compared ones
+            where the beam result differs from viterbi.  Counted in this process only.
+        """
+        return {'decoded': self.n_decoded, 'checked': self.n_checked,
+                'differ_rate': self.n_differ / self.n_checked if self.n_checked else 0.0}
+
+
+def viterbi_batch(emissions, transitions, start_transitions, lengths, tagset, constraints=None):
+    """
+    viterbi over a batch of sentences at once.  The sentences are padded to the longest one; the positions past the
+    end of a sentence carry its scores over unchanged, so every sentence gets the same result as from viterbi.
+    Sentences of similar lengths should be batched together to keep the padding small.
+    :param emissions: numpy array of shape (batch, max_words, n_tags).  emissions[b] is the emissions of sentence b,
+        as for viterbi, padded with anything
+    :param transitions: numpy array of shape (n_tags, n_tags), (batch, n_tags, n_tags) or
+        (batch, max_words, n_tags, n_tags), as for viterbi
+    :param start_transitions: numpy array of shape (n_tags,) or (batch, n_tags)
+    :param lengths: Array of Ints.  The number of words of each sentence
+    :param tagset: Array of strings, which are the possible tags.  Does not have <START>, <STOP>
+    :param constraints: Tuple of (allowed, allowed_start) as returned by allowed_transitions, or None
+    :return: Array of tag sequences including <START> and <STOP>, one for each sentence
+    """
+    emissions = np.asarray(emissions, dtype=np.float64)
+    transitions = np.asarray(transitions, dtype=np.float64)
+    start_transitions = np.asarray(start_transitions, dtype=np.float64)
+    lengths = np.asarray(lengths, dtype=np.intp)
+    n_batch, max_words, n_tags = emissions.shape
+    if constraints is not None:
+        allowed, allowed_start = constraints
+        transitions = np.where(allowed, transitions, float('-inf'))
+        start_transitions = np.where(allowed_start, start_transitions, float('-inf'))
+    if transitions.ndim == 2:
+        transitions = transitions[None, None]
+    elif transitions.ndim == 3:
+        transitions = transitions[:, None]
+    if max_words == 0:
+        return [['<START>', '<STOP>'] for _ in range(n_batch)]
+
+    best_path_pointers = np.empty((n_batch, max_words, n_tags), dtype=np.intp)
+    best_path_pointers[:] = np.arange(n_tags)     # padding points back to the same tag
+    best_path_scores = emissions[:, 0] + start_transitions
+
+    for i in range(1, max_words):
+        active = i < lengths
+        trans = transitions[:, i] if transitions.shape[1] > 1 else transitions[:, 0]
+        # cur_scores[b, k, j]: best path of sentence b ending in tag k at i-1, followed by tag j at i
+        cur_scores = best_path_scores[:, :, None] + (trans + emissions[:, i, None, :])
+        best_path_pointers[active, i] = cur_scores[active].argmax(axis=1)
+        best_path_scores[active] = cur_scores[active].max(axis=1)
+
+    #backtrack towards the best paths, all sentences at once
+    best_path = np.empty((n_batch, max_words), dtype=np.intp)
+    best_path[:, max_words-1] = best_path_scores.argmax(axis=1)
+    rows = np.arange(n_batch)
+    for i in reversed(range(1, max_words)):
+        best_path[:, i-1] = best_path_pointers[rows, i, best_path[:, i]]
+
+    return [['<START>']+[tagset[j] for j in best_path[b, :lengths[b]]]+['<STOP>'] for b in range(n_batch)]
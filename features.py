@@ -1,19 +1,219 @@
 
-from collections import defaultdict
+from collections import defaultdict, deque, namedtuple
+import os
+import functools
+import copy
 import math
+import pickle
+import zlib
 
-def load_gazetteer_dict():
-    with open('./gazetteer.txt') as f:
-        lines = f.readlines()
-        lines = [i[:-1] for i in lines]
+import numpy as np
+
+_gazetteer = {'path': os.environ.get('NER_GAZETTEER') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gazetteer.txt')}
+# path of the gazetteer file, and once loaded (see load_gazetteer) its dictionary and GazetteerIndex
+
+def set_gazetteer_path(path):
+    """
+    Uses another gazetteer file from now on.  The default is gazetteer.txt next to this file, or the NER_GAZETTEER
+    environment variable if set.  Worker processes started afterwards with fork inherit the setting.
+    :param path: String
+    :return: None
+    """
+    _gazetteer.clear()
+    _gazetteer['path'] = path
+    word_gazetteer_types.cache_clear()
+
+def gazetteer_path():
+    """
+    :return: String.  The gazetteer file in use, see set_gazetteer_path
+    """
+    return _gazetteer['path']
+
+def load_gazetteer_dict(filename=None):
+    """
+    Parses a gazetteer file with one 'TYPE word word ...' entry per line
+    :param filename: String or None.  The configured gazetteer path if None
+    :return: Dictionary from type to the set of its entries (the words joined by single spaces)
+    """
+    with open(filename or _gazetteer['path']) as f:
         g_dict = defaultdict(set)
-        for line in lines:
-            tag, word = line.split()[0], (' ').join(line.split()[1:])
-            g_dict[tag].add(word) #stores a set of words for each tag
-    
+        for line in f:
+            words = line.split()
+            if words:
+                g_dict[words[0]].add(' '.join(words[1:])) #stores a set of words for each tag
+
     # print ('gazetteer dict sample: ',g_dict.keys())
     return g_dict
-g_dict = load_gazetteer_dict()
+
+def load_gazetteer():
+    """
+    Loads the gazetteer the first time it is needed.  The parsed dictionary and its GazetteerIndex are pickled to the
+    gazetteer path + '.pkl' and read from there while the gazetteer file keeps its modification time and size.
+    :return: Dictionary with keys 'g_dict' and 'index'
+    """
+    if 'index' in _gazetteer:
+        return _gazetteer
+    path = _gazetteer['path']
+    cache_filename = path + '.pkl'
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    try:
+        with open(cache_filename, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['stamp'] != stamp:
+            cached = None
+    except Exception:   # missing, truncated or stale cache, or one written by another version: parse again
+        cached = None
+
+    if cached is None:
+        g_dict = load_gazetteer_dict(path)
+        cached = {'stamp': stamp, 'g_dict': g_dict, 'index': GazetteerIndex(g_dict)}
+        try:    # written to a temporary file first, so that concurrent readers never see half of it
+            with open(cache_filename + '.' + str(os.getpid()), 'wb') as f:
+                pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_filename + '.' + str(os.getpid()), cache_filename)
+        except OSError:
+            pass    # read-only directory: parse again next time
+
+    _gazetteer['g_dict'] = cached['g_dict']
+    _gazetteer['index'] = cached['index']
+    return _gazetteer
+
+def gazetteer_dict():
+    """
+    :return: Dictionary from type to the set of its entries, see load_gazetteer_dict
+    """
+    return load_gazetteer()['g_dict']
+
+def __getattr__(name):
+    if name == 'g_dict':    # the gazetteer used to be loaded at import as features.g_dict
+        return gazetteer_dict()
+    raise AttributeError("module 'features' has no attribute '" + name + "'")
+
+
+class GazetteerIndex(object):
+    def __init__(self, g_dict):
+        """
+        Aho-Corasick automaton over tokens for the gazetteer entries, so that all the (possibly multi-word) entries
+        occurring in a sentence are found in one pass over it
+        :param g_dict: Dictionary from entity type to a set of entries, as returned by load_gazetteer_dict.  The words
+            of an entry are separated by single spaces.
+        """
+        self.goto = [{}]    # node -> {token: child node}.  Node 0 is the root
+        self.fail = [0]     # node -> longest proper suffix of the node's token sequence that is also in the trie
+        self.out = [[]]     # node -> (type, length) of the entries ending at the node, including through fail
+        for gtype in sorted(g_dict):
+            for entry in g_dict[gtype]:
+                tokens = entry.split(' ')
+                node = 0
+                for token in tokens:
+                    if token not in self.goto[node]:
+                        self.goto[node][token] = len(self.goto)
+                        self.goto.append({})
+                        self.fail.append(0)
+                        self.out.append([])
+                    node = self.goto[node][token]
+                self.out[node].append((gtype, len(tokens)))
+
+        queue = deque(self.goto[0].values())   # children of the root fail to the root
+        while queue:
+            node = queue.popleft()
+            for token, child in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and token not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(token, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+                queue.append(child)
+
+    def find_spans(self, tokens):
+        """
+        Finds every occurrence of a gazetteer entry, overlapping ones included
+        :param tokens: Array of Strings
+        :return: Array of tuples (start, end, type), end exclusive
+        """
+        spans = []
+        node = 0
+        for j, token in enumerate(tokens):
+            while node and token not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(token, 0)
+            for gtype, length in self.out[node]:
+                spans.append((j-length+1, j+1, gtype))
+        return spans
+
+def gazetteer_index():
+    """
+    :return: GazetteerIndex of the gazetteer, see load_gazetteer
+    """
+    return load_gazetteer()['index']
+
+
+# The features of a word type are the same wherever it occurs, and the vocabulary is much smaller than the number of
+# tokens, so they are memoized for the whole process (all sentences and epochs).  Bounded, so a long stream of new
+# words cannot grow them without limit.
+WORD_CACHE_SIZE = 1 << 16
+
+WordAttributes = namedtuple('WordAttributes', ['lower', 'shape', 'prefixes', 'capitalized'])
+
+@functools.lru_cache(maxsize=WORD_CACHE_SIZE)
+def word_attributes(word):
+    """
+    :param word: String
+    :return: WordAttributes.  The lowercased word, its shape (letters replaced with a or A depending on
+        capitalization, digits with d), its prefixes of length 1 to 4 and whether it starts with a capital letter
+    """
+    shape = ('').join(['A' if c.isupper() else 'a' if c.islower() else 'd' if c in '0123456789' else c for c in word])
+    return WordAttributes(word.lower(), shape, tuple(word[:k+1] for k in range(min(4, len(word)))), word[:1].isupper())
+
+@functools.lru_cache(maxsize=WORD_CACHE_SIZE)
+def word_gazetteer_types(word):
+    """
+    :param word: String
+    :return: frozenset of the types of the single word gazetteer entries equal to word
+    """
+    index = gazetteer_index()
+    return frozenset(gtype for gtype, length in index.out[index.goto[0].get(word, 0)] if length == 1)
+
+def word_cache_info():
+    """
+    :return: Dictionary with the hits, misses, size and hit rate of the memos of word_attributes and
+        word_gazetteer_types
+    """
+    info = {}
+    for name, memo in (('attributes', word_attributes), ('gazetteer', word_gazetteer_types)):
+        hits, misses, maxsize, size = memo.cache_info()
+        info[name] = {'hits': hits, 'misses': misses, 'size': size, 'maxsize': maxsize,
+                      'hit_rate': hits / (hits+misses) if hits+misses else 0.0}
+    return info
+
+
+def feature_key(observation, tag):
+    """
+    Joins an observation feature with the current tag into the feature string used as the weight key,
+    e.g. ('Wi=France+Ti=', 'I-LOC') -> 'Wi=France+Ti=I-LOC'
+    :param observation: String.  As returned by Features.observation_features and friends
+    :param tag: String.  The current tag
+    :return: String
+    """
+    if observation.startswith('Ti-1='): # prev_tag puts the current tag first: Ti=I-LOC+Ti-1=<START>
+        return 'Ti='+tag+'+'+observation
+    return observation+tag
+
+
+def split_feature_key(key):
+    """
+    Inverse of feature_key
+    :param key: String.  A feature string, e.g. 'Wi=France+Ti=I-LOC'
+    :return: Tuple of (observation, tag), or None if the key is not of the form built by feature_key
+    """
+    if key.startswith('Ti=') and '+Ti-1=' in key:
+        tag, pre_tag = key[3:].split('+Ti-1=', 1)
+        return 'Ti-1='+pre_tag, tag
+    observation, sep, tag = key.rpartition('Ti=')
+    if not sep:
+        return None
+    return observation+sep, tag
 
 
 class Features(object):
@@ -30,76 +230,238 @@ class Features(object):
         """
         self.feature_names = feature_names
         self.inputs = inputs
-        
+        self._observations = {} # position -> observation features, see observation_features
+        self._gazetteer = None  # gazetteer matches of the sentence, see gazetteer_matches
 
-    def compute_features(self, cur_tag, pre_tag, i):
+    def observation_features(self, i):
         """
-        Computes the local features for the current tag, the previous tag, and position i
-        :param cur_tag: String.  The current tag.
-        :param pre_tag: String.  The previous tag.
+        Computes the observation features at position i that depend on neither the current nor the previous tag.
+        They are built once per position; the feature for a tag is feature_key(observation, tag).
         :param i: Int. The position
-        :return: FeatureVector
+        :return: Array of Strings
         """
-        feats = FeatureVector({})
-        # print (self.feature_names)
+        if i in self._observations:
+            return self._observations[i]
+
+        obs = []
         cur_word = self.inputs['tokens'][i]
+        cur = word_attributes(cur_word)
 
         if 'current_word' in self.feature_names:#Feature 1 :  Wi=France+Ti=I-LOC 1.0
-            feats.times_plus_equal(1, FeatureVector({'Wi='+cur_word+'+Ti='+cur_tag: 1}))
-
-        if 'prev_tag' in self.feature_names:#Feature 2 : Ti-1=<START>+Ti=I-LOC 1.0
-            feats.times_plus_equal(1, FeatureVector({'Ti='+cur_tag+"+Ti-1="+pre_tag: 1}))
+            obs.append('Wi='+cur_word+'+Ti=')
 
         if 'lowercase' in self.feature_names:#Feature 3 : Oi=france+Ti=I-LOC 1.0
-                feats.times_plus_equal(1, FeatureVector({'Oi='+cur_word.lower()+'+Ti='+cur_tag:1}))
+            obs.append('Oi='+cur.lower+'+Ti=')
 
         if 'current_pos_tag' in self.feature_names: #Feature 4 : Pi=NNP+Ti=I-LOC 1.0
-            feats.times_plus_equal(1, FeatureVector({'Pi='+self.inputs['pos'][i]+'+Ti='+cur_tag:1}))
-            
+            obs.append('Pi='+self.inputs['pos'][i]+'+Ti=')
+
         if 'shape' in self.feature_names: #Feature 5 : Si=Aaaaaa+Ti=I-LOC 1.0
-            new_word = ('').join(['A' if i.isupper() else 'a' if i.islower() else 'd' if i in '0123456789' else i for i in cur_word])
-            feats.times_plus_equal(1, FeatureVector({'Si='+new_word+'+Ti='+cur_tag: 1}))
+            obs.append('Si='+cur.shape+'+Ti=')
 
         if 'prev_next_word_features' in self.feature_names: #Feature 6
             prev_word  = self.inputs['tokens'][i-1]
-            feats.times_plus_equal(1, FeatureVector({'Wi-1='+prev_word+'+Ti='+cur_tag: 1})) #Wi-1=<START>+Ti=I-LOC 1.0
-            feats.times_plus_equal(1, FeatureVector({'Oi-1='+prev_word.lower()+'+Ti='+cur_tag: 1})) #Oi-1=france+Ti=I-LOC 1.0
-            feats.times_plus_equal(1, FeatureVector({"Pi-1="+self.inputs['pos'][i-1]+'+Ti='+cur_tag: 1})) # Pi-1=<START>+Ti=I-LOC 1.0
-            
+            obs.append('Wi-1='+prev_word+'+Ti=') #Wi-1=<START>+Ti=I-LOC 1.0
+            obs.append('Oi-1='+word_attributes(prev_word).lower+'+Ti=') #Oi-1=france+Ti=I-LOC 1.0
+            obs.append('Pi-1='+self.inputs['pos'][i-1]+'+Ti=') # Pi-1=<START>+Ti=I-LOC 1.0
+
             if cur_word!='<STOP>':
                 next_word = self.inputs['tokens'][i+1]
-                feats.times_plus_equal(1, FeatureVector({'Wi+1='+next_word+'+Ti='+cur_tag: 1}))
-                feats.times_plus_equal(1, FeatureVector({'Oi+1='+next_word.lower()+'+Ti='+cur_tag: 1}))
-                # if next_word!='<STOP>':
-                    # feats.times_plus_equal(1, FeatureVector({'Ti='+cur_tag+"+Ti+1="+self.inputs['NP_chunk'][i+1]: 1}))
-                feats.times_plus_equal(1, FeatureVector({"Pi+1="+self.inputs['pos'][i+1]+'+Ti='+cur_tag: 1}))
-
-        if 'word_lower_pos' in self.feature_names: #Feature 7 : Wi=France+Oi=france+Pi=NNP+Ti-1=<START>+Ti=I-LOC 1.0
-            feats.times_plus_equal(1, FeatureVector({'Wi='+cur_word+'+Oi='+cur_word.lower()+'+P_i='+self.inputs['pos'][i]+'+Ti-1='+pre_tag+'+Ti='+cur_tag: 1}))
+                obs.append('Wi+1='+next_word+'+Ti=')
+                obs.append('Oi+1='+word_attributes(next_word).lower+'+Ti=')
+                obs.append('Pi+1='+self.inputs['pos'][i+1]+'+Ti=')
 
         if 'length_k' in self.feature_names: #Feature 8 : PREi=Fr+Ti=I-LOC 1.0
-            for i in range(min(4,len(cur_word))):
-                feats.times_plus_equal(1, FeatureVector({'PREi='+cur_word[:i+1]+'Ti='+cur_tag: 1}))
+            for prefix in cur.prefixes:
+                obs.append('PREi='+prefix+'Ti=')
+
+        if 'uppercase' in self.feature_names: #Feature 10 : CAPi=True+Ti=I-LOC 1.0
+            if cur.capitalized: obs.append('CAPi=True+Ti=')
+            else: obs.append('CAPi=False+Ti=')
+
+        if 'position' in self.feature_names: #Feature 11 : POSi=1+Ti=I-LOC 1.0
+            # The original template reused the length_k loop variable, so with length_k enabled the position is the
+            # index of the longest prefix.  Kept as is so that trained models stay valid.
+            position = len(cur.prefixes)-1 if 'length_k' in self.feature_names else i
+            obs.append('POSi='+str(position)+'+Ti=')
 
+        if 'gazetteer_spans' in self.feature_names: #Feature 12 : GSi=B-LOC+Ti=I-LOC 1.0 for i in a gazetteer span
+            for membership in self.gazetteer_matches()[i]:
+                obs.append('GSi='+membership+'+Ti=')
+
+        self._observations[i] = obs
+        return obs
+
+    def gazetteer_matches(self):
+        """
+        Finds the gazetteer entries in the sentence, once for all positions
+        :return: Array of Arrays of Strings.  Item i is the sorted list of 'B-'+type and 'I-'+type for the entries (of
+            any length) that start at, or continue through, token i.
+        """
+        if self._gazetteer is None:
+            tokens = self.inputs['tokens']
+            spans = [set() for _ in tokens]
+            for start, end, gtype in gazetteer_index().find_spans(tokens):
+                spans[start].add('B-'+gtype)
+                for j in range(start+1, end):
+                    spans[j].add('I-'+gtype)
+            self._gazetteer = [sorted(s) for s in spans]
+        return self._gazetteer
+
+    def emission_observations(self, cur_tag, i):
+        """
+        Observation features at position i for the current tag.  Only the gazetteer feature looks at the tag itself.
+        :param cur_tag: String.  The current tag.
+        :param i: Int. The position
+        :return: Array of Strings
+        """
+        obs = self.observation_features(i)
         if 'gazetteer' in self.feature_names: #Feature 9 : GAZi=True+Ti=I-LOC 1.0
-            if cur_word!='<STOP>':
-                if cur_tag!='O' and cur_word in g_dict[cur_tag.split('-')[1]]:
-                    feats.times_plus_equal(1, FeatureVector({'GAZi=True'+'Ti='+cur_tag: 1}))
-                else:
-                    feats.times_plus_equal(1, FeatureVector({'GAZi=False'+'Ti='+cur_tag: 1}))
+            cur_word = self.inputs['tokens'][i]
+            if cur_word!='<STOP>' and cur_tag!='O' and cur_tag.split('-')[1] in word_gazetteer_types(cur_word):
+                obs = obs + ['GAZi=TrueTi=']
             else:
-                feats.times_plus_equal(1, FeatureVector({'GAZi=False'+'Ti='+cur_tag: 1}))
+                obs = obs + ['GAZi=FalseTi=']
+        return obs
 
-        if 'uppercase' in self.feature_names: #Feature 10 : CAPi=True+Ti=I-LOC 1.0
-            if cur_word[0].isupper(): feats.times_plus_equal(1, FeatureVector({'CAPi=True+Ti='+cur_tag:1}))
-            else: feats.times_plus_equal(1, FeatureVector({'CAPi=False+Ti='+cur_tag:1}))
+    def transition_observations(self, pre_tag, i):
+        """
+        Observation features at position i that depend on the previous tag.
+        :param pre_tag: String.  The previous tag.
+        :param i: Int. The position
+        :return: Array of Strings
+        """
+        obs = []
+        if 'prev_tag' in self.feature_names:#Feature 2 : Ti-1=<START>+Ti=I-LOC 1.0
+            obs.append('Ti-1='+pre_tag)
 
-        if 'position' in self.feature_names: #Feature 11 : POSi=1+Ti=I-LOC 1.0
-            feats.times_plus_equal(1, FeatureVector({'POSi='+str(i)+'+Ti='+cur_tag: 1}))
+        if 'word_lower_pos' in self.feature_names: #Feature 7 : Wi=France+Oi=france+Pi=NNP+Ti-1=<START>+Ti=I-LOC 1.0
+            cur_word = self.inputs['tokens'][i]
+            obs.append('Wi='+cur_word+'+Oi='+word_attributes(cur_word).lower+'+P_i='+self.inputs['pos'][i]+'+Ti-1='+pre_tag+'+Ti=')
+        return obs
+
+    def emission_features(self, cur_tag, i):
+        """
+        The features at position i that depend only on the current tag
+        :param cur_tag: String.  The current tag.
+        :param i: Int. The position
+        :return: Array of Strings
+        """
+        return [feature_key(o, cur_tag) for o in self.emission_observations(cur_tag, i)]
 
+    def transition_features(self, cur_tag, pre_tag, i):
+        """
+        The features at position i that depend on both the current and the previous tag
+        :param cur_tag: String.  The current tag.
+        :param pre_tag: String.  The previous tag.
+        :param i: Int. The position
+        :return: Array of Strings
+        """
+        return [feature_key(o, cur_tag) for o in self.transition_observations(pre_tag, i)]
+
+    def compute_features(self, cur_tag, pre_tag, i):
+        """
+        Computes the local features for the current tag, the previous tag, and position i
+        :param cur_tag: String.  The current tag.
+        :param pre_tag: String.  The previous tag.
+        :param i: Int. The position
+        :return: FeatureVector
+        """
+        feats = FeatureVector({})
+        for key in self.emission_features(cur_tag, i) + self.transition_features(cur_tag, pre_tag, i):
+            feats.fdict[key] = feats.fdict.get(key, 0) + 1
         return feats
 
 
+class CompiledFeatures(object):
+    def __init__(self, inputs, feature_names, index, tagset, add=True):
+        """
+        The features of a sentence compiled once into arrays of feature ids (see FeatureIndex), so that scoring and
+        gradients can be computed again and again without building any strings.
+        Features of the <STOP> position are left out: they never take part in decoding.
+        :param inputs: Dictionary from String to an Array of Strings, as for Features
+        :param feature_names: Array of Strings.  The list of features to compute.
+        :param index: FeatureIndex.  Shared by all the sentences and by the WeightMatrix of the model
+        :param tagset: Array of Strings.  The list of tags.
+        :param add: Boolean.  Whether to add unseen observations to the index (True for training data)
+        """
+        features = Features(inputs, feature_names)
+        self.index = index
+        self.tagset = list(tagset)
+        self.tag_index = {tag: j for j, tag in enumerate(self.tagset)}
+        self.input_len = len(inputs['tokens'])
+        n_tags, n_words = len(tagset), self.input_len-2
+
+        def lookup(observations):
+            return [index.lookup(o, add) for o in observations]
+
+        positions, ids, tag_ids, trans_ids = [], [], [], []
+        for i in range(1, n_words+1):
+            obs = features.observation_features(i)
+            ids.extend(lookup(obs))
+            positions.extend([i-1]*len(obs))
+            tag_ids.append([lookup(features.emission_observations(tag, i)[len(obs):]) for tag in tagset])
+            trans_ids.append([lookup(features.transition_observations(tag, i)) for tag in tagset])
+
+        n_tag_obs = len(tag_ids[0][0]) if n_words else 0
+        n_trans_obs = len(features.transition_observations('<START>', 1))
+        self.positions = np.array(positions, dtype=np.int32)    # position of each entry of ids
+        self.ids = np.array(ids, dtype=np.int32)                # observation features, shared by all tags
+        self.tag_ids = np.array(tag_ids, dtype=np.int32).reshape(n_words, n_tags, n_tag_obs)        # e.g. gazetteer
+        self.trans_ids = np.array(trans_ids, dtype=np.int32).reshape(n_words, n_tags, n_trans_obs)  # by previous tag
+        self.start_ids = np.array(lookup(features.transition_observations('<START>', 1)), dtype=np.int32)
+
+    def score_matrices(self, weights):
+        """
+        :param weights: WeightMatrix.  Must share this sentence's index and tagset
+        :return: Tuple of (emissions, transitions, start_transitions) as taken by decode.viterbi
+        """
+        weights.reserve(len(self.index))
+        matrix = weights.weights
+        n_tags, n_words = len(self.tagset), self.input_len-2
+
+        emissions = np.zeros((n_words, n_tags))
+        np.add.at(emissions, self.positions, _rows(matrix, self.ids))
+        tag_slots = self.tag_ids.astype(np.int64)*n_tags + np.arange(n_tags)[None, :, None]
+        emissions += np.where(self.tag_ids >= 0, matrix.ravel()[np.maximum(tag_slots, 0)], 0).sum(axis=2)
+        transitions = _rows(matrix, self.trans_ids).sum(axis=2)
+        start_transitions = _rows(matrix, self.start_ids).sum(axis=0)
+        return emissions, transitions, start_transitions
+
+    def feature_slots(self, tag_seq):
+        """
+        The features of a tag sequence, as WeightMatrix slots
+        :param tag_seq: Array of Strings.  The tag sequence including <START> and <STOP>
+        :return: numpy array of slots.  A slot occurs once for every time its feature fires.
+        """
+        n_tags, n_words = len(self.tagset), self.input_len-2
+        tags = np.array([self.tag_index[tag] for tag in tag_seq[1:-1]], dtype=np.int64)
+        if not n_words:
+            return np.zeros(0, dtype=np.int64)
+        slots = np.concatenate([
+            self.ids.astype(np.int64)*n_tags + tags[self.positions],
+            (self.tag_ids[np.arange(n_words), tags].astype(np.int64)*n_tags + tags[:, None]).ravel(),
+            self.start_ids.astype(np.int64)*n_tags + tags[0],
+            (self.trans_ids[np.arange(1, n_words), tags[:-1]].astype(np.int64)*n_tags + tags[1:, None]).ravel(),
+        ])
+        valid = np.concatenate([
+            self.ids >= 0,
+            (self.tag_ids[np.arange(n_words), tags] >= 0).ravel(),
+            self.start_ids >= 0,
+            (self.trans_ids[np.arange(1, n_words), tags[:-1]] >= 0).ravel(),
+        ])
+        return slots[valid]
+
+
+def _rows(matrix, ids):
+    """
+    matrix[ids], with the rows of unseen features (id -1) set to zero
+    """
+    rows = matrix[np.maximum(ids, 0)]
+    rows[ids < 0] = 0
+    return rows
+
+
 class FeatureVector(object):
 
     def __init__(self, fdict):
@@ -177,8 +539,310 @@ class FeatureVector(object):
         :param filename: String
         :return: None
         """
-        self.fdict = {}
+        if isinstance(self.fdict, WeightMatrix):
+            self.fdict.clear()
+        else:
+            self.fdict = {}
         with open(filename, 'r') as f:
             for line in f.readlines():
                 txt = line.split()
                 self.fdict[txt[0]] = float(txt[1])
+
+
+class ScaledFeatureVector(FeatureVector):
+
+    def __init__(self, fdict, scale=1.0):
+        """
+        A FeatureVector stored as scale * fdict, so multiplying every weight by a constant (as L2 regularization does
+        after each step) is O(1) instead of O(number of features).  fdict holds the unscaled values; call normalize
+        before reading it directly.
+        :param fdict: Dictionary (or WeightMatrix) of unscaled values
+        :param scale: Double
+        """
+        super(ScaledFeatureVector, self).__init__(fdict)
+        self.scale = scale
+
+    def times_plus_equal(self, scalar, v2):
+        """
+        self += scalar * v2
+        :param scalar: Double
+        :param v2: FeatureVector
+        :return: None
+        """
+        if isinstance(v2, ScaledFeatureVector):
+            scalar = scalar * v2.scale
+        super(ScaledFeatureVector, self).times_plus_equal(scalar / self.scale, v2)
+
+    def dot_product(self, v2):
+        return self.scale * super(ScaledFeatureVector, self).dot_product(v2)
+
+    def rescale(self, factor):
+        """
+        self = factor * self
+        :param factor: Double
+        :return: None
+        """
+        if factor == 0:
+            self.fdict.clear()
+            self.scale = 1.0
+            return
+        self.scale *= factor
+        if abs(self.scale) < 1e-6: # fold the scale in before the unscaled values grow too large
+            self.normalize()
+
+    def normalize(self):
+        """
+        Folds the scale into fdict, so that fdict holds the actual weights
+        :return: None
+        """
+        if self.scale == 1.0:
+            return
+        if isinstance(self.fdict, WeightMatrix):
+            self.fdict.weights *= self.scale
+            extra = self.fdict.extra
+        else:
+            extra = self.fdict
+        for key in extra:
+            extra[key] *= self.scale
+        self.scale = 1.0
+
+    def write_to_file(self, filename):
+        """
+        Writes the actual (scaled) weights, leaving the representation alone
+        :param filename: String
+        :return: None
+        """
+        print('Writing to ' + filename)
+        with open(filename, 'w', encoding='utf-8') as f:
+            for key, value in self.fdict.items():
+                f.write('{} {}\n'.format(key, self.scale * value))
+
+
+class WeightCheckpoint(object):
+
+    def __init__(self, parameters):
+        """
+        Keeps the parameters as they were at the last commit, for early stopping, without copying the whole model on
+        every commit.  Call record before a sparse update, and record_all before an update that changes every weight.
+        Until the next commit, record keeps the old value of each feature the first time it changes (a delta log).
+        The first record_all copies the model once (copy on write) and record is free from then on.
+        :param parameters: FeatureVector
+        """
+        self.parameters = parameters
+        self.commit()
+
+    def commit(self):
+        """
+        Makes the current parameters the checkpoint
+        :return: None
+        """
+        self.undo = {}
+        self.snapshot = None
+
+    def record(self, v2):
+        """
+        Call before self.parameters is updated in the features of v2
+        :param v2: FeatureVector
+        :return: None
+        """
+        if self.snapshot is not None:
+            return
+        fdict, undo = self.parameters.fdict, self.undo
+        for key in v2.fdict:
+            if key not in undo:
+                undo[key] = fdict.get(key)
+
+    def record_all(self):
+        """
+        Call before an update that may change every weight, e.g. L2 regularization
+        :return: None
+        """
+        if self.snapshot is None:
+            self.snapshot = copy.deepcopy(self.parameters)
+            self._undo(self.snapshot)
+            self.undo = {}
+
+    def _undo(self, parameters):
+        for key, value in self.undo.items():
+            if value is None:
+                del parameters.fdict[key]
+            else:
+                parameters.fdict[key] = value
+
+    def restore(self):
+        """
+        :return: FeatureVector.  The parameters at the last commit.  The tracked parameters are rolled back in place
+            unless record_all was called, in which case the snapshot is returned.
+        """
+        if self.snapshot is not None:
+            self.parameters = self.snapshot
+        else:
+            self._undo(self.parameters)
+        self.commit()
+        return self.parameters
+
+
+class FeatureIndex(object):
+
+    def __init__(self, n_buckets=None):
+        """
+        Maps observation features (see Features.observation_features) to integer ids.
+        :param n_buckets: Int or None.  If None, observations are interned in a vocabulary that grows as new ones are
+            added.  Otherwise observations are hashed into n_buckets ids (the hashing trick), so memory is fixed up front.
+        """
+        self.n_buckets = n_buckets
+        self.ids = {}
+        self.observations = []
+
+    def __len__(self):
+        return self.n_buckets if self.n_buckets else len(self.observations)
+
+    def lookup(self, observation, add=True):
+        """
+        :param observation: String
+        :param add: Boolean.  Whether to intern an unseen observation.  Always true for a hashed index.
+        :return: Int.  The id of the observation, or -1 if it is unseen and add is False
+        """
+        if self.n_buckets:
+            return zlib.crc32(observation.encode('utf-8')) % self.n_buckets
+        fid = self.ids.get(observation)
+        if fid is None:
+            if not add:
+                return -1
+            fid = self.ids[observation] = len(self.observations)
+            self.observations.append(observation)
+        return fid
+
+    def observation(self, fid):
+        """
+        :param fid: Int
+        :return: String.  The observation with id fid, or None for a hashed index
+        """
+        if self.n_buckets:
+            return None
+        return self.observations[fid]
+
+
+class WeightMatrix(object):
+
+    def __init__(self, index, tagset):
+        """
+        Dense weight store indexed as [feature_id, tag].  Can be used as the fdict of a FeatureVector: it accepts the
+        usual feature strings as keys, as well as integer slots (feature_id * len(tagset) + tag_id) which skip
+        building and parsing strings altogether.  Keys that do not fit the layout (e.g. features of <STOP>) are kept
+        in a plain dict.
+        :param index: FeatureIndex
+        :param tagset: Array of Strings.  The list of tags.
+        """
+        self.index = index
+        self.tagset = list(tagset)
+        self.tag_ids = {tag: j for j, tag in enumerate(self.tagset)}
+        self.weights = np.zeros((max(len(index), 1), len(self.tagset)))
+        self.extra = {}
+
+    def reserve(self, n_features):
+        """
+        Grows the matrix to hold at least n_features rows
+        :param n_features: Int
+        :return: None
+        """
+        rows = self.weights.shape[0]
+        if n_features > rows:
+            weights = np.zeros((max(n_features, 2*rows), len(self.tagset)))
+            weights[:rows] = self.weights
+            self.weights = weights
+
+    def slot(self, key, add=True):
+        """
+        :param key: String feature or Int slot
+        :param add: Boolean.  Whether to add an unseen observation to the index
+        :return: Int slot, or -1 if the key is unseen (add is False) or does not fit the layout
+        """
+        if isinstance(key, (int, np.integer)):
+            return int(key)
+        if self.index.n_buckets and key.isdigit(): # hashed features are written out by slot
+            return int(key)
+        parts = split_feature_key(key)
+        if parts is None or parts[1] not in self.tag_ids:
+            return -1
+        fid = self.index.lookup(parts[0], add)
+        if fid < 0:
+            return -1
+        self.reserve(fid+1)
+        return fid*len(self.tagset) + self.tag_ids[parts[1]]
+
+    def key(self, slot):
+        """
+        :param slot: Int
+        :return: String feature for the slot, or the slot itself for a hashed index
+        """
+        fid, tag_id = divmod(slot, len(self.tagset))
+        observation = self.index.observation(fid)
+        if observation is None:
+            return slot
+        return feature_key(observation, self.tagset[tag_id])
+
+    def get(self, key, default=None):
+        slot = self.slot(key, add=False)
+        if slot < 0:
+            return self.extra.get(key, default)
+        if slot >= self.weights.size:
+            return default
+        return float(self.weights.flat[slot])
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        slot = self.slot(key)
+        if slot < 0:
+            self.extra[key] = value
+        else:
+            self.reserve(slot//len(self.tagset) + 1)
+            self.weights.flat[slot] = value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def slots(self):
+        """
+        :return: numpy array of the slots holding a non-zero weight
+        """
+        return np.flatnonzero(self.weights)
+
+    def items(self):
+        for slot in self.slots():
+            yield self.key(int(slot)), float(self.weights.flat[slot])
+        for item in self.extra.items():
+            yield item
+
+    def keys(self):
+        for key, _ in self.items():
+            yield key
+
+    __iter__ = keys
+
+    def __len__(self):
+        return len(self.slots()) + len(self.extra)
+
+    def __delitem__(self, key):
+        slot = self.slot(key, add=False)
+        if slot < 0:
+            del self.extra[key]
+        elif slot < self.weights.size:
+            self.weights.flat[slot] = 0
+
+    def clear(self):
+        self.weights = np.zeros((max(len(self.index), 1), len(self.tagset)))
+        self.extra = {}
+
+    def __deepcopy__(self, memo):
+        # the index is shared by all the weights over the same features, only the values are copied
+        copy = WeightMatrix.__new__(WeightMatrix)
+        copy.__dict__.update(self.__dict__)
+        copy.weights = self.weights.copy()
+        copy.extra = dict(self.extra)
+        return copy
@@ -1,9 +1,111 @@
-from features import FeatureVector, Features
-from decode import decode
-from conlleval import evaluate as conllevaluate
+import os
+import sys
+import time
+import hashlib
+import itertools
+import collections
+import pickle
+import multiprocessing
 
+import numpy as np
 
-def predict(inputs, input_len, parameters, feature_names, tagset):
+from features import FeatureVector, ScaledFeatureVector, Features, CompiledFeatures, FeatureIndex, WeightMatrix, feature_key, gazetteer_path
+from decode import viterbi, viterbi_batch
+from conlleval import ChunkCounter
+import profiling
+
+# the CoNLL-2003 tags and the features of the shipped model, shared by main.py, server.py, pruning.py and benchmark.py
+TAGSET = ['B-PER', 'B-LOC', 'B-ORG', 'B-MISC', 'I-PER', 'I-LOC', 'I-ORG', 'I-MISC', 'O']
+FEATURE_NAMES = ['current_word', 'prev_tag', 'lowercase','current_pos_tag','shape',
+    'prev_next_word_features','word_lower_pos','length_k','gazetteer','uppercase','position' ]
+
+# part of the key of the load_compiled_data cache: bump it whenever a change to Features, CompiledFeatures or
+# FeatureIndex changes what compile_data returns, so that stale pickles are not loaded
+COMPILED_FORMAT_VERSION = 1
+
+
+def compute_score_matrices(features, input_len, parameters, tagset):
+    """
+    Scores every tag and tag pair of a sentence, building each position's observation features once.
+    :param features: Features or CompiledFeatures.  The features of the sentence
+    :param input_len: Int. input length including the padding <START> and <STOP>
+    :param parameters: FeatureVector.  The model parameters
+    :param tagset: Array of Strings.  The list of tags.
+    :return: Tuple of (emissions, transitions, start_transitions) as taken by decode.viterbi
+    """
+    with profiling.timer('scoring'):
+        profiling.count('score_matrices')
+        return _compute_score_matrices(features, input_len, parameters, tagset)
+
+def _compute_score_matrices(features, input_len, parameters, tagset):
+    if isinstance(parameters, ScaledFeatureVector) and parameters.scale != 1.0:
+        return tuple(parameters.scale * m for m in _compute_score_matrices(features, input_len, FeatureVector(parameters.fdict), tagset))
+    weights = parameters.fdict
+    if isinstance(features, CompiledFeatures):
+        return features.score_matrices(weights)
+    if isinstance(weights, WeightMatrix) and weights.tagset == list(tagset):
+        return compute_dense_score_matrices(features, input_len, weights)
+    n_tags, n_words = len(tagset), input_len-2
+
+    def weight(observations, tag):
+        return sum(weights.get(feature_key(o, tag), 0) for o in observations)
+
+    emissions = np.zeros((n_words, n_tags))
+    transitions = np.zeros((n_words, n_tags, n_tags))
+    start_transitions = np.array([weight(features.transition_observations('<START>', 1), tag) for tag in tagset], dtype=np.float64)
+
+    for i in range(1, n_words+1):
+        for j, cur_tag in enumerate(tagset):
+            emissions[i-1, j] = weight(features.emission_observations(cur_tag, i), cur_tag)
+        if i == 1:
+            continue
+        for k, pre_tag in enumerate(tagset):
+            observations = features.transition_observations(pre_tag, i)
+            for j, cur_tag in enumerate(tagset):
+                transitions[i-1, k, j] = weight(observations, cur_tag)
+
+    return emissions, transitions, start_transitions
+
+
+def compute_dense_score_matrices(features, input_len, weights):
+    """
+    compute_score_matrices for a WeightMatrix.  Observations are mapped to feature ids once per position and each
+    row of the matrix scores all tags at once.
+    :param features: Features.  The features of the sentence
+    :param input_len: Int. input length including the padding <START> and <STOP>
+    :param weights: WeightMatrix.  The model parameters
+    :return: Tuple of (emissions, transitions, start_transitions) as taken by decode.viterbi
+    """
+    tagset, index = weights.tagset, weights.index
+    n_tags, n_words = len(tagset), input_len-2
+    weights.reserve(len(index))
+    matrix = weights.weights
+
+    def weight(observations):
+        ids = [fid for fid in (index.lookup(o, add=False) for o in observations) if fid >= 0]
+        return matrix[ids].sum(axis=0)
+
+    emissions = np.zeros((n_words, n_tags))
+    transitions = np.zeros((n_words, n_tags, n_tags))
+    start_transitions = weight(features.transition_observations('<START>', 1))
+
+    for i in range(1, n_words+1):
+        observations = features.observation_features(i)
+        emissions[i-1] = weight(observations)
+        for j, cur_tag in enumerate(tagset): # tag specific observations, i.e. the gazetteer
+            for o in features.emission_observations(cur_tag, i)[len(observations):]:
+                fid = index.lookup(o, add=False)
+                if fid >= 0:
+                    emissions[i-1, j] += matrix[fid, j]
+        if i == 1:
+            continue
+        for k, pre_tag in enumerate(tagset):
+            transitions[i-1, k] = weight(features.transition_observations(pre_tag, i))
+
+    return emissions, transitions, start_transitions
+
+
+def predict(inputs, input_len, parameters, feature_names, tagset, constraints=None, decoder=None):
     """
     
     :param inputs:
@@ -11,13 +113,244 @@ def predict(inputs, input_len, parameters, feature_names, tagset):
     :param parameters:
     :param feature_names:
     :param tagset:
+    :param constraints: Tuple of (allowed, allowed_start) as returned by decode.allowed_transitions, or None
+    :param decoder: Function with the arguments of decode.viterbi, e.g. a decode.BeamDecoder.  viterbi if None.
     :return:
     """
-    features = Features(inputs, feature_names)
+    weights = parameters.fdict
+    with profiling.timer('feature_extraction'):
+        if isinstance(weights, WeightMatrix) and weights.tagset == list(tagset):
+            # builds the observations and looks them up now, so that scoring is timed on its own
+            features = CompiledFeatures(inputs, feature_names, weights.index, tagset, add=False)
+        else:
+            features = Features(inputs, feature_names)    # lazy: the observations are built while scoring
+    matrices = compute_score_matrices(features, input_len, parameters, tagset)
+    with profiling.timer('decode'):
+        profiling.count('sentences_decoded')
+        profiling.count('tokens_decoded', input_len-2)
+        return (decoder or viterbi)(*matrices, tagset, constraints)
+
 
-    def score(cur_tag, pre_tag, i):
-        return parameters.dot_product(features.compute_features(cur_tag, pre_tag, i))
-    return decode(input_len, tagset, score)
+def compute_batch_score_matrices(data, feature_names, parameters, tagset):
+    """
+    compute_score_matrices for a batch of sentences, padded to the longest one.  For a WeightMatrix the feature ids of
+    the whole batch are gathered first and scored with a few array operations; otherwise each sentence is scored on
+    its own.  Building and looking up the observations is timed as feature_extraction, the rest as scoring.
+    :param data: Array of dictionaries, as returned by read_data
+    :param feature_names: Array of Strings.  The list of features.
+    :param parameters: FeatureVector.  The model parameters
+    :param tagset: Array of Strings.  The list of tags.
+    :return: Tuple of (emissions, transitions, start_transitions, lengths) as taken by decode.viterbi_batch
+    """
+    n_tags, n_batch = len(tagset), len(data)
+    lengths = [len(inputs['tokens'])-2 for inputs in data]
+    max_words = max(lengths) if data else 0
+    weights = parameters.fdict
+    if not isinstance(weights, WeightMatrix) or weights.tagset != list(tagset):
+        emissions = np.zeros((n_batch, max_words, n_tags))
+        transitions = np.zeros((n_batch, max_words, n_tags, n_tags))
+        start_transitions = np.zeros((n_batch, n_tags))
+        with profiling.timer('scoring'):    # the observations are built lazily while scoring
+            for b, inputs in enumerate(data):
+                e, t, s = _compute_score_matrices(Features(inputs, feature_names), len(inputs['tokens']), parameters, tagset)
+                emissions[b, :lengths[b]], transitions[b, :lengths[b]], start_transitions[b] = e, t, s
+        return emissions, transitions, start_transitions, lengths
+
+    index = weights.index
+    weights.reserve(len(index))
+    matrix = weights.weights
+    scale = parameters.scale if isinstance(parameters, ScaledFeatureVector) else 1.0
+
+    with profiling.timer('feature_extraction'):
+        gathered = _gather_batch_features(data, feature_names, index, tagset, lengths, max_words)
+    with profiling.timer('scoring'):
+        return _score_batch(gathered, matrix, scale, n_batch, max_words, n_tags, lengths)
+
+
+def _gather_batch_features(data, feature_names, index, tagset, lengths, max_words):
+    # (row, feature id) pairs, rows being flattened (sentence, position) or (sentence, position, previous tag)
+    n_tags = len(tagset)
+    em_rows, em_ids, tag_rows, tag_cols, tag_ids, trans_rows, trans_ids, start_rows, start_ids = [], [], [], [], [], [], [], [], []
+    for b, inputs in enumerate(data):
+        features = Features(inputs, feature_names)
+        for o in features.transition_observations('<START>', 1):
+            start_rows.append(b)
+            start_ids.append(index.lookup(o, add=False))
+        for i in range(1, lengths[b]+1):
+            row = b*max_words + i-1
+            observations = features.observation_features(i)
+            for o in observations:
+                em_rows.append(row)
+                em_ids.append(index.lookup(o, add=False))
+            for j, cur_tag in enumerate(tagset): # tag specific observations, i.e. the gazetteer
+                for o in features.emission_observations(cur_tag, i)[len(observations):]:
+                    tag_rows.append(row)
+                    tag_cols.append(j)
+                    tag_ids.append(index.lookup(o, add=False))
+            if i == 1:
+                continue
+            for k, pre_tag in enumerate(tagset):
+                for o in features.transition_observations(pre_tag, i):
+                    trans_rows.append(row*n_tags + k)
+                    trans_ids.append(index.lookup(o, add=False))
+    return em_rows, em_ids, tag_rows, tag_cols, tag_ids, trans_rows, trans_ids, start_rows, start_ids
+
+
+def _score_batch(gathered, matrix, scale, n_batch, max_words, n_tags, lengths):
+    em_rows, em_ids, tag_rows, tag_cols, tag_ids, trans_rows, trans_ids, start_rows, start_ids = gathered
+
+    def known(rows, ids):
+        rows, ids = np.array(rows, dtype=np.intp), np.array(ids, dtype=np.intp)
+        return rows[ids >= 0], ids[ids >= 0]
+
+    emissions = np.zeros((n_batch*max_words, n_tags))
+    rows, ids = known(em_rows, em_ids)
+    np.add.at(emissions, rows, matrix[ids])
+    rows, ids = known(tag_rows, tag_ids)
+    cols = np.array(tag_cols, dtype=np.intp)[np.array(tag_ids, dtype=np.intp) >= 0]
+    np.add.at(emissions, (rows, cols), matrix[ids, cols])
+    transitions = np.zeros((n_batch*max_words*n_tags, n_tags))
+    rows, ids = known(trans_rows, trans_ids)
+    np.add.at(transitions, rows, matrix[ids])
+    start_transitions = np.zeros((n_batch, n_tags))
+    rows, ids = known(start_rows, start_ids)
+    np.add.at(start_transitions, rows, matrix[ids])
+    return (scale*emissions.reshape(n_batch, max_words, n_tags), scale*transitions.reshape(n_batch, max_words, n_tags, n_tags),
+            scale*start_transitions, lengths)
+
+def predict_batch(data, parameters, feature_names, tagset, constraints=None, batch_size=256):
+    """
+    Predicts the tag sequences of many sentences a batch at a time, see compute_batch_score_matrices and
+    decode.viterbi_batch.  The sentences are sorted by length first, so that a batch needs little padding.
+    :param data: Array of dictionaries, as returned by read_data
+    :param parameters: FeatureVector.  The model parameters
+    :param feature_names: Array of Strings.  The list of features.
+    :param tagset: Array of Strings.  The list of tags.
+    :param constraints: Tuple of (allowed, allowed_start) as returned by decode.allowed_transitions, or None
+    :param batch_size: Int.  Number of sentences decoded together
+    :return: Array of tag sequences (including <START> and <STOP>), in the order of data
+    """
+    order = sorted(range(len(data)), key=lambda d: len(data[d]['tokens']))
+    tag_seqs = [None]*len(data)
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start+batch_size]
+        profiling.count('score_matrices', len(batch))
+        matrices = compute_batch_score_matrices([data[d] for d in batch], feature_names, parameters, tagset)
+        with profiling.timer('decode'):
+            profiling.count('sentences_decoded', len(batch))
+            profiling.count('tokens_decoded', sum(matrices[3]))
+            for d, tag_seq in zip(batch, viterbi_batch(*matrices, tagset, constraints)):
+                tag_seqs[d] = tag_seq
+    return tag_seqs
+
+
+_predict_worker = {} # model and settings of a prediction worker process, set by _init_predict_worker
+
+def _init_predict_worker(parameters, feature_names, tagset, constraints=None, decoder=None):
+    _predict_worker['args'] = (parameters, feature_names, tagset, constraints, decoder)
+
+def _predict_chunk(chunk):
+    parameters, feature_names, tagset, constraints, decoder = _predict_worker['args']
+    if decoder is None:
+        return predict_batch(chunk, parameters, feature_names, tagset, constraints)
+    return [predict(inputs, len(inputs['tokens']), parameters, feature_names, tagset, constraints, decoder) for inputs in chunk]
+
+def predict_all(data, parameters, feature_names, tagset, processes=None, chunksize=64, constraints=None, decoder=None):
+    """
+    Predicts the tag sequences of all the sentences in data.
+    :param data: Array of dictionaries, as returned by read_data
+    :param parameters: FeatureVector.  The model parameters
+    :param feature_names: Array of Strings.  The list of features.
+    :param tagset: Array of Strings.  The list of tags.
+    :param processes: Int or None.  Number of worker processes.  None or 1 decodes in this process.  The model is
+        sent to each worker once, when the pool starts.
+    :param chunksize: Int.  Number of sentences sent to a worker at a time
+    :param constraints: Tuple of (allowed, allowed_start) as returned by decode.allowed_transitions, or None
+    :param decoder: Function with the arguments of decode.viterbi, or None for viterbi.  See predict.  Only exact
+        viterbi decodes in batches (see predict_batch); other decoders go one sentence at a time.
+    :return: Array of tag sequences (including <START> and <STOP>), in the order of data
+    """
+    if not processes or processes == 1 or len(data) <= chunksize:
+        if decoder is None:
+            return predict_batch(data, parameters, feature_names, tagset, constraints)
+        return [predict(inputs, len(inputs['tokens']), parameters, feature_names, tagset, constraints, decoder) for inputs in data]
+
+    order = sorted(range(len(data)), key=lambda d: len(data[d]['tokens']))  # chunks of similar lengths batch better
+    chunks = [[data[d] for d in order[i:i+chunksize]] for i in range(0, len(order), chunksize)]
+    with multiprocessing.Pool(processes, initializer=_init_predict_worker, initargs=(parameters, feature_names, tagset, constraints, decoder)) as pool:
+        results = pool.map(_predict_chunk, chunks, chunksize=1)
+    tag_seqs = [None]*len(data)
+    for d, tag_seq in zip(order, (tag_seq for chunk in results for tag_seq in chunk)):
+        tag_seqs[d] = tag_seq
+    return tag_seqs
+
+def predict_stream(data, parameters, feature_names, tagset, processes=None, chunksize=64, max_pending=4, constraints=None, decoder=None):
+    """
+    Predicts the tag sequences of a stream of sentences, yielding them in order as they are decoded.  At most
+    max_pending chunks per worker are read ahead, so memory does not grow with the length of the stream.
+    :param data: Iterable of dictionaries, as yielded by iter_data
+    :param parameters: FeatureVector.  The model parameters
+    :param feature_names: Array of Strings.  The list of features.
+    :param tagset: Array of Strings.  The list of tags.
+    :param processes: Int or None.  Number of worker processes.  None or 1 decodes in this process.
+    :param chunksize: Int.  Number of sentences sent to a worker at a time
+    :param max_pending: Int.  Number of chunks per worker that are read ahead
+    :param constraints: Tuple of (allowed, allowed_start) as returned by decode.allowed_transitions, or None
+    :param decoder: Function with the arguments of decode.viterbi, or None for viterbi.  See predict
+    :return: Generator of tuples (inputs, tag_seq)
+    """
+    if not processes or processes == 1:
+        for inputs in data:
+            yield inputs, predict(inputs, len(inputs['tokens']), parameters, feature_names, tagset, constraints, decoder)
+        return
+
+    data = iter(data)
+    with multiprocessing.Pool(processes, initializer=_init_predict_worker, initargs=(parameters, feature_names, tagset, constraints, decoder)) as pool:
+        pending = collections.deque()   # Pool.imap would read the whole input ahead, so chunks are submitted by hand
+        while True:
+            while len(pending) < max_pending*processes:
+                chunk = list(itertools.islice(data, chunksize))
+                if not chunk:
+                    break
+                pending.append((chunk, pool.apply_async(_predict_chunk, (chunk,))))
+            if not pending:
+                return
+            chunk, result = pending.popleft()
+            for inputs, tag_seq in zip(chunk, result.get()):
+                yield inputs, tag_seq
+
+def compare_decoders(data, parameters, feature_names, tagset, decoder, constraints=None):
+    """
+    Decodes every sentence with viterbi and with decoder, on the same score matrices, and reports how often and by how
+    much the results differ and how long each decoder took
+    :param data: Array of dictionaries, as returned by read_data
+    :param parameters: FeatureVector.  The model parameters
+    :param feature_names: Array of Strings.  The list of features.
+    :param tagset: Array of Strings.  The list of tags.
+    :param decoder: Function with the arguments of decode.viterbi, e.g. a decode.BeamDecoder
+    :param constraints: Tuple of (allowed, allowed_start) as returned by decode.allowed_transitions, or None
+    :return: Dictionary with the fraction of sentences and of tokens where the results differ, and the seconds spent
+        in viterbi and in decoder
+    """
+    n_differ = n_tokens = n_token_differ = 0
+    viterbi_seconds = decoder_seconds = 0.0
+    for inputs in data:
+        input_len = len(inputs['tokens'])
+        matrices = compute_score_matrices(Features(inputs, feature_names), input_len, parameters, tagset)
+        start = time.perf_counter()
+        exact = viterbi(*matrices, tagset, constraints)
+        viterbi_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        approximate = decoder(*matrices, tagset, constraints)
+        decoder_seconds += time.perf_counter() - start
+        n_differ += exact != approximate
+        n_tokens += input_len-2
+        n_token_differ += sum(a != b for a, b in zip(exact[1:-1], approximate[1:-1]))
+    return {'sentences': len(data),
+            'differ_rate': n_differ / len(data) if data else 0.0,
+            'token_differ_rate': n_token_differ / n_tokens if n_tokens else 0.0,
+            'viterbi_seconds': viterbi_seconds,
+            'decoder_seconds': decoder_seconds}
 
 
 def make_data_point(sent):
@@ -38,26 +371,122 @@ def make_data_point(sent):
     dic['gold_tags'] = ['<START>'] + [s[3] for s in sent] + ['<STOP>']
     return dic
 
-def read_data(filename):
+def iter_data(filename):
     """
-    Reads the CoNLL 2003 data into an array of dictionaries (a dictionary for each data point).
-    :param filename: String
-    :return: Array of dictionaries.  Each dictionary has the format returned by the make_data_point function.
+    Reads the CoNLL 2003 data one sentence at a time.  Blank lines separate sentences; runs of blank lines, or a blank
+    line at the end of the file, do not make empty sentences.
+    :param filename: String.  '-' reads from stdin
+    :return: Generator of dictionaries.  Each dictionary has the format returned by the make_data_point function.
     """
-    data = []
-    with open(filename, 'r') as f:
+    f = sys.stdin if filename == '-' else open(filename, 'r')
+    try:
         sent = []
-        for line in f.readlines():
+        for line in f:
             if line.strip():
                 sent.append(line)
-            else:
-                data.append(make_data_point(sent))
+            elif sent:
+                yield make_data_point(sent)
                 sent = []
-        data.append(make_data_point(sent))
+        if sent:
+            yield make_data_point(sent)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def read_data(filename):
+    """
+    Reads the CoNLL 2003 data into an array of dictionaries (a dictionary for each data point).
+    :param filename: String
+    :return: Array of dictionaries.  Each dictionary has the format returned by the make_data_point function.
+    """
+    return list(iter_data(filename))
+
+def compile_data(data, feature_names, index, tagset, add=True):
+    """
+    Compiles the features of every sentence once, see CompiledFeatures
+    :param data: Array of dictionaries, as returned by read_data
+    :param feature_names: Array of Strings.  The list of features.
+    :param index: FeatureIndex.  Shared by all the sentences
+    :param tagset: Array of Strings.  The list of tags.
+    :param add: Boolean.  Whether to add unseen observations to the index
+    :return: Array of CompiledFeatures
+    """
+    with profiling.timer('feature_extraction'):
+        return [CompiledFeatures(inputs, feature_names, index, tagset, add) for inputs in data]
 
-    return data
+def count_observations(data, feature_names):
+    """
+    Counts the observation features along the gold tag sequences, i.e. how often each feature of the model fires on
+    the training data
+    :param data: Array of dictionaries, as returned by read_data
+    :param feature_names: Array of Strings.  The list of features.
+    :return: Counter from observation (String) to count, in the order the observations are first seen
+    """
+    counts = collections.Counter()
+    for inputs in data:
+        features, tags = Features(inputs, feature_names), inputs['gold_tags']
+        for i in range(1, len(tags)-1):   # the features of <STOP> never take part in decoding
+            counts.update(features.emission_observations(tags[i], i))
+            counts.update(features.transition_observations(tags[i-1], i))
+    return counts
+
+def selected_index(counts, min_count):
+    """
+    :param counts: Counter, as returned by count_observations
+    :param min_count: Int.  Observations seen fewer times are left out
+    :return: FeatureIndex of the observations seen at least min_count times, in the order of counts
+    """
+    index = FeatureIndex()
+    for observation, count in counts.items():
+        if count >= min_count:
+            index.lookup(observation)
+    return index
+
+def load_compiled_data(filename, feature_names, tagset, n_buckets=None, cache_dir=None, min_count=None):
+    """
+    Reads and compiles a data file.  With cache_dir set, the result is pickled there keyed by a hash of the file, the
+    feature names, the tagset, n_buckets, min_count, the gazetteer (path, modification time and size) and
+    COMPILED_FORMAT_VERSION, and loaded from there next time.
+    :param filename: String
+    :param feature_names: Array of Strings.  The list of features.
+    :param tagset: Array of Strings.  The list of tags.
+    :param n_buckets: Int or None.  See FeatureIndex
+    :param cache_dir: String or None.
+    :param min_count: Int or None.  Only keep the observations seen at least min_count times in the data, see
+        count_observations.  Cannot be used with n_buckets.
+    :return: Tuple of (data, compiled) where data is as returned by read_data and compiled an Array of CompiledFeatures
+    """
+    data = read_data(filename)
+    cache_filename = None
+    if cache_dir is not None:
+        key = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            key.update(f.read())
+        key.update(repr((COMPILED_FORMAT_VERSION, list(feature_names), list(tagset), n_buckets, min_count)).encode('utf-8'))
+        if 'gazetteer' in feature_names or 'gazetteer_spans' in feature_names:
+            path = os.path.abspath(gazetteer_path())
+            stat = os.stat(path)
+            key.update(repr((path, stat.st_mtime_ns, stat.st_size)).encode('utf-8'))
+        cache_filename = os.path.join(cache_dir, os.path.basename(filename)+'.'+key.hexdigest()+'.pkl')
+        if os.path.exists(cache_filename):
+            with open(cache_filename, 'rb') as f:
+                return data, pickle.load(f)
+
+    if min_count:
+        if n_buckets:
+            raise ValueError('min_count cannot be used with hashed features')
+        compiled = compile_data(data, feature_names, selected_index(count_observations(data, feature_names), min_count), tagset, add=False)
+    else:
+        compiled = compile_data(data, feature_names, FeatureIndex(n_buckets), tagset)
+    if cache_filename is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # written to a temporary file first, so that a crash never leaves a truncated cache behind
+        with open(cache_filename + '.' + str(os.getpid()), 'wb') as f:
+            pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_filename + '.' + str(os.getpid()), cache_filename)
+    return data, compiled
 
-def write_predictions(out_filename, all_inputs, parameters, feature_names, tagset):
+def write_predictions(out_filename, all_inputs, parameters, feature_names, tagset, processes=None):
     """
     Writes the predictions on all_inputs to out_filename, in CoNLL 2003 evaluation format.
     Each line is token, pos, NP_chuck_tag, gold_tag, predicted_tag (separated by spaces)
@@ -68,17 +497,36 @@ def write_predictions(out_filename, all_inputs, parameters, feature_names, tagse
     :param parameters:
     :param feature_names:
     :param tagset:
+    :param processes: Int or None.  Number of worker processes, see predict_all
     :return:
     """
+    write_tag_sequences(out_filename, all_inputs, predict_all(all_inputs, parameters, feature_names, tagset, processes))
+
+def write_tag_sequences(out_filename, all_inputs, tag_seqs):
+    """
+    Writes already predicted tag sequences to out_filename, in the format of write_predictions
+    :param out_filename: filename of the output
+    :param all_inputs: Array of dictionaries, as returned by read_data
+    :param tag_seqs: Array of tag sequences including <START> and <STOP>, one for each element of all_inputs
+    :return: None
+    """
     with open(out_filename, 'w', encoding='utf-8') as f:
-        for inputs in all_inputs:
-            input_len = len(inputs['tokens'])
-            tag_seq = predict(inputs, input_len, parameters, feature_names, tagset)
-            for i, tag in enumerate(tag_seq[1:-1]):  # deletes <START> and <STOP>
-                f.write(' '.join([inputs['tokens'][i+1], inputs['pos'][i+1], inputs['NP_chunk'][i+1], inputs['gold_tags'][i+1], tag])+'\n') # i + 1 because of <START>
-            f.write('\n')
+        for inputs, tag_seq in zip(all_inputs, tag_seqs):
+            write_tag_sequence(f, inputs, tag_seq)
+
+def write_tag_sequence(f, inputs, tag_seq):
+    """
+    Writes the predicted tag sequence of one sentence to an open file, in the format of write_predictions
+    :param f: File
+    :param inputs: Dictionary, as returned by make_data_point
+    :param tag_seq: Array of Strings.  The tag sequence including <START> and <STOP>
+    :return: None
+    """
+    for i, tag in enumerate(tag_seq[1:-1]):  # deletes <START> and <STOP>
+        f.write(' '.join([inputs['tokens'][i+1], inputs['pos'][i+1], inputs['NP_chunk'][i+1], inputs['gold_tags'][i+1], tag])+'\n') # i + 1 because of <START>
+    f.write('\n')
 
-def evaluate(data, parameters, feature_names, tagset):
+def evaluate(data, parameters, feature_names, tagset, processes=None):
     """
     Evaluates precision, recall, and F1 of the tagger compared to the gold standard in the data
     :param data: Array of dictionaries representing the data.  One dictionary for each data point (as created by the
@@ -86,15 +534,23 @@ def evaluate(data, parameters, feature_names, tagset):
     :param parameters: FeatureVector.  The model parameters
     :param feature_names: Array of Strings.  The list of features.
     :param tagset: Array of Strings.  The list of tags.
+    :param processes: Int or None.  Number of worker processes, see predict_all
     :return: Tuple of (prec, rec, f1)
     """
-    all_gold_tags = [ ]
-    all_predicted_tags = [ ]
-    for inputs in data:
-        all_gold_tags.extend(inputs['gold_tags'][1:-1])  # deletes <START> and <STOP>
-        input_len = len(inputs['tokens'])
-        all_predicted_tags.extend(predict(inputs, input_len, parameters, feature_names, tagset)[1:-1]) # deletes <START> and <STOP>
-    return conllevaluate(all_gold_tags, all_predicted_tags)
+    return evaluate_tag_sequences(data, predict_all(data, parameters, feature_names, tagset, processes))
+
+def evaluate_tag_sequences(data, tag_seqs):
+    """
+    Evaluates already predicted tag sequences against the gold standard in the data
+    :param data: Array of dictionaries, as returned by read_data
+    :param tag_seqs: Array of tag sequences including <START> and <STOP>, one for each element of data
+    :return: Tuple of (prec, rec, f1)
+    """
+    with profiling.timer('evaluation'):
+        counter = ChunkCounter()
+        for inputs, tag_seq in zip(data, tag_seqs):
+            counter.update(inputs['gold_tags'][1:-1], tag_seq[1:-1])  # deletes <START> and <STOP>
+        return counter.result()
 
 
 def compute_score(tag_seq, input_length, score):
@@ -117,11 +573,18 @@ def compute_features(tag_seq, input_length, features):
     Compute f(xi, yi)
     :param tag_seq: [tags] already padded with <START> and <STOP>
     :param input_length: input length including the padding <START> and <STOP>
-    :param features: func from token index to FeatureVector
+    :param features: func from token index to FeatureVector, or CompiledFeatures
     :return:
     """
-    feats = FeatureVector({})
-    for i in range(1, input_length):
-        feats.times_plus_equal(1, features.compute_features(tag_seq[i], tag_seq[i - 1], i))
-    return feats
+    with profiling.timer('feature_extraction'):
+        if isinstance(features, CompiledFeatures):
+            slots, counts = np.unique(features.feature_slots(tag_seq), return_counts=True)
+            feats = FeatureVector(dict(zip(slots.tolist(), counts.tolist())))
+        else:
+            feats = FeatureVector({})
+            for i in range(1, input_length):
+                feats.times_plus_equal(1, features.compute_features(tag_seq[i], tag_seq[i - 1], i))
+        profiling.count('feature_vectors')
+        profiling.count('features', len(feats.fdict))
+        return feats
 
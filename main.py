@@ -3,64 +3,136 @@ import os
 import sys
 import random
 import math
+import contextlib
 
 from train import train
-from helpers import read_data
-from features import FeatureVector
+from helpers import read_data, iter_data, load_compiled_data, predict_all, predict_stream, write_tag_sequences, write_tag_sequence, evaluate_tag_sequences, compare_decoders, TAGSET, FEATURE_NAMES
+from binary_model import read_model, write_binary_model
+from pruning import prune_model
+from decode import allowed_transitions, BeamDecoder
+from conlleval import ChunkCounter
+import profiling
 random.seed(1234)
 
-def main_predict(data_filename, model_filename):
+def main_predict(data_filename, model_filename, processes=None, stream=False, scheme=None, beam_width=None, beam_threshold=None, profile=None, compare_beam=True):
     """
     Main function to make predictions.
     Loads the model file and runs the NER tagger on the data, writing the output in CoNLL 2003 evaluation format to data_filename.out
-    :param data_filename: String
-    :param model_filename: String
+    :param data_filename: String.  '-' reads from stdin (stream mode only)
+    :param model_filename: String.  A text model, or a binary model (see binary_model.py), which is mapped instead of parsed
+    :param processes: Int or None.  Number of worker processes to tag with
+    :param stream: Boolean.  Read, tag and write one sentence at a time, so memory does not grow with the size of the
+        data.  The output goes to stdout if data_filename is '-', and the evaluation, counted as the sentences are
+        tagged, to stderr.
+    :param scheme: String or None.  Rule out the transitions that are invalid in this tagging scheme, see
+        decode.allowed_transitions.  The CoNLL 2003 data is 'iob1'.
+    :param beam_width: Int or None.  Decode with decode.beam_viterbi instead of exact Viterbi
+    :param beam_threshold: Float or None.  Emission score margin of the tags the beam considers, see decode.beam_viterbi
+    :param profile: String or None.  Write the time spent in each stage and the counters of profiling.py to this JSON
+        file.  Only covers this process, so leave processes unset to profile decoding.
+    :param compare_beam: Boolean.  With beam_width, report how often the beam result differs from exact Viterbi.  The
+        data is scored again and decoded both ways in this process (see helpers.compare_decoders).  In stream mode
+        every 10th sentence is decoded exactly as well instead, which needs processes unset.
     :return: None
     """
-    data = read_data(data_filename)
-    parameters = FeatureVector({})
-    parameters.read_from_file(model_filename)
-
-    tagset = ['B-PER', 'B-LOC', 'B-ORG', 'B-MISC', 'I-PER', 'I-LOC', 'I-ORG', 'I-MISC', 'O']
-
-    feature_names = ['current_word', 'prev_tag', 'lowercase','current_pos_tag','shape',
-        'prev_next_word_features','word_lower_pos','length_k','gazetteer','uppercase','position' ]
-    
-    write_predictions(data_filename+'.out', data, parameters, feature_names, tagset)
-    evaluate(data, parameters, feature_names, tagset)
-
+    if profile:
+        profiling.enable()
+    tagset = TAGSET
+
+    parameters = read_model(model_filename, tagset)
+
+    feature_names = FEATURE_NAMES
+    constraints = allowed_transitions(tagset, scheme) if scheme else None
+    decoder = BeamDecoder(beam_width, beam_threshold, check_every=10 if compare_beam and stream else 0) if beam_width else None
+
+    if stream:
+        f = sys.stdout if data_filename == '-' else open(data_filename+'.out', 'w', encoding='utf-8')
+        counter = ChunkCounter()
+        try:
+            for inputs, tag_seq in predict_stream(iter_data(data_filename), parameters, feature_names, tagset, processes, constraints=constraints, decoder=decoder):
+                write_tag_sequence(f, inputs, tag_seq)
+                counter.update(inputs['gold_tags'][1:-1], tag_seq[1:-1])
+        finally:
+            if f is not sys.stdout:
+                f.close()
+        with contextlib.redirect_stdout(sys.stderr if f is sys.stdout else sys.stdout):
+            counter.result()
+            if decoder is not None and compare_beam:
+                if processes and processes > 1:
+                    print('Beam decoding: not compared to exact Viterbi, the sentences were decoded in worker processes')
+                else:
+                    print('Beam decoding, every 10th sentence also decoded exactly:', decoder.stats())
+    else:
+        data = read_data(data_filename)
+        tag_seqs = predict_all(data, parameters, feature_names, tagset, processes, constraints=constraints, decoder=decoder)
+        write_tag_sequences(data_filename+'.out', data, tag_seqs)
+        evaluate_tag_sequences(data, tag_seqs)
+        if decoder is not None and compare_beam:
+            print('Beam decoding, all sentences decoded again both ways:',
+                  compare_decoders(data, parameters, feature_names, tagset, BeamDecoder(beam_width, beam_threshold), constraints))
+
+    if profile:
+        profiling.write(profile)
     return
 
 
-def main_train(method='structured_perceptron',optimizer='sgd',step_size=1.0, l2=None, epochs=20, is_only_four_features=False):
+def main_train(method='structured_perceptron',optimizer='sgd',step_size=1.0, l2=None, epochs=20, is_only_four_features=False, n_buckets=None, cache_dir=None, processes=None, parallel=None, batch_size=64, scheme=None, beam_width=None, beam_threshold=None, profile=None, min_count=None, prune_threshold=None):
     """
     Main function to train the model
+    :param n_buckets: Int or None.  Hash features into this many ids instead of interning them
+    :param cache_dir: String or None.  Directory to cache the compiled training features in
+    :param processes: Int or None.  Number of worker processes used to evaluate on dev and test, and to train with
+    :param parallel: String or None.  Parallel training mode, 'minibatch' or 'mixing' (see train.train)
+    :param batch_size: Int.  Batch size for parallel='minibatch'
+    :param scheme: String or None.  Constrained decoding during training and evaluation, see train.train
+    :param beam_width: Int or None.  Decode with decode.beam_viterbi instead of exact Viterbi during training and
+        evaluation.  Every 10th sentence is also decoded exactly to report how often the beam differs, counting the
+        sentences decoded in this process: not the gradients of parallel training, nor the evaluation with processes.
+    :param beam_threshold: Float or None.  See decode.beam_viterbi
+    :param profile: String or None.  Write the time spent in each stage, the counters and the model size after each
+        epoch (see profiling.py) to this JSON file.  With parallel set, the gradients computed by the workers are not
+        included.
+    :param min_count: Int or None.  Leave out the observation features seen fewer than min_count times in the training
+        data before training (see helpers.count_observations)
+    :param prune_threshold: Float or None.  After training, drop the weights with a magnitude of at most
+        prune_threshold and write the compacted model to outputs/model.pruned (binary, see pruning.py)
     :return: None
     """
+    if profile:
+        profiling.enable()
+    tagset = TAGSET
+    feature_names = FEATURE_NAMES
+
+    decoder = BeamDecoder(beam_width, beam_threshold, check_every=10) if beam_width else None
+
+    if is_only_four_features:
+        feature_names = feature_names[:4]
+
     print('Reading training data')
-    train_data = read_data('ner.train')
+    train_data, compiled = load_compiled_data('ner.train', feature_names, tagset, n_buckets=n_buckets, cache_dir=cache_dir, min_count=min_count)
     # train_data = read_data('ner.train')[:2]
 
     print ('Size of training data: ', len(train_data))
     #train_data = read_data('ner.train')[1:1] # if you want to train on just one example
 
-    tagset = ['B-PER', 'B-LOC', 'B-ORG', 'B-MISC', 'I-PER', 'I-LOC', 'I-ORG', 'I-MISC', 'O']
-    feature_names = ['current_word', 'prev_tag', 'lowercase','current_pos_tag','shape',
-        'prev_next_word_features','word_lower_pos','length_k','gazetteer','uppercase','position' ]
-    
     print('Training...')
 
-    if is_only_four_features:
-        feature_names = feature_names[:4]
-
     if method=='structured_perceptron':
-        parameters = train(train_data, feature_names, tagset, epochs=20, method='structured_perceptron', optimizer=optimizer, step_size=step_size, l2=l2)
+        parameters = train(train_data, feature_names, tagset, epochs=20, method='structured_perceptron', optimizer=optimizer, step_size=step_size, l2=l2, n_buckets=n_buckets, compiled=compiled, processes=processes, parallel=parallel, batch_size=batch_size, scheme=scheme, decoder=decoder)
+    if method=='averaged_perceptron':
+        parameters = train(train_data, feature_names, tagset, epochs=20, method='averaged_perceptron', optimizer='sgd', step_size=step_size, l2=l2, n_buckets=n_buckets, compiled=compiled, processes=processes, parallel=parallel, batch_size=batch_size, scheme=scheme, decoder=decoder)
     if method=='svm':
-        parameters = train(train_data, feature_names, tagset, epochs=20,  method='svm', optimizer='svm', step_size=step_size, l2=l2)
+        parameters = train(train_data, feature_names, tagset, epochs=20,  method='svm', optimizer='svm', step_size=step_size, l2=l2, n_buckets=n_buckets, compiled=compiled, processes=processes, parallel=parallel, batch_size=batch_size, scheme=scheme, decoder=decoder)
     if method=='svm_modified':
-        parameters = train(train_data, feature_names, tagset, epochs=20,  method='svm_modified', optimizer='svm', step_size=step_size, l2=l2)
+        parameters = train(train_data, feature_names, tagset, epochs=20,  method='svm_modified', optimizer='svm', step_size=step_size, l2=l2, n_buckets=n_buckets, compiled=compiled, processes=processes, parallel=parallel, batch_size=batch_size, scheme=scheme, decoder=decoder)
 
     print('Training done')
+    if prune_threshold is not None:
+        pruned = prune_model(parameters, prune_threshold)
+        print('Pruned %d weights to %d' % (len(parameters.fdict), len(pruned.fdict)))
+        write_binary_model(pruned, 'outputs/model.pruned')
+    if profile:
+        profiling.write(profile)
 
     # dev_data = read_data('ner.dev')
     # evaluate(dev_data, parameters, feature_names, tagset)
@@ -82,6 +154,8 @@ if __name__ == '__main__':
 
     # main_train(method='structured_perceptron',optimizer='adagrad',step_size=1.0, l2=None, epochs=20, is_only_four_features=False)
 
+    # main_train(method='averaged_perceptron',optimizer='sgd',step_size=1.0, l2=None, epochs=20, is_only_four_features=False)
+
     # print ('\n\n','='*20)
     main_train(method='svm',optimizer='svm',step_size=1.0, l2=0.0001, epochs=10, is_only_four_features=False)
 
@@ -1,6 +1,23 @@
+import math
+import multiprocessing
+
+import numpy as np
 from tqdm import tqdm
-from features import FeatureVector
+from features import FeatureVector, ScaledFeatureVector, WeightMatrix, WeightCheckpoint
 from copy import deepcopy
+import profiling
+
+def l2_decay(parameters, decay):
+    """
+    w = w - decay*w.  O(1) for a ScaledFeatureVector, otherwise touches every weight.
+    :param parameters: FeatureVector
+    :param decay: Double.  Step size times regularization strength
+    :return: None
+    """
+    if isinstance(parameters, ScaledFeatureVector):
+        parameters.rescale(1-decay)
+    else:
+        parameters.times_plus_equal(-decay, deepcopy(parameters))
 
 def sgd_optimizer(training_size, epochs, gradient, parameters, training_observer):
     """
@@ -18,26 +35,29 @@ def sgd_optimizer(training_size, epochs, gradient, parameters, training_observer
     # To implement early stopping you can call the function training_observer at the end of each epoch.
     max_patience = 3
     best_f1 = float('-inf')
-    best_parameters = None
+    checkpoint = WeightCheckpoint(parameters) # the parameters of the best epoch so far
     patience = 0
 
     for epoch in range(epochs):
         # print ('Hello')
         print ('-'*20,'Epoch:',epoch+1,'-'*20)
         for i in tqdm(range(training_size)):
-            parameters.times_plus_equal(-1,gradient(i))
+            gradient_t = gradient(i)
+            with profiling.timer('update'):
+                checkpoint.record(gradient_t)
+                parameters.times_plus_equal(-1,gradient_t)
 
         cur_f1 = training_observer(epoch, parameters)
         if cur_f1 > best_f1:
             best_f1 = cur_f1
-            best_parameters = parameters
+            checkpoint.commit()
             patience = 0
         else:
             patience +=1
             if patience > max_patience:
-                return best_parameters
+                return checkpoint.restore()
 
-    return best_parameters
+    return checkpoint.restore()
 
 def svm_optimizer(training_size, epochs, gradient, parameters, training_observer, alpha=1.0, lamda=0.0):
     """
@@ -50,13 +70,14 @@ def svm_optimizer(training_size, epochs, gradient, parameters, training_observer
            epoch to evaluate on a dev set and write out the model parameters for early stopping.
 
     :param alpha: step size
-    :param lamda: regularization strength
+    :param lamda: regularization strength.  The regularization is lazy (each step touches only the features in the
+           gradient) when parameters is a ScaledFeatureVector
     :return: final parameters
     """
 
     max_patience = 3
     best_f1 = float('-inf')
-    best_parameters = None
+    checkpoint = WeightCheckpoint(parameters) # the parameters of the best epoch so far
     patience = 0
     print (f'--------- Stepsize: {alpha}, lambda: {lamda} ---------')
 
@@ -65,13 +86,68 @@ def svm_optimizer(training_size, epochs, gradient, parameters, training_observer
         
         for i in tqdm(range(training_size)):
 
-            parameters.times_plus_equal(-alpha, gradient(i)) # w - α g
-            parameters.times_plus_equal(-alpha*lamda, deepcopy(parameters)) # # w - αg - αλw
+            gradient_t = gradient(i)
+            with profiling.timer('update'):
+                checkpoint.record(gradient_t)
+                parameters.times_plus_equal(-alpha, gradient_t) # w - α g
+                if lamda:
+                    checkpoint.record_all()
+                    l2_decay(parameters, alpha*lamda) # # w - αg - αλw
 
         cur_f1 = training_observer(epoch, parameters)
         if cur_f1 > best_f1:
             best_f1 = cur_f1
-            best_parameters = parameters
+            checkpoint.commit()
+            patience = 0
+        else:
+            patience +=1
+            if patience > max_patience:
+                return checkpoint.restore()
+
+    return checkpoint.restore()
+
+def averaged_perceptron_optimizer(training_size, epochs, gradient, parameters, training_observer):
+    """
+    Averaged structured perceptron: SGD with step size 1, evaluating and returning the average of the parameters over
+    all the steps so far.  The average is kept lazily: each feature remembers the step at which its running total was
+    last brought up to date, so a step only touches the features in its gradient.
+    :param training_size: int. Number of examples in the training set
+    :param epochs: int. Number of epochs to run SGD for
+    :param gradient: func from index (int) in range(training_size) to a FeatureVector of the gradient
+    :param parameters: FeatureVector.  Initial parameters.  Should be updated while training
+    :param training_observer: func that takes epoch and parameters.  You can call this function at the end of each
+           epoch to evaluate on a dev set and write out the model parameters for early stopping.
+    :return: final averaged parameters
+    """
+    max_patience = 3
+    best_f1 = float('-inf')
+    best_parameters = None
+    patience = 0
+    totals = {} # feature -> sum of its weight over steps 1..stamps[feature]
+    stamps = {}
+    step = 0
+
+    for epoch in range(epochs):
+        print ('-'*20,'Epoch:',epoch+1,'-'*20)
+        for i in tqdm(range(training_size)):
+            step += 1
+            gradient_t = gradient(i)
+            with profiling.timer('update'):
+                for key in gradient_t.fdict:
+                    # the current weight has been in place since the last update of this feature
+                    totals[key] = totals.get(key, 0) + (step-1-stamps.get(key, 0)) * parameters.fdict.get(key, 0)
+                    stamps[key] = step-1
+                parameters.times_plus_equal(-1, gradient_t)
+
+        with profiling.timer('update'):
+            averaged = deepcopy(parameters)
+            for key, total in totals.items():
+                averaged.fdict[key] = (total + (step-stamps[key]) * parameters.fdict.get(key, 0)) / step
+
+        cur_f1 = training_observer(epoch, averaged)
+        if cur_f1 > best_f1:
+            best_f1 = cur_f1
+            best_parameters = averaged
             patience = 0
         else:
             patience +=1
@@ -80,6 +156,37 @@ def svm_optimizer(training_size, epochs, gradient, parameters, training_observer
 
     return best_parameters
 
+def adagrad_step(parameters, gradient_matrix, gradient_t):
+    """
+    One Adagrad update, done in place in a single pass over the non-zero entries of the gradient:
+    s_{t,i} = s_{t-1,i} + g_{t,i}^2 and θ_{t,i} = θ_{t-1,i} - g_{t,i} / sqrt(s_{t,i})
+    :param parameters: FeatureVector.  θ
+    :param gradient_matrix: Dictionary or WeightMatrix.  s, the running sum of squared gradients
+    :param gradient_t: FeatureVector.  g_t
+    :return: None
+    """
+    weights = parameters.fdict
+    if isinstance(weights, WeightMatrix) and isinstance(gradient_matrix, WeightMatrix) and \
+            all(isinstance(key, int) for key in gradient_t.fdict):
+        # integer slots: vectorized update of both matrices
+        slots = np.fromiter(gradient_t.fdict.keys(), dtype=np.int64, count=len(gradient_t.fdict))
+        if not len(slots):
+            return
+        values = np.fromiter(gradient_t.fdict.values(), dtype=np.float64, count=len(slots))
+        n_features = int(slots.max()) // len(weights.tagset) + 1
+        weights.reserve(n_features)
+        gradient_matrix.reserve(n_features)
+        squares = gradient_matrix.weights.ravel()[slots] + values**2
+        gradient_matrix.weights.ravel()[slots] = squares
+        steps = np.zeros(len(slots))
+        np.divide(values, np.sqrt(squares), out=steps, where=squares != 0)
+        weights.weights.ravel()[slots] -= steps
+        return
+
+    for key, value in gradient_t.fdict.items():
+        square = gradient_matrix[key] = value**2 + gradient_matrix.get(key, 0)
+        weights[key] = -(value / math.sqrt(square) if square != 0 else 0) + weights.get(key, 0)
+
 def adagrad_optimizer(training_size, epochs, gradient, parameters, training_observer):
     """
     Adagrad
@@ -96,29 +203,223 @@ def adagrad_optimizer(training_size, epochs, gradient, parameters, training_obse
     # To implement early stopping you can call the function training_observer at the end of each epoch.
     max_patience = 3
     best_f1 = float('-inf')
-    best_parameters = None
+    checkpoint = WeightCheckpoint(parameters) # the parameters of the best epoch so far
     patience = 0
-    gradient_matrix = FeatureVector({}) # s
+    if isinstance(parameters.fdict, WeightMatrix): # s, stored the same way as the parameters
+        gradient_matrix = WeightMatrix(parameters.fdict.index, parameters.fdict.tagset)
+    else:
+        gradient_matrix = {}
 
     for epoch in range(epochs):
         print ('-'*20,'Epoch:',epoch+1,'-'*20)
 
         for i in tqdm(range(training_size)):
-            
-            gradient_t = gradient(i) #g_{t,i}
-            gradient_matrix.times_plus_equal(1,gradient_t.square()) # s_{t,i} = s_{t-1,i} + g_{t,i}^2
-            gradient_t_square_running = gradient_matrix.current_params(gradient_t) # get gradient history of only current parameters
-            parameters.times_plus_equal(-1,gradient_t.divide(gradient_t_square_running.square_root()))
-            # print ('PF',parameters.fdict)
+            gradient_t = gradient(i)
+            with profiling.timer('update'):
+                checkpoint.record(gradient_t)
+                adagrad_step(parameters, gradient_matrix, gradient_t)
 
         cur_f1 = training_observer(epoch, parameters)
         if cur_f1 > best_f1:
             best_f1 = cur_f1
-            best_parameters = parameters
+            checkpoint.commit()
             patience = 0
         else:
             patience +=1
             if patience > max_patience:
-                return best_parameters
+                return checkpoint.restore()
 
-    return best_parameters
+    return checkpoint.restore()
+
+def _gradient_worker(connection, gradient, parameters):
+    """
+    Main loop of a GradientWorkers process.  parameters is this process' replica of the model, the same object that
+    gradient reads from.  Each message is (command, delta, decay, indices, alpha, step_decay): the replica is first
+    moved by delta (and decayed, see minibatch_optimizer), then the command runs on the examples in indices.
+    """
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        command, delta, decay, indices, alpha, step_decay = message
+        if delta is not None:
+            parameters.times_plus_equal(1, delta)
+        if decay:
+            l2_decay(parameters, decay)
+
+        change = FeatureVector({})
+        if command == 'gradient':   # sum of the gradients at the current parameters
+            for i in indices:
+                change.times_plus_equal(1, gradient(i))
+        elif command == 'epoch':    # one SGD epoch over the shard, starting from the current parameters
+            # with L2 decay d per step, the replica ends at (1-d)^n w + change, change being decayed along with it
+            change = ScaledFeatureVector({})
+            for i in indices:
+                update = gradient(i)
+                parameters.times_plus_equal(-alpha, update)
+                change.times_plus_equal(-alpha, update)
+                if step_decay:
+                    l2_decay(parameters, step_decay)
+                    change.rescale(1-step_decay)
+            parameters.times_plus_equal(-1, change) # back to the shared parameters, the mixed change comes next message
+            if step_decay and indices:
+                l2_decay(parameters, 1 - (1-step_decay)**-len(indices))
+            change.normalize()
+        connection.send(change)
+
+
+class GradientWorkers(object):
+
+    def __init__(self, processes, gradient, parameters):
+        """
+        Forks worker processes that each keep a replica of the parameters, so the model is copied to them once.  Every
+        call to run sends the same delta to all workers, which keeps the replicas equal to the parameters of the
+        calling process.
+        :param processes: Int.  Number of worker processes
+        :param gradient: func from index (int) to a FeatureVector of the gradient, reading from parameters
+        :param parameters: FeatureVector.  The parameters gradient reads from
+        """
+        context = multiprocessing.get_context('fork')
+        self.connections = []
+        self.workers = []
+        for _ in range(processes):
+            connection, worker_connection = context.Pipe()
+            worker = context.Process(target=_gradient_worker, args=(worker_connection, gradient, parameters), daemon=True)
+            worker.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    def run(self, command, delta, shards, decay=0.0, alpha=1.0, step_decay=0.0):
+        """
+        :param command: String.  'gradient' returns the summed gradient of each shard, 'epoch' trains an SGD epoch on
+            each shard and returns the change it made, without the decay of the parameters the shard started from
+        :param delta: FeatureVector or None.  Update applied to the parameters since the last call
+        :param shards: Array of Arrays of example indices, one for each worker
+        :param decay: Double.  L2 decay applied to the parameters since the last call (w = w - decay*w)
+        :param alpha: Double.  Step size for 'epoch'
+        :param step_decay: Double.  L2 decay after every step of 'epoch'
+        :return: Array of FeatureVectors, one for each shard
+        """
+        for connection, indices in zip(self.connections, shards):
+            connection.send((command, delta, decay, indices, alpha, step_decay))
+        return [connection.recv() for connection in self.connections]
+
+    def close(self):
+        for connection, worker in zip(self.connections, self.workers):
+            connection.send(None)
+            worker.join()
+
+
+def minibatch_optimizer(training_size, epochs, gradient, parameters, training_observer, batch_size=64, processes=2, alpha=1.0, lamda=0.0):
+    """
+    Mini-batch subgradient descent.  The gradients of a batch are computed in parallel by worker processes and summed
+    before one update of the parameters.
+    :param training_size: int. Number of examples in the training set
+    :param epochs: int. Number of epochs
+    :param gradient: func from index (int) in range(training_size) to a FeatureVector of the gradient
+    :param parameters: FeatureVector.  Initial parameters.  Should be updated while training
+    :param training_observer: func that takes epoch and parameters.  You can call this function at the end of each
+           epoch to evaluate on a dev set and write out the model parameters for early stopping.
+    :param batch_size: int. Number of examples in a batch
+    :param processes: int. Number of worker processes
+    :param alpha: step size
+    :param lamda: regularization strength
+    :return: final parameters
+    """
+    max_patience = 3
+    best_f1 = float('-inf')
+    checkpoint = WeightCheckpoint(parameters) # the parameters of the best epoch so far
+    patience = 0
+    print (f'--------- Batch size: {batch_size}, processes: {processes}, stepsize: {alpha}, lambda: {lamda} ---------')
+
+    workers = GradientWorkers(processes, gradient, parameters)
+    delta, decay = None, 0.0
+    try:
+        for epoch in range(epochs):
+            print ('-'*20,'Epoch:',epoch+1,'-'*20)
+
+            for start in tqdm(range(0, training_size, batch_size)):
+                batch = list(range(start, min(start+batch_size, training_size)))
+                gradients = workers.run('gradient', delta, [batch[w::processes] for w in range(processes)], decay)
+                with profiling.timer('update'):
+                    delta = FeatureVector({})
+                    for batch_gradient in gradients:
+                        delta.times_plus_equal(-alpha, batch_gradient) # w - α g
+                    checkpoint.record(delta)
+                    parameters.times_plus_equal(1, delta)
+                    if lamda:
+                        decay = alpha*lamda
+                        checkpoint.record_all()
+                        l2_decay(parameters, decay) # w - αg - αλw
+
+            cur_f1 = training_observer(epoch, parameters)
+            if cur_f1 > best_f1:
+                best_f1 = cur_f1
+                checkpoint.commit()
+                patience = 0
+            else:
+                patience +=1
+                if patience > max_patience:
+                    return checkpoint.restore()
+    finally:
+        workers.close()
+
+    return checkpoint.restore()
+
+def parameter_mixing_optimizer(training_size, epochs, gradient, parameters, training_observer, processes=2, alpha=1.0, lamda=0.0):
+    """
+    Iterative parameter mixing (distributed perceptron).  Each epoch the training set is split into one shard per
+    worker, every worker runs an epoch of SGD on its shard starting from the current parameters, and the parameters
+    are replaced by the average of the workers' parameters.
+    :param training_size: int. Number of examples in the training set
+    :param epochs: int. Number of epochs
+    :param gradient: func from index (int) in range(training_size) to a FeatureVector of the gradient
+    :param parameters: FeatureVector.  Initial parameters.  Should be updated while training
+    :param training_observer: func that takes epoch and parameters.  You can call this function at the end of each
+           epoch to evaluate on a dev set and write out the model parameters for early stopping.
+    :param processes: int. Number of worker processes, and of shards
+    :param alpha: step size
+    :param lamda: regularization strength.  Each worker decays its replica after every step, as svm_optimizer does.
+    :return: final parameters
+    """
+    max_patience = 3
+    best_f1 = float('-inf')
+    checkpoint = WeightCheckpoint(parameters) # the parameters of the best epoch so far
+    patience = 0
+    shards = [list(range(w, training_size, processes)) for w in range(processes)]
+    print (f'--------- Shards: {processes}, stepsize: {alpha}, lambda: {lamda} ---------')
+    # fraction of the starting parameters a worker's epoch decays away, averaged over the shards
+    decay = float(np.mean([1 - (1-alpha*lamda)**len(shard) for shard in shards])) if lamda else 0.0
+
+    workers = GradientWorkers(processes, gradient, parameters)
+    delta = None
+    try:
+        for epoch in range(epochs):
+            print ('-'*20,'Epoch:',epoch+1,'-'*20)
+
+            changes = workers.run('epoch', delta, shards, decay=decay if delta is not None else 0.0, alpha=alpha, step_decay=alpha*lamda)
+            with profiling.timer('update'):
+                # the average of the workers' parameters, (1-decay) w + mean(change), as w + delta decayed by decay
+                delta = FeatureVector({})
+                for change in changes:
+                    delta.times_plus_equal(1.0/processes/(1-decay), change) # uniform mixing weights
+                checkpoint.record(delta)
+                parameters.times_plus_equal(1, delta)
+                if decay:
+                    checkpoint.record_all()
+                    l2_decay(parameters, decay)
+
+            cur_f1 = training_observer(epoch, parameters)
+            if cur_f1 > best_f1:
+                best_f1 = cur_f1
+                checkpoint.commit()
+                patience = 0
+            else:
+                patience +=1
+                if patience > max_patience:
+                    return checkpoint.restore()
+    finally:
+        workers.close()
+
+    return checkpoint.restore()
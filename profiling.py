@@ -0,0 +1,152 @@
+"""
+Instrumentation of training and tagging: time spent in feature extraction, scoring, decoding, updates and
+evaluation, counters such as sentences decoded and features per sentence, and a snapshot per epoch.
+
+Off by default.  When off, timer returns a shared no-op context manager and count returns at once, so the
+instrumented code pays one function call per sentence.  Timers are inclusive and only the outermost of nested timers
+with the same name counts.  Numbers are for this process only; the work of worker processes is not included.
+
+Usage:
+    profiling.enable()
+    ...
+    profiling.write('profile.json')
+"""
+import json
+import time
+from collections import defaultdict
+
+from features import word_cache_info
+
+enabled = False
+_seconds = defaultdict(float)   # timer name -> seconds
+_calls = defaultdict(int)       # timer name -> number of times timed
+_depth = defaultdict(int)       # timer name -> number of open timers of that name
+_counters = defaultdict(int)
+_epochs = []
+_last_epoch = {'seconds': {}, 'counters': {}, 'time': None}
+
+
+def enable(on=True):
+    """
+    Turns the instrumentation on or off.  Turning it on resets everything counted so far.
+    :param on: Boolean
+    :return: None
+    """
+    global enabled
+    if on:
+        reset()
+    enabled = on
+
+
+def reset():
+    _seconds.clear()
+    _calls.clear()
+    _counters.clear()
+    del _epochs[:]
+    _last_epoch.update(seconds={}, counters={}, time=time.perf_counter())
+
+
+class _Timer(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        _depth[self.name] += 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        _depth[self.name] -= 1
+        if not _depth[self.name]:
+            _seconds[self.name] += time.perf_counter() - self.start
+            _calls[self.name] += 1
+        return False
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_null_timer = _NullTimer()
+
+
+def timer(name):
+    """
+    with profiling.timer('decode'): ...
+    :param name: String
+    :return: context manager that adds the time spent in it to the timer name
+    """
+    return _Timer(name) if enabled else _null_timer
+
+
+def count(name, n=1):
+    """
+    Adds n to the counter name
+    :param name: String
+    :param n: Int
+    :return: None
+    """
+    if enabled:
+        _counters[name] += n
+
+
+def start_epoch():
+    """
+    Starts the time and counts of the next epoch now instead of at the previous call of epoch, e.g. to leave out
+    the setup before the first epoch.  The totals keep everything.
+    :return: None
+    """
+    if enabled:
+        _last_epoch.update(seconds=dict(_seconds), counters=dict(_counters), time=time.perf_counter())
+
+
+def epoch(epoch, **values):
+    """
+    Records the time and counts of an epoch, i.e. since the previous call (or start_epoch)
+    :param epoch: Int
+    :param values: more values to record, e.g. model_size
+    :return: None
+    """
+    if not enabled:
+        return
+    now = time.perf_counter()
+    record = {'epoch': epoch, 'seconds': now - _last_epoch['time'],
+              'timers': {name: seconds - _last_epoch['seconds'].get(name, 0.0) for name, seconds in _seconds.items()},
+              'counters': {name: value - _last_epoch['counters'].get(name, 0) for name, value in _counters.items()}}
+    record.update(values)
+    _epochs.append(record)
+    _last_epoch.update(seconds=dict(_seconds), counters=dict(_counters), time=now)
+
+
+def report():
+    """
+    :return: Dictionary with the timers (seconds and calls), the counters, derived averages, the epochs and the hit
+        rates of the word memos of features.py
+    """
+    averages = {}
+    if _counters.get('sentences_decoded'):
+        averages['tokens_per_sentence'] = _counters['tokens_decoded'] / _counters['sentences_decoded']
+    if _counters.get('feature_vectors'):
+        averages['features_per_vector'] = _counters['features'] / _counters['feature_vectors']
+    return {'timers': {name: {'seconds': _seconds[name], 'calls': _calls[name]} for name in sorted(_seconds)},
+            'counters': dict(sorted(_counters.items())),
+            'averages': averages,
+            'epochs': list(_epochs),
+            'word_cache': word_cache_info()}
+
+
+def write(filename):
+    """
+    Writes the report as JSON
+    :param filename: String
+    :return: None
+    """
+    with open(filename, 'w') as f:
+        json.dump(report(), f, indent=2)
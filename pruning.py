@@ -0,0 +1,114 @@
+"""
+Feature selection and model pruning.  Most observation features (e.g. the word_lower_pos conjunctions) occur once or
+twice in the training data, and each of them takes a row of the WeightMatrix and a line of the model file.
+
+    Before training: helpers.count_observations counts every observation on the gold tag sequences of the training
+    data, and helpers.selected_index keeps those that occur at least min_count times.  Compiling the training data
+    with that index (add=False, see load_compiled_data and train) leaves the rest out of the model altogether.
+
+    After training: prune_model drops the weights whose magnitude is at most threshold and compacts the index to the
+    observations that still have a weight, so the written model (text or binary) only holds those.
+
+Usage: python pruning.py <model> [threshold ...]
+    prints the model size, load time, tagging speed and F1 on ner.dev of the model pruned at each threshold
+"""
+import os
+import sys
+import json
+import time
+
+import numpy as np
+
+from features import FeatureVector, ScaledFeatureVector, FeatureIndex, WeightMatrix
+from helpers import read_data, predict_all, TAGSET, FEATURE_NAMES
+from binary_model import read_model, read_binary_model, write_binary_model
+from conlleval import ChunkCounter
+
+
+def prune_model(parameters, threshold=0.0):
+    """
+    Drops the weights with a magnitude of at most threshold.  Unless features are hashed, the result has its own
+    index holding only the observations with a weight left, in the order of the original index.
+    :param parameters: FeatureVector over a WeightMatrix
+    :param threshold: Float.  0 only compacts the index, dropping the observations whose weights are all zero
+    :return: FeatureVector over a WeightMatrix
+    """
+    weights = parameters.fdict
+    scale = parameters.scale if isinstance(parameters, ScaledFeatureVector) else 1.0
+    index = weights.index
+    matrix = scale*np.asarray(weights.weights[:len(index)])
+    matrix = np.where(np.abs(matrix) > threshold, matrix, 0.0)
+
+    if index.n_buckets:
+        pruned = WeightMatrix(FeatureIndex(index.n_buckets), weights.tagset)
+        pruned.weights = matrix
+    else:
+        rows = np.flatnonzero(matrix.any(axis=1))
+        pruned = WeightMatrix(FeatureIndex(), weights.tagset)
+        for fid in rows:
+            pruned.index.lookup(index.observation(int(fid)))
+        pruned.weights = matrix[rows] if len(rows) else np.zeros((1, len(weights.tagset)))
+    pruned.extra = {key: scale*value for key, value in weights.extra.items() if abs(scale*value) > threshold}
+    return FeatureVector(pruned)
+
+
+def prune_report(model_filename, thresholds, data, feature_names, tagset, out_dir='outputs'):
+    """
+    Prunes the model at each threshold and measures what that costs and saves: the number of weights and
+    observations, the size and load time of the text and binary files, the tagging speed and the F1 on data
+    :param model_filename: String.  A text or binary model
+    :param thresholds: Array of Floats.  See prune_model
+    :param data: Array of dictionaries, as returned by read_data
+    :param feature_names: Array of Strings.  The list of features.
+    :param tagset: Array of Strings.  The list of tags.
+    :param out_dir: String.  Directory the pruned models are written to
+    :return: Array of dictionaries, one for each threshold
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    parameters = read_model(model_filename, tagset)
+    n_tokens = sum(len(inputs['tokens'])-2 for inputs in data)
+    report = []
+    for threshold in thresholds:
+        pruned = prune_model(parameters, threshold)
+        text_filename = os.path.join(out_dir, 'model.pruned%g' % threshold)
+        binary_filename = text_filename + '.bin'
+        pruned.write_to_file(text_filename)
+        write_binary_model(pruned, binary_filename)
+
+        start = time.perf_counter()
+        loaded = read_model(text_filename, tagset)
+        text_load = time.perf_counter() - start
+        start = time.perf_counter()
+        read_binary_model(binary_filename)
+        binary_load = time.perf_counter() - start
+
+        start = time.perf_counter()
+        tag_seqs = predict_all(data, loaded, feature_names, tagset)
+        seconds = time.perf_counter() - start
+        counter = ChunkCounter()
+        for inputs, tag_seq in zip(data, tag_seqs):
+            counter.update(inputs['gold_tags'][1:-1], tag_seq[1:-1])
+        _, _, f1 = counter.result(verbose=False)
+
+        report.append({'threshold': threshold, 'weights': len(pruned.fdict), 'observations': len(pruned.fdict.index),
+                       'text_bytes': os.path.getsize(text_filename), 'binary_bytes': os.path.getsize(binary_filename),
+                       'text_load_seconds': text_load, 'binary_load_seconds': binary_load,
+                       'tokens_per_s': n_tokens/seconds, 'f1': f1})
+    return report
+
+
+def print_report(report):
+    print('%9s %9s %12s %11s %11s %10s %10s %10s %7s' % ('threshold', 'weights', 'observations', 'text KB',
+          'binary KB', 'text load', 'bin load', 'tokens/s', 'F1'))
+    for row in report:
+        print('%9g %9d %12d %11.1f %11.1f %9.3fs %9.4fs %10.0f %7.2f' % (row['threshold'], row['weights'],
+              row['observations'], row['text_bytes']/1024, row['binary_bytes']/1024, row['text_load_seconds'],
+              row['binary_load_seconds'], row['tokens_per_s'], row['f1']))
+
+
+if __name__ == '__main__':
+    thresholds = [float(t) for t in sys.argv[2:]] or [0.0, 1.0, 2.0, 5.0]
+    report = prune_report(sys.argv[1], thresholds, read_data('ner.dev'), FEATURE_NAMES, TAGSET)
+    print_report(report)
+    with open('outputs/prune_report.json', 'w') as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,297 @@
+"""
+Tagging server.  Loads the model and the gazetteer once and tags sentences sent over HTTP.
+
+    POST /tag       {"tokens": [...], "pos": [...]}  ->  {"tags": [...]}
+    GET /metrics    request count, batch sizes and p50/p99 latency in milliseconds
+
+Requests that arrive together are decoded as one batch by a single decoding thread: it waits at most max_wait seconds
+for up to max_batch sentences, so a busy server decodes in batches and an idle one answers right away.
+
+Usage: python server.py <model> [port]
+"""
+import sys
+import json
+import time
+import queue
+import threading
+import collections
+import multiprocessing
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+from features import load_gazetteer
+from helpers import predict_batch, iter_data, _init_predict_worker, _predict_chunk, TAGSET, FEATURE_NAMES
+from binary_model import read_model
+
+
+def make_inputs(tokens, pos):
+    """
+    Creates the dictionary of make_data_point for an untagged sentence.  The NP chunks and gold tags are not used by
+    the features and are filled with 'O'.
+    :param tokens: Array of Strings
+    :param pos: Array of Strings.  The POS tags of the tokens
+    :return: Dict from String to Array of Strings.
+    """
+    if len(tokens) != len(pos):
+        raise ValueError('tokens and pos must have the same length')
+    return {'tokens': ['<START>'] + list(tokens) + ['<STOP>'],
+            'pos': ['<START>'] + list(pos) + ['<STOP>'],
+            'NP_chunk': ['<START>'] + ['O']*len(tokens) + ['<STOP>'],
+            'gold_tags': ['<START>'] + ['O']*len(tokens) + ['<STOP>']}
+
+
+class Tagger(object):
+
+    def __init__(self, parameters, feature_names, tagset, max_batch=32, max_wait=0.005, processes=None, window=10000):
+        """
+        Decodes sentences submitted from any thread in micro-batches
+        :param parameters: FeatureVector.  The model parameters
+        :param feature_names: Array of Strings.  The list of features.
+        :param tagset: Array of Strings.  The list of tags.
+        :param max_batch: Int.  Largest number of sentences decoded together
+        :param max_wait: Float.  Seconds to wait for more sentences once the first one of a batch arrived
+        :param processes: Int or None.  Decode the batches with this many worker processes (started once)
+        :param window: Int.  Number of recent requests the latency percentiles are computed over
+        """
+        self.parameters = parameters
+        self.feature_names = feature_names
+        self.tagset = tagset
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.Counter()
+        self.n_requests = 0
+        self.pool = None
+        if processes and processes > 1:
+            self.pool = multiprocessing.Pool(processes, initializer=_init_predict_worker, initargs=(parameters, feature_names, tagset))
+            self.processes = processes
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def tag(self, tokens, pos):
+        """
+        Tags one sentence.  Blocks until its batch is decoded.  Raises ValueError or TypeError for a malformed sentence,
+        before it joins a batch.
+        :param tokens: Array of Strings
+        :param pos: Array of Strings
+        :return: Array of Strings.  The predicted tags, without <START> and <STOP>
+        """
+        for name, values in (('tokens', tokens), ('pos', pos)):
+            if not isinstance(values, list) or not all(isinstance(value, str) and value for value in values):
+                raise TypeError(name + ' must be a list of non-empty strings')
+        if not tokens and not pos:
+            return []
+        request = {'inputs': make_inputs(tokens, pos), 'start': time.perf_counter(), 'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['tags']
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _decode(self, data):
+        if self.pool is None or len(data) == 1:
+            return predict_batch(data, self.parameters, self.feature_names, self.tagset)
+        size = (len(data) + self.processes - 1) // self.processes
+        chunks = [data[i:i+size] for i in range(0, len(data), size)]
+        return [tag_seq for chunk in self.pool.map(_predict_chunk, chunks, chunksize=1) for tag_seq in chunk]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                tag_seqs = self._decode([request['inputs'] for request in batch])
+            except Exception:
+                tag_seqs = None
+            if tag_seqs is None:   # decode one by one, so that a sentence that fails only fails its own request
+                tag_seqs = []
+                for request in batch:
+                    try:
+                        tag_seqs.append(self._decode([request['inputs']])[0])
+                    except Exception as e:
+                        request['error'] = e
+                        tag_seqs.append(None)
+            for request, tag_seq in zip(batch, tag_seqs):
+                if tag_seq is not None:
+                    request['tags'] = tag_seq[1:-1]  # deletes <START> and <STOP>
+            end = time.perf_counter()
+            with self.lock:
+                self.batch_sizes[len(batch)] += 1
+                self.n_requests += len(batch)
+                self.latencies.extend(end - request['start'] for request in batch)
+            for request in batch:
+                request['done'].set()
+
+    def close(self):
+        """
+        Stops the worker processes, if any.  Later batches are decoded in this process.
+        :return: None
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def metrics(self):
+        """
+        :return: Dictionary with the number of requests, the mean batch size and the p50/p99 latency (milliseconds)
+            of the recent requests
+        """
+        with self.lock:
+            latencies = np.array(self.latencies)
+            batches = sum(self.batch_sizes.values())
+            n_requests = self.n_requests
+        return {'requests': n_requests,
+                'batches': batches,
+                'mean_batch_size': n_requests / batches if batches else 0.0,
+                'p50_ms': 1000*float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+                'p99_ms': 1000*float(np.percentile(latencies, 99)) if len(latencies) else 0.0}
+
+
+def make_handler(tagger):
+    """
+    :param tagger: Tagger
+    :return: BaseHTTPRequestHandler subclass serving tagger
+    """
+    class Handler(BaseHTTPRequestHandler):
+
+        def _reply(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._reply(200, tagger.metrics())
+            else:
+                self._reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/tag':
+                self._reply(404, {'error': 'not found'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+                tags = tagger.tag(body['tokens'], body['pos'])
+            except (ValueError, KeyError, TypeError) as e:
+                self._reply(400, {'error': str(e)})
+                return
+            except Exception as e:
+                self._reply(500, {'error': repr(e)})
+                return
+            self._reply(200, {'tags': tags})
+
+        def log_message(self, format, *args):
+            pass    # one line per request is too much under load
+
+    return Handler
+
+
+def make_server(model_filename, port=8000, host='127.0.0.1', max_batch=32, max_wait=0.005, processes=None):
+    """
+    Loads the model and the gazetteer and creates the server without starting it.  Port 0 picks a free port.  The
+    parameters are the ones of serve.
+    :return: ThreadingHTTPServer.  Its tagger attribute is the Tagger
+    """
+    parameters = read_model(model_filename, TAGSET)
+    if 'gazetteer' in FEATURE_NAMES or 'gazetteer_spans' in FEATURE_NAMES:
+        load_gazetteer()    # now rather than on the first request, and before the workers are forked so they share it
+    tagger = Tagger(parameters, FEATURE_NAMES, TAGSET, max_batch, max_wait, processes)
+    server = ThreadingHTTPServer((host, port), make_handler(tagger))
+    server.tagger = tagger
+    return server
+
+
+def serve(model_filename, port=8000, host='127.0.0.1', max_batch=32, max_wait=0.005, processes=None):
+    """
+    Loads the model and serves it until interrupted
+    :param model_filename: String.  A text or binary model
+    :param port: Int
+    :param host: String
+    :param max_batch: Int.  See Tagger
+    :param max_wait: Float.  See Tagger
+    :param processes: Int or None.  See Tagger
+    :return: None
+    """
+    server = make_server(model_filename, port, host, max_batch, max_wait, processes)
+    print('Serving on http://%s:%d' % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.tagger.close()
+
+
+def client_tag(url, tokens, pos):
+    """
+    Stand-in client: tags one sentence with a running server
+    :param url: String.  The server, e.g. 'http://127.0.0.1:8000'
+    :param tokens: Array of Strings
+    :param pos: Array of Strings
+    :return: Array of Strings.  The predicted tags
+    """
+    request = urllib.request.Request(url+'/tag', data=json.dumps({'tokens': tokens, 'pos': pos}).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read().decode('utf-8'))['tags']
+
+
+def client_load_test(url, data_filename, threads=8, limit=None):
+    """
+    Sends the sentences of a CoNLL file to a running server from several threads at once and prints the throughput and
+    the server's metrics
+    :param url: String
+    :param data_filename: String
+    :param threads: Int.  Number of concurrent clients
+    :param limit: Int or None.  Number of sentences to send
+    :return: Array of tag sequences (without <START> and <STOP>), in the order of the file
+    """
+    data = list(iter_data(data_filename))[:limit]
+    results = [None]*len(data)
+    next_sentence = iter(range(len(data)))
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                i = next(next_sentence, None)
+            if i is None:
+                return
+            results[i] = client_tag(url, data[i]['tokens'][1:-1], data[i]['pos'][1:-1])
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=client) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    print('%d sentences in %.2fs (%.1f sentences/s)' % (len(data), elapsed, len(data)/elapsed))
+    with urllib.request.urlopen(url+'/metrics') as response:
+        print(json.loads(response.read().decode('utf-8')))
+    return results
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 8000)
@@ -0,0 +1,40 @@
+"""
+Small random sentences and models for the tests, so that they need neither the CoNLL data nor the gazetteer
+"""
+from features import FeatureVector, FeatureIndex, WeightMatrix
+from helpers import TAGSET
+
+FEATURE_NAMES = ['current_word', 'prev_tag', 'lowercase', 'current_pos_tag', 'shape', 'prev_next_word_features',
+                 'word_lower_pos', 'length_k', 'uppercase', 'position']   # no gazetteer: no file to load
+WORDS = ['EU', 'rejects', 'German', 'call', 'Peter', 'Blackburn', 'to', 'boycott', 'lamb', '.']
+POS = ['NNP', 'VBZ', 'JJ', 'NN', 'TO', '.']
+
+
+def random_data(rng, n_sentences, n_words):
+    """
+    :param rng: random.Random
+    :param n_sentences: Int
+    :param n_words: Int or Tuple of (fewest, most) words
+    :return: Array of dictionaries, as returned by helpers.read_data, with random gold tags
+    """
+    data = []
+    for _ in range(n_sentences):
+        n = n_words if isinstance(n_words, int) else rng.randint(*n_words)
+        tokens = [rng.choice(WORDS) + str(rng.randint(0, 50)) for _ in range(n)]
+        pos = [rng.choice(POS) for _ in range(n)]
+        data.append({'tokens': ['<START>'] + tokens + ['<STOP>'], 'pos': ['<START>'] + pos + ['<STOP>'],
+                     'NP_chunk': ['<START>'] + ['O']*n + ['<STOP>'],
+                     'gold_tags': ['<START>'] + [rng.choice(TAGSET) for _ in range(n)] + ['<STOP>']})
+    return data
+
+
+def random_model(rng, data, n_buckets=None):
+    """
+    :return: FeatureVector over a WeightMatrix with random weights for some word and tag pair features of data
+    """
+    parameters = FeatureVector(WeightMatrix(FeatureIndex(n_buckets), TAGSET))
+    for inputs in data[:20]:
+        for word in inputs['tokens'][1:-1]:
+            parameters.fdict['Wi='+word+'+Ti='+rng.choice(TAGSET)] = rng.uniform(-1, 1)
+            parameters.fdict['Ti='+rng.choice(TAGSET)+'+Ti-1='+rng.choice(TAGSET)] = rng.uniform(-1, 1)
+    return parameters
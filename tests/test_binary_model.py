@@ -0,0 +1,61 @@
+"""
+Checks that a model written as a binary model reads back with the same weights and tags the same
+
+Usage: python -m pytest tests
+"""
+import random
+
+import numpy as np
+
+from binary_model import write_binary_model, read_binary_model, read_model, convert_model, is_binary_model
+from helpers import predict, predict_all, TAGSET
+from synthetic import FEATURE_NAMES, random_data, random_model
+
+
+def text_lines(filename):
+    with open(filename) as f:
+        return sorted(f.read().splitlines())
+
+
+def test_text_binary_text_round_trip(tmp_path):
+    rng = random.Random(0)
+    data = random_data(rng, 50, (1, 20))
+    parameters = random_model(rng, data)
+    parameters.fdict['Ti=<STOP>+Ti-1=O'] = 0.5     # kept outside the matrix
+    text, binary, back = str(tmp_path/'model'), str(tmp_path/'model.bin'), str(tmp_path/'model.txt')
+    parameters.write_to_file(text)
+
+    convert_model(text, binary)
+    assert is_binary_model(binary) and not is_binary_model(text)
+    convert_model(binary, back)
+    assert text_lines(back) == text_lines(text)
+
+    loaded = read_binary_model(binary)
+    assert dict(loaded.fdict.items()) == dict(parameters.fdict.items())
+    assert dict(read_model(text).fdict.items()) == dict(read_model(binary).fdict.items())
+    expected = predict_all(data, parameters, FEATURE_NAMES, TAGSET)
+    assert predict_all(data, loaded, FEATURE_NAMES, TAGSET) == expected
+    assert [predict(inputs, len(inputs['tokens']), loaded, FEATURE_NAMES, TAGSET) for inputs in data] == expected
+
+
+def test_binary_model_is_smaller_than_text(tmp_path):
+    rng = random.Random(1)
+    parameters = random_model(rng, random_data(rng, 50, (1, 20)))
+    parameters.write_to_file(str(tmp_path/'model'))
+    write_binary_model(parameters, str(tmp_path/'model.bin'))
+    assert (tmp_path/'model.bin').stat().st_size < (tmp_path/'model').stat().st_size
+
+
+def test_hashed_and_float32_models(tmp_path):
+    rng = random.Random(2)
+    data = random_data(rng, 30, (1, 20))
+    hashed = random_model(rng, data, n_buckets=64)
+    write_binary_model(hashed, str(tmp_path/'hashed.bin'))
+    loaded = read_binary_model(str(tmp_path/'hashed.bin'))
+    assert np.array_equal(loaded.fdict.weights[:64], hashed.fdict.weights[:64])
+
+    parameters = random_model(rng, data)
+    write_binary_model(parameters, str(tmp_path/'model.bin'), dtype='<f4')
+    loaded = read_binary_model(str(tmp_path/'model.bin'))
+    for key, value in parameters.fdict.items():
+        assert abs(loaded.fdict[key] - value) < 1e-6
@@ -0,0 +1,50 @@
+"""
+Checks that ChunkCounter, fed in pieces and merged from shards, counts the same as conlleval.count_chunks
+
+Usage: python -m pytest tests
+"""
+import random
+
+import pytest
+
+from conlleval import ChunkCounter, count_chunks
+
+TAGS = {'iob': ['O', 'B-PER', 'I-PER', 'B-LOC', 'I-LOC', 'B-MISC', 'I-MISC'],
+        'iobes': ['O', 'B-PER', 'I-PER', 'E-PER', 'S-PER', 'B-LOC', 'I-LOC', 'E-LOC', 'S-LOC']}
+
+
+def random_tags(rng, tags, n, p_o):
+    return ['O' if rng.random() < p_o else rng.choice(tags[1:]) for _ in range(n)]
+
+
+def chunk_counts(counts):
+    return [{key: value for key, value in c.items() if value} for c in counts]
+
+
+def random_split(rng, n, pieces):
+    cuts = sorted(rng.randint(0, n) for _ in range(pieces-1))
+    return list(zip([0] + cuts, cuts + [n]))
+
+
+@pytest.mark.parametrize('scheme', ['iob', 'iobes'])
+@pytest.mark.parametrize('p_o', [0.0, 0.3, 0.7])
+def test_chunk_counter_matches_count_chunks(scheme, p_o):
+    rng = random.Random(len(scheme) + int(10*p_o))
+    for _ in range(30):
+        n = rng.randint(0, 60)
+        true_seqs, pred_seqs = random_tags(rng, TAGS[scheme], n, p_o), random_tags(rng, TAGS[scheme], n, p_o)
+        expected = chunk_counts(count_chunks(true_seqs, pred_seqs))
+
+        counter = ChunkCounter(flush_size=rng.randint(1, 8))
+        for start, end in random_split(rng, n, rng.randint(1, 6)):
+            counter.update(true_seqs[start:end], pred_seqs[start:end])
+        assert chunk_counts(counter.counts()) == expected
+
+        shards = random_split(rng, n, rng.randint(1, 5))
+        counters = [ChunkCounter(shard=s > 0, flush_size=rng.randint(1, 8)) for s in range(len(shards))]
+        for counter, (start, end) in zip(counters, shards):
+            for piece_start, piece_end in random_split(rng, end-start, rng.randint(1, 3)):
+                counter.update(true_seqs[start+piece_start:start+piece_end], pred_seqs[start+piece_start:start+piece_end])
+        for counter in counters[1:]:
+            counters[0].merge(counter)
+        assert chunk_counts(counters[0].counts()) == expected
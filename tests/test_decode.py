@@ -0,0 +1,102 @@
+"""
+Checks of the decoders of decode.py against each other
+
+Usage: python -m pytest tests
+"""
+import random
+
+import numpy as np
+import pytest
+
+from decode import decode, viterbi, viterbi_batch, beam_viterbi, allowed_transitions, BeamDecoder
+from helpers import compare_decoders, TAGSET
+from synthetic import FEATURE_NAMES, random_data, random_model
+
+SCHEMES = [None, 'iob1', 'iob2']
+
+def random_scores(rng, n_words, n_tags):
+    return rng.randn(n_words, n_tags), rng.randn(n_words, n_tags, n_tags), rng.randn(n_tags)
+
+
+def decode_scores(emissions, transitions, start_transitions, tagset, constraints=None):
+    """
+    decode with the score function that the score matrices stand for
+    """
+    tag_ids = {tag: j for j, tag in enumerate(tagset)}
+
+    def score(cur_tag, pre_tag, i):
+        j = tag_ids[cur_tag]
+        if pre_tag == '<START>':
+            return emissions[0, j] + start_transitions[j]
+        return emissions[i-1, j] + transitions[i-1, tag_ids[pre_tag], j]
+
+    return decode(len(emissions)+2, tagset, score, constraints)
+
+
+def allowed_sequence(tag_seq, scheme):
+    allowed, allowed_start = allowed_transitions(TAGSET, scheme)
+    ids = [TAGSET.index(tag) for tag in tag_seq[1:-1]]
+    return allowed_start[ids[0]] and all(allowed[k, j] for k, j in zip(ids, ids[1:]))
+
+
+@pytest.mark.parametrize('scheme', SCHEMES)
+def test_viterbi_matches_decode(scheme):
+    rng = np.random.RandomState(0)
+    constraints = allowed_transitions(TAGSET, scheme) if scheme else None
+    for n_words in list(range(1, 8)) + [25]:
+        matrices = random_scores(rng, n_words, len(TAGSET))
+        expected = decode_scores(*matrices, TAGSET, constraints)
+        assert viterbi(*matrices, TAGSET, constraints) == expected
+        assert scheme is None or allowed_sequence(expected, scheme)
+        transitions = matrices[1][-1]    # position independent transitions
+        assert viterbi(matrices[0], transitions, matrices[2], TAGSET, constraints) == \
+            decode_scores(matrices[0], np.broadcast_to(transitions, matrices[1].shape), matrices[2], TAGSET, constraints)
+
+
+@pytest.mark.parametrize('scheme', SCHEMES)
+def test_beam_viterbi_matches_decode(scheme):
+    # exact once the beam holds every tag
+    rng = np.random.RandomState(2)
+    constraints = allowed_transitions(TAGSET, scheme) if scheme else None
+    for n_words in list(range(1, 8)) + [25]:
+        matrices = random_scores(rng, n_words, len(TAGSET))
+        expected = decode_scores(*matrices, TAGSET, constraints)
+        assert beam_viterbi(*matrices, TAGSET, beam_width=len(TAGSET), constraints=constraints) == expected
+        assert BeamDecoder(len(TAGSET))(*matrices, TAGSET, constraints) == expected
+        narrow = beam_viterbi(*matrices, TAGSET, beam_width=2, threshold=1.0, constraints=constraints)
+        assert len(narrow) == n_words+2 and (scheme is None or allowed_sequence(narrow, scheme))
+
+
+def test_compare_decoders():
+    rng = random.Random(0)
+    data = random_data(rng, 40, (1, 15))
+    parameters = random_model(rng, data)
+    report = compare_decoders(data, parameters, FEATURE_NAMES, TAGSET, BeamDecoder(len(TAGSET)))
+    assert report['sentences'] == len(data) and report['differ_rate'] == 0.0 and report['token_differ_rate'] == 0.0
+    report = compare_decoders(data, parameters, FEATURE_NAMES, TAGSET, BeamDecoder(1))
+    assert 0.0 <= report['token_differ_rate'] <= report['differ_rate'] <= 1.0
+
+
+@pytest.mark.parametrize('scheme', SCHEMES)
+def test_viterbi_batch_matches_decode(scheme):
+    rng = np.random.RandomState(1)
+    constraints = allowed_transitions(TAGSET, scheme) if scheme else None
+    lengths = [1, 4, 9, 2, 9, 13]   # padded to the longest
+    n_tags, max_words = len(TAGSET), max(lengths)
+    emissions, transitions, start_transitions = rng.randn(len(lengths), max_words, n_tags), \
+        rng.randn(len(lengths), max_words, n_tags, n_tags), rng.randn(len(lengths), n_tags)
+    tag_seqs = viterbi_batch(emissions, transitions, start_transitions, lengths, TAGSET, constraints)
+    for b, n_words in enumerate(lengths):
+        expected = decode_scores(emissions[b, :n_words], transitions[b, :n_words], start_transitions[b], TAGSET, constraints)
+        assert tag_seqs[b] == expected
+
+
+def test_viterbi_batch_shared_transitions():
+    # 2-d transitions and start transitions shared by the whole batch
+    rng = np.random.RandomState(3)
+    lengths = [3, 1, 6]
+    n_tags = len(TAGSET)
+    emissions, transitions, start_transitions = rng.randn(len(lengths), max(lengths), n_tags), rng.randn(n_tags, n_tags), rng.randn(n_tags)
+    tag_seqs = viterbi_batch(emissions, transitions, start_transitions, lengths, TAGSET)
+    for b, n_words in enumerate(lengths):
+        assert tag_seqs[b] == viterbi(emissions[b, :n_words], transitions, start_transitions, TAGSET)
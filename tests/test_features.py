@@ -0,0 +1,48 @@
+"""
+Checks of the weight storage of features.py
+
+Usage: python -m pytest tests
+"""
+import copy
+import random
+
+import pytest
+
+from features import FeatureVector, ScaledFeatureVector, FeatureIndex, WeightMatrix, WeightCheckpoint
+from helpers import TAGSET
+from optimizers import l2_decay
+
+
+def random_update(rng, n_keys):
+    observations = ['Wi=w%d+Ti=' % rng.randint(0, 40) for _ in range(n_keys)]
+    fdict = {observation + rng.choice(TAGSET): rng.uniform(-2, 2) for observation in observations}
+    fdict['Ti=<STOP>+Ti-1=' + rng.choice(TAGSET)] = rng.uniform(-2, 2)   # does not fit the matrix, kept in extra
+    return FeatureVector(fdict)
+
+
+def weights_of(parameters):
+    scale = getattr(parameters, 'scale', 1.0)
+    return {key: scale*value for key, value in parameters.fdict.items() if value}
+
+
+@pytest.mark.parametrize('scaled', [False, True])
+@pytest.mark.parametrize('decay', [False, True])
+def test_checkpoint_restore_matches_snapshot(scaled, decay):
+    rng = random.Random(2*scaled + decay)
+    vector = ScaledFeatureVector if scaled else FeatureVector
+    parameters = vector(WeightMatrix(FeatureIndex(), TAGSET))
+    checkpoint = WeightCheckpoint(parameters)
+    for _ in range(5):
+        parameters.times_plus_equal(1, random_update(rng, 10))
+    checkpoint.commit()
+    expected = weights_of(copy.deepcopy(parameters))
+
+    for step in range(20):
+        update = random_update(rng, 10)
+        checkpoint.record(update)
+        parameters.times_plus_equal(-1, update)
+        if decay and step % 7 == 3:
+            checkpoint.record_all()
+            l2_decay(parameters, 0.01)
+    assert weights_of(parameters) != expected
+    assert weights_of(checkpoint.restore()) == pytest.approx(expected, rel=1e-12, abs=1e-12)
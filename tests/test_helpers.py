@@ -0,0 +1,87 @@
+"""
+Checks of the compiled features and of parallel prediction in helpers.py against the plain code paths
+
+Usage: python -m pytest tests
+"""
+import random
+
+import numpy as np
+import pytest
+
+from decode import allowed_transitions, BeamDecoder
+from features import Features, FeatureIndex, FeatureVector, WeightMatrix
+import helpers
+from helpers import compile_data, load_compiled_data, compute_features, compute_score_matrices, predict, predict_all, predict_stream, TAGSET
+from synthetic import FEATURE_NAMES, random_data, random_model
+
+
+def random_tags(rng, n_words):
+    return ['<START>'] + [rng.choice(TAGSET) for _ in range(n_words)] + ['<STOP>']
+
+
+def test_compiled_gradients_match_string_gradients():
+    rng = random.Random(0)
+    data = random_data(rng, 30, (1, 15))
+    index = FeatureIndex()
+    compiled = compile_data(data, FEATURE_NAMES, index, TAGSET)
+    weights = WeightMatrix(index, TAGSET)
+    weights.weights = np.random.RandomState(0).randn(len(index), len(TAGSET))
+
+    for inputs, features in zip(data, compiled):
+        input_len = len(inputs['tokens'])
+        string_features = Features(inputs, FEATURE_NAMES)
+        predicted = random_tags(rng, input_len-2)
+
+        expected = compute_features(predicted, input_len, string_features)
+        expected.times_plus_equal(-1, compute_features(inputs['gold_tags'], input_len, string_features))
+        # the features of <STOP> do not fit the weight matrix and never take part in decoding, so they are not compiled
+        expected = {key: value for key, value in expected.fdict.items() if value and weights.slot(key, add=False) >= 0}
+        gradient = compute_features(predicted, input_len, features)
+        gradient.times_plus_equal(-1, compute_features(inputs['gold_tags'], input_len, features))
+        assert {weights.key(slot): value for slot, value in gradient.fdict.items() if value} == expected
+
+
+        # the string features score against a plain dict of the same weights, the compiled ones against the matrix
+        emissions, transitions, start_transitions = compute_score_matrices(string_features, input_len, FeatureVector(dict(weights.items())), TAGSET)
+        compiled_emissions, compiled_transitions, compiled_start = compute_score_matrices(features, input_len, FeatureVector(weights), TAGSET)
+        assert np.allclose(emissions, compiled_emissions)
+        # the first transition scores are never read, viterbi takes start_transitions there
+        assert np.allclose(transitions[1:], compiled_transitions[1:])
+        assert np.allclose(start_transitions, compiled_start)
+
+
+def test_compiled_data_cache_is_keyed_by_format_version(tmp_path, monkeypatch):
+    rng = random.Random(4)
+    filename = str(tmp_path/'ner.sample')
+    with open(filename, 'w') as f:
+        for inputs in random_data(rng, 5, (1, 6)):
+            for token, pos, tag in zip(inputs['tokens'][1:-1], inputs['pos'][1:-1], inputs['gold_tags'][1:-1]):
+                f.write('%s %s I-NP %s\n' % (token, pos, tag))
+            f.write('\n')
+    cache_dir = tmp_path/'cache'
+
+    data, compiled = load_compiled_data(filename, FEATURE_NAMES, TAGSET, cache_dir=str(cache_dir))
+    load_compiled_data(filename, FEATURE_NAMES, TAGSET, cache_dir=str(cache_dir))
+    assert len(list(cache_dir.iterdir())) == 1
+    monkeypatch.setattr(helpers, 'COMPILED_FORMAT_VERSION', helpers.COMPILED_FORMAT_VERSION+1)
+    _, recompiled = load_compiled_data(filename, FEATURE_NAMES, TAGSET, cache_dir=str(cache_dir))
+    assert len(list(cache_dir.iterdir())) == 2
+    assert [c.feature_slots(inputs['gold_tags']).tolist() for c, inputs in zip(recompiled, data)] == \
+        [c.feature_slots(inputs['gold_tags']).tolist() for c, inputs in zip(compiled, data)]
+
+
+@pytest.mark.parametrize('decoder', [None, BeamDecoder(3)])
+@pytest.mark.parametrize('scheme', [None, 'iob1'])
+def test_parallel_prediction_matches_serial(decoder, scheme):
+    rng = random.Random(1)
+    data = random_data(rng, 50, (1, 20))
+    parameters = random_model(rng, data)
+    constraints = allowed_transitions(TAGSET, scheme) if scheme else None
+    options = dict(constraints=constraints, decoder=decoder)
+
+    expected = [predict(inputs, len(inputs['tokens']), parameters, FEATURE_NAMES, TAGSET, **options) for inputs in data]
+    assert predict_all(data, parameters, FEATURE_NAMES, TAGSET, **options) == expected
+    assert predict_all(data, parameters, FEATURE_NAMES, TAGSET, processes=2, chunksize=7, **options) == expected
+    for processes in (None, 2):
+        stream = predict_stream(iter(data), parameters, FEATURE_NAMES, TAGSET, processes=processes, chunksize=7, max_pending=1, **options)
+        assert [tag_seq for _, tag_seq in stream] == expected
@@ -0,0 +1,145 @@
+"""
+Checks the optimizers in optimizers.py against the straightforward updates they replace, on random gradients
+
+Usage: python -m pytest tests
+"""
+import random
+from copy import deepcopy
+
+import pytest
+
+from features import FeatureIndex, FeatureVector, ScaledFeatureVector, WeightMatrix
+from helpers import TAGSET
+from optimizers import svm_optimizer, adagrad_optimizer
+
+F1S = [0.1, 0.3, 0.2, 0.4, 0.4, 0.3, 0.2, 0.1, 0.5] # early stopping after the 8th epoch, back to the 4th
+
+
+def random_gradients(rng, n_examples, n_words=12):
+    """
+    :return: Array of FeatureVectors over string keys, most of which fit the WeightMatrix layout and some (of <STOP>) don't
+    """
+    gradients = []
+    for _ in range(n_examples):
+        fdict = {}
+        for _ in range(rng.randint(1, 10)):
+            fdict['Wi=w'+str(rng.randrange(n_words))+'+Ti='+rng.choice(TAGSET)] = rng.choice([-2, -1, 1, 2])
+        if rng.random() < 0.3:
+            fdict['Ti=<STOP>+Ti-1='+rng.choice(TAGSET)] = rng.choice([-1, 1])
+        gradients.append(FeatureVector(fdict))
+    return gradients
+
+
+def as_slots(gradients, index):
+    """
+    :return: The gradients keyed by WeightMatrix slots where the key fits the layout, as compiled training makes them
+    """
+    matrix = WeightMatrix(index, TAGSET)
+    slotted = []
+    for g in gradients:
+        fdict = {}
+        for key, value in g.fdict.items():
+            slot = matrix.slot(key)
+            fdict[key if slot < 0 else slot] = value
+        slotted.append(FeatureVector(fdict))
+    return slotted
+
+
+def actual_weights(parameters):
+    scale = getattr(parameters, 'scale', 1.0)
+    return {key: scale * value for key, value in parameters.fdict.items() if value}
+
+
+def run(optimizer, gradients, parameters, **kwargs):
+    """
+    :return: Tuple of (final weights, weights seen by the observer after each epoch)
+    """
+    seen = []
+    def observer(epoch, parameters):
+        seen.append(actual_weights(parameters))
+        return F1S[epoch]
+    final = optimizer(len(gradients), len(F1S), lambda i: gradients[i], parameters, observer, **kwargs)
+    return actual_weights(final), seen
+
+
+def assert_same_weights(weights, expected):
+    assert set(weights) == set(expected)
+    for key, value in expected.items():
+        assert weights[key] == pytest.approx(value, rel=1e-9, abs=1e-12)
+
+
+def eager_svm(training_size, epochs, gradient, parameters, training_observer, alpha=1.0, lamda=0.0):
+    # the update of the original svm_optimizer, copying the whole model for the decay, and a copy of the best epoch
+    best_f1, best_parameters, patience = float('-inf'), None, 0
+    for epoch in range(epochs):
+        for i in range(training_size):
+            parameters.times_plus_equal(-alpha, gradient(i))
+            parameters.times_plus_equal(-alpha*lamda, deepcopy(parameters))
+        cur_f1 = training_observer(epoch, parameters)
+        if cur_f1 > best_f1:
+            best_f1, best_parameters, patience = cur_f1, deepcopy(parameters), 0
+        else:
+            patience += 1
+            if patience > 3:
+                break
+    return best_parameters
+
+
+@pytest.mark.parametrize('store', ['dict', 'matrix', 'scaled dict', 'scaled matrix', 'scaled slots'])
+@pytest.mark.parametrize('lamda', [0.0, 0.01, 0.3])
+def test_lazy_l2_matches_eager_update(store, lamda):
+    rng = random.Random(2)
+    gradients = random_gradients(rng, 40)
+    expected, expected_seen = run(eager_svm, gradients, FeatureVector({}), alpha=0.5, lamda=lamda)
+
+    index = FeatureIndex()
+    if store.endswith('slots'):
+        gradients = as_slots(gradients, index)
+    fdict = {} if store.endswith('dict') else WeightMatrix(index, TAGSET)
+    parameters = ScaledFeatureVector(fdict) if store.startswith('scaled') else FeatureVector(fdict)
+    weights, seen = run(svm_optimizer, gradients, parameters, alpha=0.5, lamda=lamda)
+
+    assert len(seen) == len(expected_seen)
+    for epoch_weights, epoch_expected in zip(seen, expected_seen):
+        assert_same_weights(epoch_weights, epoch_expected)
+    assert_same_weights(weights, expected)
+
+
+def original_adagrad(training_size, epochs, gradient, parameters, training_observer):
+    # the update of the original adagrad_optimizer, built from whole FeatureVectors, and a copy of the best epoch
+    best_f1, best_parameters, patience = float('-inf'), None, 0
+    gradient_matrix = FeatureVector({})
+    for epoch in range(epochs):
+        for i in range(training_size):
+            gradient_t = gradient(i)
+            gradient_matrix.times_plus_equal(1, gradient_t.square())
+            gradient_t_square_running = gradient_matrix.current_params(gradient_t)
+            parameters.times_plus_equal(-1, gradient_t.divide(gradient_t_square_running.square_root()))
+        cur_f1 = training_observer(epoch, parameters)
+        if cur_f1 > best_f1:
+            best_f1, best_parameters, patience = cur_f1, deepcopy(parameters), 0
+        else:
+            patience += 1
+            if patience > 3:
+                break
+    return best_parameters
+
+
+@pytest.mark.parametrize('store', ['dict', 'matrix', 'slots', 'slots only'])
+def test_adagrad_matches_original_update(store):
+    rng = random.Random(3)
+    gradients = random_gradients(rng, 40)
+    if store == 'slots only': # every key a slot, which takes the vectorized update
+        gradients = [FeatureVector({k: v for k, v in g.fdict.items() if '<STOP>' not in k}) for g in gradients]
+    expected, expected_seen = run(original_adagrad, gradients, FeatureVector({}))
+
+    index = FeatureIndex()
+    if store.startswith('slots'):
+        gradients = as_slots(gradients, index)
+    parameters = FeatureVector({} if store == 'dict' else WeightMatrix(index, TAGSET))
+    weights, seen = run(adagrad_optimizer, gradients, parameters)
+
+    assert len(seen) == len(expected_seen)
+    for epoch_weights, epoch_expected in zip(seen, expected_seen):
+        assert_same_weights(epoch_weights, epoch_expected)
+    assert_same_weights(weights, expected)
@@ -0,0 +1,30 @@
+"""
+Checks that the prediction profile charges building the features to feature_extraction rather than to scoring
+
+Usage: python -m pytest tests
+"""
+import random
+
+import profiling
+from helpers import predict, predict_all, TAGSET
+from synthetic import FEATURE_NAMES, random_data, random_model
+
+
+def profile(func):
+    profiling.enable()
+    try:
+        func()
+        return {name: timer['seconds'] for name, timer in profiling.report()['timers'].items()}
+    finally:
+        profiling.enable(False)
+
+
+def test_prediction_profile_times_feature_extraction():
+    rng = random.Random(0)
+    data = random_data(rng, 200, 15)
+    parameters = random_model(rng, data)
+    for func in (lambda: predict_all(data, parameters, FEATURE_NAMES, TAGSET),
+                 lambda: [predict(inputs, len(inputs['tokens']), parameters, FEATURE_NAMES, TAGSET) for inputs in data]):
+        seconds = profile(func)
+        # building the string features costs much more than the array operations that score them
+        assert seconds['feature_extraction'] > seconds['scoring'] / 4
@@ -0,0 +1,58 @@
+"""
+Starts the tagging server on a free port and talks to it with the stand-in client of server.py
+
+Usage: python -m pytest tests
+"""
+import json
+import random
+import threading
+import urllib.request
+import urllib.error
+
+import pytest
+
+from server import make_server, make_inputs, client_tag
+from helpers import predict, TAGSET, FEATURE_NAMES
+from synthetic import random_data, random_model
+
+
+@pytest.fixture(params=[None, 2], ids=['in_process', 'pool'])
+def server(request, tmp_path):
+    rng = random.Random(0)
+    data = random_data(rng, 20, (1, 10))
+    parameters = random_model(rng, data)
+    parameters.write_to_file(str(tmp_path/'model'))
+    server = make_server(str(tmp_path/'model'), port=0, processes=request.param)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = 'http://%s:%d' % server.server_address
+    server.data, server.parameters = data, parameters
+    yield server
+    server.shutdown()
+    server.server_close()
+    server.tagger.close()
+
+
+def post(url, body):
+    request = urllib.request.Request(url+'/tag', data=body, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_client_tag(server):
+    for inputs in server.data:
+        tokens, pos = inputs['tokens'][1:-1], inputs['pos'][1:-1]
+        expected = predict(make_inputs(tokens, pos), len(tokens)+2, server.parameters, FEATURE_NAMES, TAGSET)[1:-1]
+        assert client_tag(server.url, tokens, pos) == expected
+    assert client_tag(server.url, [], []) == []
+    assert server.tagger.metrics()['requests'] == len(server.data)
+
+
+def test_bad_requests(server):
+    for body in [b'not json', json.dumps({'tokens': ['EU']}), json.dumps({'tokens': 'EU', 'pos': 'NNP'}),
+                 json.dumps({'tokens': ['EU', 3], 'pos': ['NNP', 'CD']}), json.dumps({'tokens': ['EU'], 'pos': []})]:
+        assert post(server.url, body if isinstance(body, bytes) else body.encode('utf-8')) == 400
+    assert client_tag(server.url, ['EU', 'rejects'], ['NNP', 'VBZ'])    # the server still tags after them
@@ -1,7 +1,13 @@
-from optimizers import sgd_optimizer, svm_optimizer, adagrad_optimizer
-from features import FeatureVector, Features
-from helpers import compute_features,read_data, evaluate, write_predictions
-from decode import decode
+import multiprocessing
+
+import numpy as np
+
+from optimizers import sgd_optimizer, svm_optimizer, adagrad_optimizer, averaged_perceptron_optimizer, minibatch_optimizer, parameter_mixing_optimizer
+from features import FeatureVector, ScaledFeatureVector, FeatureIndex, WeightMatrix
+from helpers import compute_features, compute_score_matrices, compile_data, count_observations, selected_index, read_data, predict_all, evaluate_tag_sequences, write_tag_sequences
+from decode import viterbi, allowed_transitions, BeamDecoder
+from binary_model import write_binary_model
+import profiling
 
 def hamming_loss(gold,predicted):
     return (10*int(gold!=predicted))
@@ -11,7 +17,29 @@ def hamming_loss_modified(gold,predicted):
         return 30*int(gold!=predicted)
     return 10*int(gold!=predicted)
 
-def train(data, feature_names, tagset, epochs, method, optimizer, step_size=1.0, l2=None):
+COST_FUNCTIONS = {'hamming': hamming_loss, 'hamming_modified': hamming_loss_modified}  # name -> loss(gold, predicted)
+
+def cost_matrices(data, tagset, loss, skip_last=False):
+    """
+    Precomputes the cost of every tag at every position of every sentence for cost augmented decoding.  The loss is
+    evaluated once per (gold tag, tag) pair, so any loss(gold, predicted) costs the same during training.
+    :param data: Array of dictionaries, as returned by read_data
+    :param tagset: Array of Strings.  The list of tags.
+    :param loss: Function from gold tag (string) and predicted tag (string) to the cost, e.g. hamming_loss
+    :param skip_last: Boolean.  No cost for the last word of a sentence
+    :return: Array of numpy arrays of shape (n_words, n_tags), one for each sentence, to be added to the emissions
+    """
+    tag_index = {tag: j for j, tag in enumerate(tagset)}
+    table = np.array([[loss(gold, tag) for tag in tagset] for gold in tagset], dtype=np.float64)
+    costs = []
+    for inputs in data:
+        cost = table[[tag_index[tag] for tag in inputs['gold_tags'][1:-1]]]
+        if skip_last and len(cost):
+            cost[-1] = 0
+        costs.append(cost)
+    return costs
+
+def train(data, feature_names, tagset, epochs, method, optimizer, step_size=1.0, l2=None, n_buckets=None, compiled=None, processes=None, parallel=None, batch_size=64, scheme=None, decoder=None, cost=None, min_count=None):
     """
     Trains the model on the data and returns the parameters
     :param data: Array of dictionaries representing the data.  One dictionary for each data point (as created by the
@@ -19,9 +47,47 @@ def train(data, feature_names, tagset, epochs, method, optimizer, step_size=1.0,
     :param feature_names: Array of Strings.  The list of feature names.
     :param tagset: Array of Strings.  The list of tags.
     :param epochs: Int. The number of epochs to train
+    :param n_buckets: Int or None.  Hash features into this many ids instead of interning them (see FeatureIndex)
+    :param compiled: Array of CompiledFeatures or None.  The precompiled features of data, see helpers.load_compiled_data.
+        Compiled here if not given.  Either way every epoch reuses them.
+    :param processes: Int or None.  Number of worker processes used to evaluate after each epoch, and to train with
+        when parallel is set
+    :param parallel: String or None.  'minibatch' for mini-batch training with the gradients of a batch computed in
+        parallel, 'mixing' for iterative parameter mixing over one shard per process.  None trains in this process.
+        Both train with SGD steps (and the L2 decay of svm), so they cannot be used with the adagrad optimizer, and do
+        not average the parameters, so they cannot be used with averaged_perceptron.
+    :param batch_size: Int.  Batch size for parallel='minibatch'
+    :param scheme: String or None.  Tagging scheme ('iob1' or 'iob2', see decode.allowed_transitions) whose invalid
+        transitions are ruled out when decoding, both for the gradients and for evaluation.  None decodes without
+        constraints.
+    :param decoder: Function with the arguments of decode.viterbi, e.g. a decode.BeamDecoder, used instead of viterbi
+        for the gradients and for evaluation.  None decodes exactly.
+    :param cost: String, function or None.  The cost of svm and svm_modified: a key of COST_FUNCTIONS or a function
+        from gold tag and predicted tag to the cost.  None uses 'hamming' for svm and 'hamming_modified' for
+        svm_modified.
+    :param min_count: Int or None.  When the features are compiled here, only keep the observations seen at least
+        min_count times on the gold tags of data (see helpers.count_observations).  Not with n_buckets.
     :return: FeatureVector. The learned parameters.
     """
-    parameters = FeatureVector({})   # creates a zero vector
+    if parallel is not None and optimizer == 'adagrad':
+        raise ValueError('parallel training does not support the adagrad optimizer')
+    if parallel is not None and method == 'averaged_perceptron':
+        raise ValueError('parallel training returns the last parameters, not their average: use structured_perceptron')
+    constraints = allowed_transitions(tagset, scheme) if scheme else None
+    decode = decoder or viterbi
+    if compiled is None:
+        print('Compiling features')
+        if min_count:
+            index = selected_index(count_observations(data, feature_names), min_count)
+            print('Kept %d observations seen at least %d times' % (len(index), min_count))
+            compiled = compile_data(data, feature_names, index, tagset, add=False)
+        else:
+            compiled = compile_data(data, feature_names, FeatureIndex(n_buckets), tagset)
+    index = compiled[0].index if compiled else FeatureIndex(n_buckets)
+    if method=='svm' and l2:
+        parameters = ScaledFeatureVector(WeightMatrix(index, tagset))  # zero vector, with O(1) L2 regularization steps
+    else:
+        parameters = FeatureVector(WeightMatrix(index, tagset))   # creates a zero vector
 
     def perceptron_gradient(i):
         """
@@ -32,84 +98,101 @@ def train(data, feature_names, tagset, epochs, method, optimizer, step_size=1.0,
         inputs = data[i]
         input_len = len(inputs['tokens'])
         gold_labels = inputs['gold_tags']
-        features = Features(inputs, feature_names)
+        features = compiled[i]
 
-        def score(cur_tag, pre_tag, i):
-            return parameters.dot_product(features.compute_features(cur_tag, pre_tag, i))
-
-        tags = decode(input_len, tagset, score)
+        matrices = compute_score_matrices(features, input_len, parameters, tagset)
+        with profiling.timer('decode'):
+            profiling.count('sentences_decoded')
+            profiling.count('tokens_decoded', input_len-2)
+            tags = decode(*matrices, tagset, constraints)
         fvector = compute_features(tags, input_len, features)           # Add the predicted features
         fvector.times_plus_equal(-1, compute_features(gold_labels, input_len, features))    # Subtract the features for the gold labels
         return fvector
 
+    if method in ('svm', 'svm_modified'):
+        loss = cost or {'svm': 'hamming', 'svm_modified': 'hamming_modified'}[method]
+        # svm_modified used to add the cost of a tag to the transitions out of it, so the last word (whose transition
+        # is to <STOP>, which is never scored) had no cost.  Kept, so that training gives the same results.
+        costs = cost_matrices(data, tagset, COST_FUNCTIONS[loss] if isinstance(loss, str) else loss, skip_last=method=='svm_modified')
+
     def svm_gradient(i):
         """
-        Computes the gradient of the SVM loss for example i
+        Computes the gradient of the SVM loss for example i.  Cost augmented decoding adds the precomputed costs of
+        the example to the emission scores.
         :param i: Int
         :return: FeatureVector
         """
         inputs = data[i]
         input_len = len(inputs['tokens'])
         gold_labels = inputs['gold_tags']
-        features = Features(inputs, feature_names)
-
-        def score_svm(cur_tag, pre_tag, i):
-            return parameters.dot_product(features.compute_features(cur_tag, pre_tag, i)) + hamming_loss(gold_labels[i],cur_tag)
+        features = compiled[i]
 
-        tags = decode(input_len, tagset, score_svm)
+        emissions, transitions, start_transitions = compute_score_matrices(features, input_len, parameters, tagset)
+        with profiling.timer('decode'):
+            profiling.count('sentences_decoded')
+            profiling.count('tokens_decoded', input_len-2)
+            tags = decode(emissions + costs[i], transitions, start_transitions, tagset, constraints)
         fvector = compute_features(tags, input_len, features)           # Add the predicted features
         fvector.times_plus_equal(-1, compute_features(gold_labels, input_len, features))    # Subtract the features for the gold labels
         return fvector
     
-    def svm_modified_gradient(i):
-        """
-        Computes the gradient of the SVM loss for example i
-        :param i: Int
-        :return: FeatureVector
-        """
-        inputs = data[i]
-        input_len = len(inputs['tokens'])
-        gold_labels = inputs['gold_tags']
-        features = Features(inputs, feature_names)
-
-        def score_svm(cur_tag, pre_tag, i):
-            return parameters.dot_product(features.compute_features(cur_tag, pre_tag, i)) + hamming_loss_modified(gold_labels[i-1],pre_tag)
+    dev_data = read_data('ner.dev')    # held out sets are read once, not every epoch
+    # dev_data = read_data('ner.train')[:2]
+    test_data = read_data('ner.test')
+    # test_data = read_data('ner.train')[:2]
 
-        tags = decode(input_len, tagset, score_svm)
-        fvector = compute_features(tags, input_len, features)           # Add the predicted features
-        fvector.times_plus_equal(-1, compute_features(gold_labels, input_len, features))    # Subtract the features for the gold labels
-        return fvector
-    
     def training_observer(epoch, parameters):
         """
-        Evaluates the parameters on the development data, and writes out the parameters to a 'model.iter'+epoch and
-        the predictions to 'ner.dev.out'+epoch.
+        Evaluates the parameters on the development data, and writes out the parameters to a binary 'model.iter'+epoch and
+        the predictions to 'ner.dev.out'+epoch.  Each sentence is decoded once for both.
         :param epoch: int.  The epoch
         :param parameters: Feature Vector.  The current parameters
         :return: Double. F1 on the development data
         """
+        with profiling.timer('evaluation'):
+            f1 = evaluate_epoch(epoch, parameters)
+        profiling.epoch(epoch, model_size=len(parameters.fdict), index_size=len(index))
+        return f1
+
+    def evaluate_epoch(epoch, parameters):
         print ('---- Dev Data -----')
-        dev_data = read_data('ner.dev')
-        # dev_data = read_data('ner.train')[:2]
-        (_, _, f1) = evaluate(dev_data, parameters, feature_names, tagset)
-        write_predictions('outputs/ner.dev.out'+str(epoch), dev_data, parameters, feature_names, tagset)
-        parameters.write_to_file('outputs/model.iter'+str(epoch))
+        tag_seqs = predict_all(dev_data, parameters, feature_names, tagset, processes, constraints=constraints, decoder=decoder)
+        (_, _, f1) = evaluate_tag_sequences(dev_data, tag_seqs)
+        write_tag_sequences('outputs/ner.dev.out'+str(epoch), dev_data, tag_seqs)
+        write_binary_model(parameters, 'outputs/model.iter'+str(epoch))    # convert with binary_model.py for a text model
         
         print ('---- Test Data -----')
-        test_data = read_data('ner.test')
-        # test_data = read_data('ner.train')[:2]
-        (_, _, f1) = evaluate(test_data, parameters, feature_names, tagset)
-        write_predictions('outputs/ner.test.out'+str(epoch), test_data, parameters, feature_names, tagset)
+        tag_seqs = predict_all(test_data, parameters, feature_names, tagset, processes, constraints=constraints, decoder=decoder)
+        (_, _, f1) = evaluate_tag_sequences(test_data, tag_seqs)
+        write_tag_sequences('outputs/ner.test.out'+str(epoch), test_data, tag_seqs)
+        if isinstance(decoder, BeamDecoder):
+            # the decoder only counts the sentences decoded in this process
+            counted = [name for name, here in (('training', parallel is None), ('evaluation', not processes or processes == 1)) if here]
+            print('Beam decoding so far, %s decodes in this process:' % (' and '.join(counted) or 'no'), decoder.stats())
         return f1
 
     print (f'------------Method: {method} optimizer: {optimizer}--------------')
     print (f'-------- Feature Names: {feature_names}')
+    profiling.start_epoch()    # the first epoch starts here, not with the compiling and the reading of dev and test
+
+    if parallel is not None:
+        gradient = {'structured_perceptron': perceptron_gradient, 'svm': svm_gradient, 'svm_modified': svm_gradient}[method]
+        processes = processes or multiprocessing.cpu_count()
+        if parallel=='minibatch':
+            return minibatch_optimizer(len(data), epochs, gradient, parameters, training_observer, batch_size=batch_size,
+                processes=processes, alpha=step_size, lamda=(l2 or 0.0) if method=='svm' else 0.0)
+        if parallel=='mixing':
+            return parameter_mixing_optimizer(len(data), epochs, gradient, parameters, training_observer, processes=processes,
+                alpha=step_size, lamda=(l2 or 0.0) if method=='svm' else 0.0)
+        raise ValueError('Unknown parallel training mode: '+parallel)
 
     if method=='svm':
         return svm_optimizer(len(data), epochs, svm_gradient, parameters, training_observer, alpha=step_size, lamda=l2)
     if method=='svm_modified':
-        return svm_optimizer(len(data), epochs, svm_modified_gradient, parameters, training_observer)
+        return svm_optimizer(len(data), epochs, svm_gradient, parameters, training_observer)
     if method=='structured_perceptron' and optimizer=='sgd':
         return sgd_optimizer(len(data), epochs, perceptron_gradient, parameters, training_observer)
+    if method=='averaged_perceptron':
+        return averaged_perceptron_optimizer(len(data), epochs, perceptron_gradient, parameters, training_observer)
     if method=='structured_perceptron' and optimizer=='adagrad':
         return adagrad_optimizer(len(data), epochs, perceptron_gradient, parameters, training_observer)